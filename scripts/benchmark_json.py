@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import time
+
+from get_assetnote_assets_exposures import JSONBackend
+from get_assetnote_assets_exposures import info
+from get_assetnote_assets_exposures import error
+from get_assetnote_assets_exposures import orjson
+
+def load_pages(args):
+    """
+    Load the recorded pages to benchmark. Each file is either a page response
+    as returned by the Assetnote GraphQL API, or an outfile written by
+    get_assetnote_assets_exposures.py (a JSON array, or one record per line)
+    whose records are split into pages of the page count.
+
+    Arguments
+    ---------
+    args: dict
+        Arguments provided by the user
+
+    Returns
+    -------
+    list
+        Raw JSON of each page response, as bytes
+    """
+    pages = []
+    page_count = int(args['page_count'])
+    for page_file in args['page_files']:
+        with open(page_file, "rb") as f:
+            content = f.read()
+        try:
+            page = json.loads(content)
+        except ValueError:
+            page = [json.loads(line) for line in content.splitlines() if line.strip()]
+
+        if isinstance(page, dict):
+            pages.append(content)
+            continue
+        for i in range(0, len(page), page_count):
+            page_json = {'data': {args['collection']: {'edges': page[i:i + page_count],
+                                                       'pageInfo': {'hasNextPage': i + page_count < len(page)}}}}
+            pages.append(json.dumps(page_json, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+    return pages
+
+def time_backend(backend, pages, records, repeat):
+    """
+    Measure how long a JSON backend takes to parse the pages and to serialize
+    the records on them
+
+    Arguments
+    ---------
+    backend: JSONBackend
+        Backend to benchmark
+    pages: list
+        Raw JSON of each page response
+    records: list
+        Records on the pages
+    repeat: int
+        Number of times to parse and serialize all of them
+
+    Returns
+    -------
+    tuple
+        Seconds taken to parse the pages and to serialize the records, and
+        the bytes of the records serialized
+    """
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            backend.loads(page)
+    parse_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        records_json = [backend.dumps(record) for record in records]
+    serialize_time = time.perf_counter() - start_time
+    return parse_time, serialize_time, records_json
+
+def main():
+    parser = argparse.ArgumentParser(description=("Benchmark the throughput of parsing recorded Assetnote pages and "
+                                                  "serializing their records with each JSON backend"))
+    parser.add_argument("-f", "--page-files", nargs="+", required=True,
+                        help=("Recorded page responses eg saved from the GraphQL API, or outfiles written by "
+                              "get_assetnote_assets_exposures.py"))
+    parser.add_argument("-co", "--collection", choices=["assets", "exposures"], default="assets",
+                        help="Collection the pages belong to")
+    parser.add_argument("-pc", "--page-count", default="30",
+                        help="Number of records per page, when splitting an outfile into pages")
+    parser.add_argument("-n", "--repeat", default="20",
+                        help="Number of times to parse and serialize all the pages")
+    args = vars(parser.parse_args())
+    repeat = int(args['repeat'])
+
+    pages = load_pages(args)
+    records = []
+    for page in pages:
+        page_json = json.loads(page)
+        if 'data' not in page_json or not page_json['data'].get(args['collection']):
+            error(args, "Skipping a page without any {collection}...")
+            continue
+        records.extend(page_json['data'][args['collection']]['edges'])
+    args['num_pages'] = len(pages)
+    args['num_records'] = len(records)
+    args['num_bytes'] = sum(len(page) for page in pages)
+    info(args, "Benchmarking {num_pages} pages with {num_records} {collection} ({num_bytes} bytes) {repeat} times...")
+
+    backends = [JSONBackend(use_orjson=False)]
+    if orjson is not None:
+        backends.append(JSONBackend())
+    else:
+        info(args, "orjson is not installed, benchmarking the json module only...")
+
+    print("{:>8} {:>12} {:>14} {:>14} {:>16}".format("backend", "parse MB/s", "parse recs/s",
+                                                     "serialize MB/s", "serialize recs/s"))
+    outputs = {}
+    for backend in backends:
+        parse_time, serialize_time, records_json = time_backend(backend, pages, records, repeat)
+        outputs[backend.name] = records_json
+        serialized_bytes = sum(len(record_json) for record_json in records_json)
+        print("{:>8} {:>12.1f} {:>14.0f} {:>14.1f} {:>16.0f}".format(
+              backend.name,
+              args['num_bytes'] * repeat / parse_time / 1e6,
+              len(records) * repeat / parse_time,
+              serialized_bytes * repeat / serialize_time / 1e6,
+              len(records) * repeat / serialize_time))
+
+    # The records written must not depend on the backend used
+    if len(outputs) > 1:
+        args['num_different'] = sum(1 for record_json, orjson_record_json in zip(outputs['json'], outputs['orjson'])
+                                    if record_json != orjson_record_json)
+        if args['num_different']:
+            error(args, "{num_different} of {num_records} records were serialized differently by the backends")
+        else:
+            info(args, "All {num_records} records were serialized byte-identically by both backends")
+
+
+if __name__ == "__main__":
+    main()
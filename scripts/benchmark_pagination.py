@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import requests
+
+from get_assetnote_assets_exposures import COLLECTION_QUERIES
+from get_assetnote_assets_exposures import create_session
+from get_assetnote_assets_exposures import get_page_variables
+from get_assetnote_assets_exposures import info
+from get_assetnote_assets_exposures import error
+
+def time_page_request(args, session, page_num, after=None):
+    """
+    Request a single page and measure how long the request took
+
+    Arguments
+    ---------
+    args: dict
+        Arguments provided by the user
+    session: requests.Session
+        HTTP session to request the page with
+    page_num: int
+        Page number to request
+    after: str
+        endCursor of the previous page, when paginating by cursor
+
+    Returns
+    -------
+    tuple
+        Latency of the request in seconds, and the endCursor of the page (or
+        None if the page could not be obtained)
+    """
+    page_args = dict(args)
+    page_args['page_num'] = page_num
+    variables = get_page_variables(args['pagination'], page_num, args['page_count'], after)
+    payload = COLLECTION_QUERIES[args['collection']].get_payload(variables)
+
+    start_time = time.monotonic()
+    try:
+        resp = session.post(
+                    "https://{instance}.assetnotecloud.com/api/v2/graphql".format(**args),
+                    json=payload,
+                    timeout=(float(args['connect_timeout']), float(args['read_timeout']))
+        )
+    except requests.exceptions.RequestException as e:
+        page_args['error'] = "{}, {}".format(e.__class__, e)
+        error(page_args, "Error encountered when retrieving page: {page_num} by {pagination}. Error: {error}")
+        return time.monotonic() - start_time, None
+    latency = time.monotonic() - start_time
+
+    # Error pages eg HTTP 502, 504 or rate limited are not necessarily JSON
+    page_args['status_code'] = resp.status_code
+    if resp.status_code != 200:
+        error(page_args, "Error encountered when retrieving page: {page_num} by {pagination} (HTTP {status_code})...")
+        return latency, None
+    try:
+        resp_json = resp.json()
+    except ValueError:
+        error(page_args, "Invalid JSON returned when retrieving page: {page_num} by {pagination}...")
+        return latency, None
+
+    if not isinstance(resp_json, dict) or not resp_json.get('data') or 'errors' in resp_json:
+        error(page_args, "Error encountered when retrieving page: {page_num} by {pagination}...")
+        return latency, None
+    return latency, resp_json['data'][args['collection']]['pageInfo'].get('endCursor')
+
+def main():
+    parser = argparse.ArgumentParser(description=("Benchmark the latency of deep pages when paginating by page "
+                                                  "number vs by cursor in Assetnote"))
+    parser.add_argument("-i", "--instance", required=True,
+                        help="Instance ID for assetnote instance. The API URL is based on {{instance}}.assetnotecloud.com")
+    parser.add_argument("-ak", "--api-key", required=True,
+                        help="API key to use for requesting the pages")
+    parser.add_argument("-co", "--collection", choices=["assets", "exposures"], default="assets",
+                        help="Collection to request the pages for")
+    parser.add_argument("-pc", "--page-count", default="30",
+                        help="Number of items to request per page")
+    parser.add_argument("-d", "--depths", default="1,10,50,100,250,500",
+                        help="Comma-separated page numbers at which to compare the latency of both modes")
+    parser.add_argument("-ct", "--connect-timeout", default="10",
+                        help="Timeout in seconds for connecting to the Assetnote instance")
+    parser.add_argument("-rt", "--read-timeout", default="120",
+                        help="Timeout in seconds for reading a page response from the Assetnote instance")
+    args = vars(parser.parse_args())
+    args['pool_size'] = 1
+    depths = sorted(set(int(depth) for depth in args['depths'].split(",")))
+
+    session = create_session(args)
+
+    # Pages are requested directly by their page number
+    info(args, "Requesting {collection} pages at depths: {depths} by page number...")
+    args['pagination'] = 'page'
+    page_latencies = {}
+    for depth in depths:
+        latency, end_cursor = time_page_request(args, session, depth)
+        if end_cursor is not None:
+            page_latencies[depth] = latency
+
+    # Cursors can only be obtained by walking every page up to the deepest one
+    info(args, "Walking {collection} pages up to the deepest page by cursor...")
+    args['pagination'] = 'cursor'
+    cursor_latencies = {}
+    end_cursor = None
+    for page_num in range(1, depths[-1] + 1):
+        latency, end_cursor = time_page_request(args, session, page_num, after=end_cursor)
+        if end_cursor is None:
+            break
+        if page_num in depths:
+            cursor_latencies[page_num] = latency
+
+    # Pages which could not be obtained are shown without a latency
+    print("{:>8} {:>12} {:>12}".format("page", "page (s)", "cursor (s)"))
+    for depth in depths:
+        page_latency = page_latencies.get(depth)
+        cursor_latency = cursor_latencies.get(depth)
+        print("{:>8} {:>12} {:>12}".format(depth,
+              "{:.3f}".format(page_latency) if page_latency is not None else "-",
+              "{:.3f}".format(cursor_latency) if cursor_latency is not None else "-"))
+
+    session.close()
+
+
+if __name__ == "__main__":
+    main()
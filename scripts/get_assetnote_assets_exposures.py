@@ -1,17 +1,37 @@
 #!/usr/bin/env python3
 import argparse
+import codecs
+import collections
+import datetime
+import email.utils
+import hashlib
 import json
+import os
+import random
+import re
 import requests
+import sys
+import threading
 import time
 
-# Graph Query templates to pull vulnerability and indicators
-EXPOSURES_GRAPHQL_QUERY_TEMPLATE = """
-query {{
-    exposures(count:{page_count},page:{page_num}) {{
-        edges {{
-            node {{
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# orjson is used to parse the pages and serialize the records, if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Graph Query to pull vulnerability and indicators. The $count, $page and $after
+# variables select the page to pull down - either by page number or by cursor
+EXPOSURES_GRAPHQL_QUERY = """
+query Exposures($count: Int!, $page: Int, $after: String) {
+    exposures(count:$count,page:$page,after:$after) {
+        edges {
+            node {
                 __typename,
-                ... on BaseExposure {{
+                ... on BaseExposure {
                     id,
                     name,
                     exposureUrl,
@@ -27,8 +47,8 @@ query {{
                     probeId,
                     severity,
                     severityNormalized: severityCustom,
-                    signature {{
-                        ... on HTTPSignature {{
+                    signature {
+                        ... on HTTPSignature {
                             categoryId,
                             categoryName,
                             created,
@@ -44,7 +64,7 @@ query {{
                             references,
                             severity,
                             signatureType,
-                            definition {{
+                            definition {
                                 id,
                                 name,
                                 categoryId,
@@ -53,106 +73,106 @@ query {{
                                 description,
                                 lastUpdated,
                                 signatureCount
-                            }}
-                        }}
-                    }}
-                    asset {{
-                        ... on SubdomainAsset {{
+                            }
+                        }
+                    }
+                    asset {
+                        ... on SubdomainAsset {
                             id,
                             host
-                        }}
-                    }}
-                }}
-            }}
-        }},
-        pageInfo {{
+                        }
+                    }
+                }
+            }
+        },
+        pageInfo {
             hasNextPage,
             hasPreviousPage,
             startCursor,
             endCursor
-        }}
-    }}
-}}
+        }
+    }
+}
 """
 
-# Graphql Query template to pull down assets. {page_count} is set and {page_num} is incremented
-# to pull down the assets listing
-ASSETS_GRAPHQL_QUERY_TEMPLATE = """
-query {{
-    assets(s:[{{rel:"assetGroup", field:"name", dir:ASC}}],count:{page_count},page:{page_num}) {{
-        edges {{
-            node {{
-                ... on CloudAsset {{
-                    activeARecords {{
-                        edges {{
-                            node {{ 
-                                ... on ADnsRecord {{
+# Graphql Query to pull down assets. The $count, $page and $after variables select
+# the page to pull down for the assets listing - either by page number or by cursor
+ASSETS_GRAPHQL_QUERY = """
+query Assets($count: Int!, $page: Int, $after: String) {
+    assets(s:[{rel:"assetGroup", field:"name", dir:ASC}],count:$count,page:$page,after:$after) {
+        edges {
+            node {
+                ... on CloudAsset {
+                    activeARecords {
+                        edges {
+                            node { 
+                                ... on ADnsRecord {
                                     id,
                                     ipAddress
-                                }}
-                            }}
-                        }}
-                    }},
-                    activeCnameRecords {{
-                        edges {{
-                            node {{
-                                ... on CnameDnsRecord {{
+                                }
+                            }
+                        }
+                    },
+                    activeCnameRecords {
+                        edges {
+                            node {
+                                ... on CnameDnsRecord {
                                     id,
                                     subdomain,
                                     rawRecord
-                                }}
-                            }}
-                        }}
-                    }}
-                }},
-                ... on IpAsset {{
-                    activeARecords {{
-                        edges {{
-                            node {{ 
-                                ... on ADnsRecord {{
+                                }
+                            }
+                        }
+                    }
+                },
+                ... on IpAsset {
+                    activeARecords {
+                        edges {
+                            node { 
+                                ... on ADnsRecord {
                                     id,
                                     ipAddress
-                                }}
-                            }}
-                        }}
-                    }},
-                    activeCnameRecords {{
-                        edges {{
-                            node {{
-                                ... on CnameDnsRecord {{
+                                }
+                            }
+                        }
+                    },
+                    activeCnameRecords {
+                        edges {
+                            node {
+                                ... on CnameDnsRecord {
                                     id,
                                     subdomain,
                                     rawRecord
-                                }}
-                            }}
-                        }}
-                    }}
-                }},
-                ... on SubdomainAsset {{
-                    activeARecords {{
-                        edges {{
-                            node {{ 
-                                ... on ADnsRecord {{
+                                }
+                            }
+                        }
+                    }
+                },
+                ... on SubdomainAsset {
+                    activeARecords {
+                        edges {
+                            node { 
+                                ... on ADnsRecord {
                                     id,
                                     ipAddress
-                                }}
-                            }}
-                        }}
-                    }},
-                    activeCnameRecords {{
-                        edges {{
-                            node {{
-                                ... on CnameDnsRecord {{
+                                }
+                            }
+                        }
+                    },
+                    activeCnameRecords {
+                        edges {
+                            node {
+                                ... on CnameDnsRecord {
                                     id,
                                     subdomain,
                                     rawRecord
-                                }}
-                            }}
-                        }}
-                    }}
-                }},
+                                }
+                            }
+                        }
+                    }
+                },
                 __typename,
-    	        ... on BaseAsset {{
+    	        ... on BaseAsset {
                     humanName,
                     activeARecordCount,
         	    activeCnameRecordCount,
@@ -168,72 +188,72 @@ query {{
 	            assetGroupName,
 	            assetType,
 	            created,
-	            geoData {{
+	            geoData {
                         id,
                         city,
                         country
-                    }},
+                    },
 	            host,
-                    ... on IpAsset {{
+                    ... on IpAsset {
                         ipAddress,
-                        technologies {{
-                            edges {{
-                                node {{
+                        technologies {
+                            edges {
+                                node {
                                     name
-                                }}
-                            }}
-                        }},
-                        services {{
-                            edges {{
-                                node {{
+                                }
+                            }
+                        },
+                        services {
+                            edges {
+                                node {
                                     name,
                                     port,
                                     isActive,
                                     lastActive
-                                }}
-                            }}
-                        }}
-                    }},
-                    ... on CloudAsset {{
+                                }
+                            }
+                        }
+                    },
+                    ... on CloudAsset {
                         ipAddress,
-                        technologies {{
-                            edges {{
-                                node {{
+                        technologies {
+                            edges {
+                                node {
                                     name
-                                }}
-                            }}
-                        }},
-                        services {{
-                            edges {{
-                                node {{
+                                }
+                            }
+                        },
+                        services {
+                            edges {
+                                node {
                                     name,
                                     port,
                                     isActive,
                                     lastActive
-                                }}
-                            }}
-                        }}
-                    }},
-                    ... on SubdomainAsset {{
+                                }
+                            }
+                        }
+                    },
+                    ... on SubdomainAsset {
                        ipAddress: subdomain,
-                       technologies {{
-                            edges {{
-                                node {{
+                       technologies {
+                            edges {
+                                node {
                                     name
-                                }}
-                            }}
-                        }},
-                        services {{
-                            edges {{
-                                node {{
+                                }
+                            }
+                        },
+                        services {
+                            edges {
+                                node {
                                     name,
                                     port,
                                     isActive,
                                     lastActive
-                                }}
-                            }}
-                        }}
-                    }},
+                                }
+                            }
+                        }
+                    },
 	            id,
 	            importance,
  	            isMonitored,
@@ -242,23 +262,70 @@ query {{
 	            parentName,
 	            risk,
 	            verifiedStatus,
-                    assetGroup {{
+                    assetGroup {
                         id,
                         name
-                    }}
-	        }}
-            }}
-        }},
-        pageInfo {{
+                    }
+	        }
+            }
+        },
+        pageInfo {
             hasNextPage,
             hasPreviousPage,
             startCursor,
             endCursor
-        }}
-    }}
-}}
+        }
+    }
+}
 """
 
+# Set to stop all the running exports eg when the user interrupts the script
+STOP_EVENT = threading.Event()
+
+# Collections whose export ended before the last page was written, so that the
+# script exits with an error
+INCOMPLETE_EXPORTS = []
+
+# Retry policy per class of error: the number of times to re-request a page
+# failing with the error, and the base and maximum delay in seconds of the
+# exponential backoff between the requests. Errors of other classes eg HTTP
+# 400, 401 or 403 are not retried.
+RETRY_POLICIES = {
+    # Connection refused or reset, DNS failure, connect timeout
+    'connection': {'max_retries': 5, 'base_delay': 1, 'max_delay': 30},
+
+    # Read timeout - the page may be too large for the instance to return in
+    # time, so it is only retried a couple of times before shrinking the page
+    'timeout': {'max_retries': 2, 'base_delay': 5, 'max_delay': 60},
+
+    # HTTP 429 - waits at least as long as any 'Retry-After' header
+    'rate_limited': {'max_retries': 8, 'base_delay': 2, 'max_delay': 120},
+
+    # HTTP 502, 503, 504 - instance or gateway temporarily unavailable
+    'unavailable': {'max_retries': 6, 'base_delay': 5, 'max_delay': 120},
+
+    # Other HTTP 5xx, or a response which is not valid JSON
+    'server_error': {'max_retries': 2, 'base_delay': 5, 'max_delay': 60},
+
+    # HTTP 200 with an 'errors' payload (or without 'data') from GraphQL
+    'graphql': {'max_retries': 2, 'base_delay': 2, 'max_delay': 10},
+}
+
+# Pattern matching a string, whitespace around a punctuator, or any other
+# whitespace in a GraphQL document, to minify the document with
+GRAPHQL_MINIFY_PATTERN = re.compile(r'("(?:[^"\\]|\\.)*")|\s*([{}()\[\]:,!=])\s*|\s+')
+
+# Version of the automatic persisted queries protocol, to send the SHA-256 hash
+# of a query instead of its document
+PERSISTED_QUERY_VERSION = 1
+
+# Error code returned by the instance for a persisted query, per error message
+PERSISTED_QUERY_ERROR_CODES = {'PersistedQueryNotFound': 'PERSISTED_QUERY_NOT_FOUND',
+                               'PersistedQueryNotSupported': 'PERSISTED_QUERY_NOT_SUPPORTED'}
+
+# Number of bytes to read at a time from a page response read as a stream
+STREAM_CHUNK_SIZE = 65536
+
 def info(args, msg):
     """
     Print an info message
@@ -299,19 +366,1597 @@ def error(args, msg):
     """
     print("[-] " + msg.format(**args))
 
-def sleep_time(args):
+class GraphQLQuery(object):
+    """
+    GraphQL query document compiled once, with the page to request given as
+    variables rather than formatted into the document. The document is
+    minified and hashed with SHA-256 up front, so that in the persisted query
+    mode only the hash is sent to an instance which has already been sent the
+    document, as per the automatic persisted queries protocol.
+
+    Arguments
+    ---------
+    document: str
+        GraphQL query document, without any comments
+    """
+    def __init__(self, document):
+        self.document = GRAPHQL_MINIFY_PATTERN.sub(lambda m: m.group(1) or m.group(2) or ' ', document).strip()
+        self.sha256_hash = hashlib.sha256(self.document.encode('utf-8')).hexdigest()
+        self.extensions = {'persistedQuery': {'version': PERSISTED_QUERY_VERSION,
+                                              'sha256Hash': self.sha256_hash}}
+        self.registered = False
+        self.unsupported = False
+
+    def get_payload(self, variables=None, persisted=False):
+        """
+        Get the JSON payload of a request for the query. In the persisted
+        query mode, the document is only sent along with the hash until the
+        instance has returned a response to it.
+
+        Arguments
+        ---------
+        variables: dict
+            Values of the variables of the query
+        persisted: bool
+            If True, the hash of the query is sent, and the document left out
+            once the instance has been sent it
+
+        Returns
+        -------
+        dict
+            JSON payload of the request
+        """
+        payload = {}
+        if not persisted or self.unsupported:
+            payload['query'] = self.document
+        else:
+            if not self.registered:
+                payload['query'] = self.document
+            payload['extensions'] = self.extensions
+        if variables:
+            payload['variables'] = variables
+        return payload
+
+    def record_response(self, payload, status_code, content):
+        """
+        Record whether the instance knows the hash of the query, from the
+        response to a request sent with the hash. The instance has registered
+        the query once it returns a response to the document sent along with
+        the hash, and forgets it if it returns PersistedQueryNotFound.
+
+        Arguments
+        ---------
+        payload: dict
+            JSON payload the request was sent with
+        status_code: int
+            HTTP status code of the response
+        content: bytes
+            Body of the response
+
+        Returns
+        -------
+        bool
+            True, if the request must be sent again as the instance did not
+            know the hash, or does not support persisted queries
+        """
+        if 'extensions' not in payload:
+            return False
+        error_code = get_persisted_query_error(content)
+        if error_code == 'PERSISTED_QUERY_NOT_SUPPORTED':
+            self.unsupported = True
+            return True
+        if error_code == 'PERSISTED_QUERY_NOT_FOUND':
+            self.registered = False
+            return 'query' not in payload
+        if status_code == 200 and 'query' in payload:
+            self.registered = True
+        return False
+
+def get_persisted_query_error(content):
+    """
+    Get the error returned for a persisted query in a response, if any. The
+    body is only decoded if it mentions a persisted query at all, so that
+    pages of records are not decoded twice.
+
+    Arguments
+    ---------
+    content: bytes
+        Body of the response
+
+    Returns
+    -------
+    str
+        Error code eg 'PERSISTED_QUERY_NOT_FOUND', or None
+    """
+    if not content or (b'PersistedQuery' not in content and b'PERSISTED_QUERY' not in content):
+        return None
+    try:
+        resp_json = JSON_BACKEND.loads(content)
+    except ValueError:
+        return None
+    if not isinstance(resp_json, dict):
+        return None
+    for err in resp_json.get('errors') or []:
+        if not isinstance(err, dict):
+            continue
+        error_code = (err.get('extensions') or {}).get('code') or PERSISTED_QUERY_ERROR_CODES.get(err.get('message'))
+        if error_code in PERSISTED_QUERY_ERROR_CODES.values():
+            return error_code
+    return None
+
+# Graphql Queries to use for each collection that can be exported, compiled
+# once at import
+COLLECTION_QUERIES = {
+    'assets': GraphQLQuery(ASSETS_GRAPHQL_QUERY),
+    'exposures': GraphQLQuery(EXPOSURES_GRAPHQL_QUERY)
+}
+
+def create_session(args):
+    """
+    Create a single HTTP session which is shared for requesting all the pages
+    of assets and exposures, so that the keep-alive connections to the
+    Assetnote instance are pooled and re-used instead of performing a new
+    TCP/TLS handshake for every page
+
+    Arguments
+    ---------
+    args: dict
+        Arguments provided by the user including the pool size
+
+    Returns
+    -------
+    requests.Session
+        Session with a connection pool mounted for https
+    """
+    session = requests.Session()
+
+    # Ensure that there is a connection available for each concurrent worker
+    # of both the assets and exposures exports
+    pool_size = max(int(args['pool_size']), 2 * int(args.get('concurrency', 1)))
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=pool_size,
+                          pool_block=True)
+    session.mount("https://", adapter)
+    session.headers.update({
+        "X-ASSETNOTE-API-KEY": "{api_key}".format(**args)
+    })
+    return session
+
+def get_retry_after(headers):
+    """
+    Get the number of seconds to wait from the 'Retry-After' header of a
+    response, which may be given either in seconds or as an HTTP date
+
+    Arguments
+    ---------
+    headers: dict
+        Headers of the response
+
+    Returns
+    -------
+    float
+        Number of seconds to wait, or None if no valid 'Retry-After' header
+    """
+    retry_after = (headers or {}).get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        retry_after_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_after_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+
+class RetryBudget(object):
+    """
+    Total number of retries allowed across all the exports in a run, so that
+    an instance which keeps failing does not keep the exports retrying for
+    hours
+
+    Arguments
+    ---------
+    total_retries: int
+        Total number of retries allowed. If set to 0, no page is retried.
+    """
+    def __init__(self, total_retries):
+        self.total_retries = int(total_retries)
+        self.retries_used = 0
+        self.lock = threading.Lock()
+
+    def consume(self):
+        """
+        Use up a retry from the budget
+
+        Returns
+        -------
+        bool
+            True, if a retry was left in the budget
+        """
+        with self.lock:
+            if self.retries_used >= self.total_retries:
+                return False
+            self.retries_used += 1
+            return True
+
+def classify_error(status_code, resp_json, exception=None):
+    """
+    Classify the error (if any) encountered when requesting a page, to pick
+    the retry policy from RETRY_POLICIES
+
+    Arguments
+    ---------
+    status_code: int
+        HTTP status code of the response, or None if no response was received
+    resp_json: dict
+        JSON response, or None if the response was not valid JSON
+    exception: Exception
+        Exception raised when requesting the page, if any
+
+    Returns
+    -------
+    str
+        Class of the error eg 'connection', 'rate_limited', 'graphql', or None
+        if the page was obtained successfully
+    """
+    if exception is not None:
+        if isinstance(exception, requests.exceptions.ConnectTimeout):
+            return 'connection'
+        if isinstance(exception, requests.exceptions.Timeout):
+            return 'timeout'
+        if isinstance(exception, (requests.exceptions.ConnectionError,
+                                  requests.exceptions.ChunkedEncodingError)):
+            return 'connection'
+        return 'request'
+    if status_code == 429:
+        return 'rate_limited'
+    if status_code in (502, 503, 504):
+        return 'unavailable'
+    if status_code >= 500:
+        return 'server_error'
+    if status_code != 200:
+        return 'client_error'
+    if not isinstance(resp_json, dict):
+        return 'server_error'
+    if 'errors' in resp_json or 'data' not in resp_json:
+        return 'graphql'
+    return None
+
+def get_backoff_delay(policy, retry_num, retry_after=None):
+    """
+    Get the delay before re-requesting a page, growing exponentially with the
+    number of retries and jittered so that parallel exports do not retry in
+    lockstep
+
+    Arguments
+    ---------
+    policy: dict
+        Retry policy for the class of error, from RETRY_POLICIES
+    retry_num: int
+        Number of retries already made for the page
+    retry_after: float
+        Number of seconds to wait from the 'Retry-After' header, if any
+
+    Returns
+    -------
+    float
+        Number of seconds to wait before re-requesting the page
+    """
+    delay = min(policy['max_delay'], policy['base_delay'] * 2 ** retry_num)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+class RateLimiter(object):
+    """
+    Rate limiter shared by all the exports running in parallel, which lets
+    requests through as fast as the Assetnote instance allows. The rate is cut
+    multiplicatively when the instance signals pressure (HTTP 429, 5xx or a
+    'Retry-After' header), and recovered additively after each successful
+    request (AIMD). Until the first sign of pressure, the rate is only capped
+    by the maximum requests per second (if any).
+
+    Requests are spaced out evenly at the current rate, as with a token bucket
+    holding a single token, by keeping the earliest time the next request can
+    be made.
+
+    Arguments
+    ---------
+    max_requests_per_second: float
+        Maximum number of requests per second. If set to 0 or less, no limit.
+    min_requests_per_second: float
+        Rate below which the rate is never cut
+    """
+
+    # Factor to cut the rate by when the instance signals pressure
+    MULTIPLICATIVE_DECREASE = 0.5
+
+    # Requests per second to recover the rate by after each successful request
+    ADDITIVE_INCREASE = 0.5
+
+    # Number of recent requests to measure the rate from, when cutting the rate
+    # for the first time
+    RATE_WINDOW = 10
+
+    def __init__(self, max_requests_per_second=0, min_requests_per_second=0.1):
+        max_requests_per_second = float(max_requests_per_second)
+        self.max_rate = max_requests_per_second if max_requests_per_second > 0 else None
+        self.min_rate = float(min_requests_per_second)
+        if self.max_rate is not None:
+            self.min_rate = min(self.min_rate, self.max_rate)
+        self.rate = self.max_rate
+        self.next_request_time = 0
+        self.last_decrease_time = None
+        self.request_times = collections.deque(maxlen=self.RATE_WINDOW)
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the next request can be made without exceeding the rate
+
+        Returns
+        -------
+        float
+            Time (as per time.monotonic()) at which the request is made
+        """
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_time)
+            if self.rate is not None:
+                self.next_request_time = request_time + 1.0 / self.rate
+            self.request_times.append(request_time)
+        if request_time > now:
+            time.sleep(request_time - now)
+        return request_time
+
+    def get_current_rate(self):
+        """
+        Get the rate at which the recent requests were made
+
+        Returns
+        -------
+        float
+            Requests per second over the recent requests, or None if the rate
+            cannot be measured yet
+        """
+        if len(self.request_times) < 2:
+            return None
+        elapsed = self.request_times[-1] - self.request_times[0]
+        if elapsed <= 0:
+            return None
+        return (len(self.request_times) - 1) / elapsed
+
+    def record_response(self, status_code, headers=None, request_time=None):
+        """
+        Adjust the rate based on the response to a request. The rate is cut
+        only once for the requests which were already in flight when it was
+        last cut.
+
+        Arguments
+        ---------
+        status_code: int
+            HTTP status code of the response
+        headers: dict
+            Headers of the response
+        request_time: float
+            Time at which the request was made, as returned by wait()
+
+        Returns
+        -------
+        bool
+            True, if the response signalled pressure
+        """
+        retry_after = get_retry_after(headers)
+        with self.lock:
+            if status_code == 429 or status_code >= 500 or retry_after is not None:
+                now = time.monotonic()
+                if self.last_decrease_time is None or request_time is None or \
+                   request_time >= self.last_decrease_time:
+
+                    # Without a rate yet, cut the rate at which the recent
+                    # requests were made
+                    rate = self.rate
+                    if rate is None:
+                        rate = self.get_current_rate() or 1.0
+                    self.rate = max(rate * self.MULTIPLICATIVE_DECREASE, self.min_rate)
+                    self.next_request_time = max(self.next_request_time, now + 1.0 / self.rate)
+                    self.last_decrease_time = now
+
+                # No requests are let through until the time to retry after
+                if retry_after is not None:
+                    self.next_request_time = max(self.next_request_time, now + retry_after)
+                return True
+
+            if status_code == 200 and self.rate is not None:
+                self.rate += self.ADDITIVE_INCREASE
+                if self.max_rate is not None:
+                    self.rate = min(self.rate, self.max_rate)
+            return False
+
+class PageSizeController(object):
+    """
+    Adapt the number of items requested per page to the largest page that the
+    Assetnote instance handles well. The page size is doubled after a few pages
+    returned within the target latency, held while pages are slow, and halved
+    on timeouts or errors (or brought back to the largest page size known to
+    work, if a larger page size was being probed). A page size which failed is
+    never requested again, and growth then probes halfway towards it instead
+    of doubling.
+
+    Arguments
+    ---------
+    page_size: int
+        Page size to start with
+    min_page_size: int
+        Smallest page size to shrink to
+    max_page_size: int
+        Largest page size to grow to
+    target_latency: float
+        Page size is only grown while pages are returned within this time (s)
+    adaptive: bool
+        If False, the page size is kept fixed
+    """
+
+    # Number of pages returned within the target latency before growing
+    SUCCESSES_BEFORE_GROWTH = 2
+
+    def __init__(self, page_size, min_page_size=5, max_page_size=500,
+                 target_latency=10, adaptive=True):
+        self.adaptive = adaptive
+        self.min_page_size = min(min_page_size, page_size)
+        self.max_page_size = max(max_page_size, page_size)
+        if self.adaptive:
+            page_size = min(max(page_size, self.min_page_size), self.max_page_size)
+        self.page_size = page_size
+        self.target_latency = target_latency
+        self.successes = 0
+
+        # Largest page size returned within the target latency so far
+        self.learned_page_size = None
+
+    def get_page_size(self):
+        """
+        Get the page size to request the next page with
+
+        Returns
+        -------
+        int
+            Page size to request the next page with
+        """
+        return self.page_size
+
+    def record_success(self, page_size, latency):
+        """
+        Record a page returned successfully, growing the page size if healthy
+
+        Arguments
+        ---------
+        page_size: int
+            Page size the page was requested with
+        latency: float
+            Time taken to return the page (s)
+        """
+        if not self.adaptive:
+            return
+        if latency > self.target_latency:
+            self.successes = 0
+            return
+        self.learned_page_size = max(self.learned_page_size or 0, page_size)
+        self.successes += 1
+        if self.successes >= self.SUCCESSES_BEFORE_GROWTH:
+            self.page_size = min(self.page_size * 2,
+                                 (self.page_size + self.max_page_size + 1) // 2)
+            self.successes = 0
+
+    def record_failure(self, page_size):
+        """
+        Record a page which could not be obtained, shrinking the page size
+
+        Arguments
+        ---------
+        page_size: int
+            Page size the page was requested with
+
+        Returns
+        -------
+        bool
+            True, if the page size was shrunk and the page should be retried
+        """
+        self.successes = 0
+        if not self.adaptive or page_size <= self.min_page_size:
+            return False
+        self.max_page_size = max(page_size - 1, self.min_page_size)
+        if self.learned_page_size is not None and self.learned_page_size < page_size:
+            self.page_size = self.learned_page_size
+        else:
+            self.page_size = max(page_size // 2, self.min_page_size)
+            if self.learned_page_size is not None:
+                self.learned_page_size = min(self.learned_page_size, self.max_page_size)
+        return True
+
+# Lock for reading/writing the page size state file from the export threads
+PAGE_SIZE_STATE_LOCK = threading.Lock()
+
+def load_learned_page_size(state_file, query_type):
+    """
+    Load the page size learned in a previous export
+
+    Arguments
+    ---------
+    state_file: str
+        File to keep the learned page sizes in
+    query_type: str
+        Instance and collection eg 'demo/assets'
+
+    Returns
+    -------
+    int
+        Learned page size, or None if no page size was learned yet
+    """
+    with PAGE_SIZE_STATE_LOCK:
+        if not os.path.isfile(state_file):
+            return None
+        with open(state_file, "r") as f:
+            return json.load(f).get(query_type)
+
+def save_learned_page_size(state_file, query_type, page_size):
+    """
+    Save the page size learned in an export, for the next export to start with
+
+    Arguments
+    ---------
+    state_file: str
+        File to keep the learned page sizes in
+    query_type: str
+        Instance and collection eg 'demo/assets'
+    page_size: int
+        Learned page size
+    """
+    with PAGE_SIZE_STATE_LOCK:
+        learned_page_sizes = {}
+        if os.path.isfile(state_file):
+            with open(state_file, "r") as f:
+                learned_page_sizes = json.load(f)
+        learned_page_sizes[query_type] = page_size
+        with open(state_file, "w") as f:
+            f.write(json.dumps(learned_page_sizes, indent=4))
+
+class JSONBackend(object):
+    """
+    Serialization layer for the JSON of the pages and the records written,
+    using orjson when it is installed and the json module otherwise. Records
+    are serialized without any whitespace and with non-ASCII characters
+    written as is, so that the output of both backends is byte-identical
+    (apart from floats written with an exponent, eg 1e16 rather than 1e+16,
+    which are not found in the records). Values orjson does not handle (eg
+    integers beyond 64 bits) fall back to the json module.
+
+    Arguments
+    ---------
+    use_orjson: bool
+        Use orjson, if it is installed
+    """
+    def __init__(self, use_orjson=True):
+        self.orjson = orjson if use_orjson else None
+        self.name = "orjson" if self.orjson is not None else "json"
+
+    def loads(self, data):
+        """
+        Decode a JSON document
+
+        Arguments
+        ---------
+        data: bytes
+            JSON document, as bytes or str
+
+        Returns
+        -------
+        object
+            Value decoded
+        """
+        if self.orjson is not None:
+            try:
+                return self.orjson.loads(data)
+            except self.orjson.JSONDecodeError:
+                pass
+        return json.loads(data)
+
+    def dumps(self, value):
+        """
+        Serialize a value as JSON without any whitespace
+
+        Arguments
+        ---------
+        value: object
+            Value to serialize
+
+        Returns
+        -------
+        bytes
+            JSON of the value, encoded as UTF-8
+        """
+        if self.orjson is not None:
+            try:
+                return self.orjson.dumps(value)
+            except self.orjson.JSONEncodeError:
+                pass
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+# Serialization layer used for the pages and records, with orjson if installed
+JSON_BACKEND = JSONBackend()
+
+class StreamingJSONWriter(object):
+    """
+    Write records to an output file as they arrive instead of re-writing the
+    whole listing after every page. Records are written either as a JSON array
+    (same layout as json.dumps(records, indent=4), closed by close()) or as
+    newline-delimited JSON, one compact record per line. Compact records are
+    serialized by the JSON backend, while the indented layout is always
+    written by the json module, as orjson only indents by 2 spaces.
+
+    Arguments
+    ---------
+    path: str
+        Output file to write the records to
+    output_format: str
+        'json' for a JSON array, 'ndjson' for newline-delimited JSON
+    fsync_every: int
+        Number of pages to write before flushing and fsync-ing the file
+    resume_offset: int
+        If set, the existing output file is truncated to this byte offset and
+        records are appended to it instead of starting a new file
+    records_written: int
+        Number of records already in the output file when resuming
+    """
+    def __init__(self, path, output_format="json", fsync_every=10,
+                 resume_offset=None, records_written=0):
+        self.path = path
+        self.output_format = output_format
+        self.fsync_every = max(int(fsync_every), 1)
+        self.records_written = records_written
+        self.pages_since_sync = 0
+        self.closed = False
+        if resume_offset is not None:
+            self.f = open(path, "r+b")
+            self.f.truncate(resume_offset)
+            self.f.seek(resume_offset)
+        else:
+            self.f = open(path, "wb")
+            if self.output_format == "json":
+                self.f.write(b"[")
+
+        # Byte offset up to which the records have been fsync-ed to disk
+        self.committed_offset = self.f.tell()
+
+    def write_records(self, records):
+        """
+        Append a page of records to the output file
+
+        Arguments
+        ---------
+        records: iterable
+            Records (edges) obtained from a single page
+
+        Returns
+        -------
+        bool
+            True, if the records written so far were fsync-ed to disk
+        """
+        # Records of a page read as a stream are written as they are parsed,
+        # so the part of a page written before the page could not be obtained
+        # is dropped again
+        page_offset = self.f.tell()
+        page_records_written = self.records_written
+        try:
+            for record in records:
+                if self.output_format == "ndjson":
+                    self.f.write(JSON_BACKEND.dumps(record) + b"\n")
+                else:
+                    if self.records_written > 0:
+                        self.f.write(b",")
+                    self.f.write(("\n    " + json.dumps(record, indent=4).replace("\n", "\n    ")).encode("utf-8"))
+                self.records_written += 1
+        except PageNotObtainedError:
+            self.f.seek(page_offset)
+            self.f.truncate()
+            self.records_written = page_records_written
+            raise
+
+        self.pages_since_sync += 1
+        if self.pages_since_sync >= self.fsync_every:
+            self.sync()
+            return True
+        return False
+
+    def sync(self):
+        """
+        Flush buffered records and fsync them to disk
+        """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pages_since_sync = 0
+        self.committed_offset = self.f.tell()
+
+    def close(self):
+        """
+        Close the JSON array (if required), fsync and close the output file
+        """
+        if self.closed:
+            return
+        self.sync()
+        if self.output_format == "json":
+            if self.records_written > 0:
+                self.f.write(b"\n")
+            self.f.write(b"]")
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.closed = True
+
+class StreamingJSONParser(object):
+    """
+    Incremental parser for a JSON document read in chunks, which yields each
+    item of the array found at a path (eg the edges of a page) as soon as the
+    item is complete. Only the item being parsed is held in memory, along with
+    the rest of the document (the header) eg
+    {'data': {'assets': {'edges': [], 'pageInfo': {...}}}}. Each item is
+    decoded by the json module, while the objects leading to the array are
+    walked key by key.
+
+    Arguments
+    ---------
+    path: tuple
+        Keys of the objects leading to the array eg ('data', 'assets', 'edges')
+    """
+
+    WHITESPACE = " \t\n\r"
+
+    def __init__(self, path):
+        self.path = tuple(path)
+        self.decoder = json.JSONDecoder()
+        self.header = None
+
+    def parse(self, chunks):
+        """
+        Parse a JSON document, yielding each item of the array at the path. Once
+        all the items are yielded, the header is kept in 'header'.
+
+        Arguments
+        ---------
+        chunks: iterable
+            Text of the JSON document, in chunks
+        """
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+        self.header = yield from self.parse_value(self.path)
+        self.skip_whitespace(allow_eof=True)
+        if self.pos < len(self.buffer):
+            raise ValueError("Extra data after the JSON document at: {}".format(self.pos))
+
+    def read_more(self):
+        """
+        Read the next chunk of the document, dropping the text already parsed
+
+        Returns
+        -------
+        bool
+            False, if the whole document has been read
+        """
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def skip_whitespace(self, allow_eof=False):
+        """
+        Move past any whitespace, reading more of the document if needed
+
+        Arguments
+        ---------
+        allow_eof: bool
+            If False, reaching the end of the document is an error
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return
+            if not self.read_more():
+                if allow_eof:
+                    return
+                raise ValueError("Unexpected end of the JSON document")
+
+    def expect(self, chars):
+        """
+        Move past the next character, which must be one of the characters given
+
+        Arguments
+        ---------
+        chars: str
+            Characters expected eg ',}'
+
+        Returns
+        -------
+        str
+            Character found
+        """
+        self.skip_whitespace()
+        char = self.buffer[self.pos]
+        if char not in chars:
+            raise ValueError("Expected one of: {!r} at: {}, found: {!r}".format(chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """
+        Decode the next value in full, reading more of the document until the
+        value is complete
+
+        Returns
+        -------
+        object
+            Value decoded
+        """
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.read_more():
+                    raise
+                continue
+
+            # A number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and self.read_more():
+                continue
+            self.pos = end
+            return value
+
+    def parse_value(self, path):
+        """
+        Parse the next value, yielding the items of the array at the path
+
+        Arguments
+        ---------
+        path: tuple
+            Keys leading from the value to the array
+
+        Returns
+        -------
+        object
+            Value parsed, with the array at the path left empty
+        """
+        self.skip_whitespace()
+        if not path:
+            if self.buffer[self.pos] != '[':
+                return self.decode()
+            self.pos += 1
+            self.skip_whitespace()
+            if self.buffer[self.pos] == ']':
+                self.pos += 1
+                return []
+            while True:
+                yield self.decode()
+                if self.expect(',]') == ']':
+                    return []
+        if self.buffer[self.pos] != '{':
+            return self.decode()
+        self.pos += 1
+        value = {}
+        self.skip_whitespace()
+        if self.buffer[self.pos] == '}':
+            self.pos += 1
+            return value
+        while True:
+            key = self.decode()
+            self.expect(':')
+            if key == path[0]:
+                value[key] = yield from self.parse_value(path[1:])
+            else:
+                value[key] = self.decode()
+            if self.expect(',}') == '}':
+                return value
+
+class PageNotObtainedError(Exception):
+    """
+    Raised when a page read as a stream could not be obtained in full
+    """
+    pass
+
+class StreamedPage(object):
+    """
+    Page response read as a stream, whose edges are parsed and yielded one at
+    a time while the response is downloaded, so that only a single record of
+    the page is held in memory. If the stream breaks off part way (eg the
+    connection is reset) or the response turns out to be an error, the page
+    is requested again in full and only the edges not yielded yet are
+    yielded. Once the edges have been iterated, 'resp_json' holds the rest of
+    the response and 'page_info' the page info.
+
+    Arguments
+    ---------
+    resp: requests.Response
+        Response for the page, sent with stream=True
+    page_args: dict
+        Arguments for the page including the collection and page number
+    request_again: function
+        Function requesting the page again in full, returning the JSON
+        response or None if the page could not be obtained
+    """
+    def __init__(self, resp, page_args, request_again):
+        self.resp = resp
+        self.page_args = dict(page_args)
+        self.request_again = request_again
+        self.items_to_skip = 0
+        self.num_edges = 0
+        self.resp_json = None
+        self.page_info = {}
+        self.end_time = None
+
+    def iter_text(self):
+        """
+        Generator which yields the body of the response as text, in chunks
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for chunk in self.resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b"", final=True)
+
+    def iter_edges(self):
+        """
+        Generator which yields the edges of the page after the items to skip.
+        PageNotObtainedError is raised if the page could not be obtained in
+        full.
+        """
+        collection = self.page_args['collection']
+        parser = StreamingJSONParser(('data', collection, 'edges'))
+        num_parsed = 0
+        resp_json = None
+        try:
+            for edge in parser.parse(self.iter_text()):
+                num_parsed += 1
+                if num_parsed > self.items_to_skip:
+                    self.num_edges += 1
+                    yield edge
+            resp_json = parser.header
+        except (ValueError, requests.exceptions.RequestException) as e:
+            self.page_args['error'] = "{}, {}".format(e.__class__.__name__, e)
+            error(self.page_args, "Stream of page: {page_num} for {collection} broke off. Error: {error}")
+        finally:
+            self.resp.close()
+
+        if classify_error(200, resp_json) is not None:
+            self.page_args['num_parsed'] = num_parsed
+            info(self.page_args, "Requesting page: {page_num} for {collection} again after {num_parsed} {collection} parsed...")
+            resp_json = self.request_again()
+            if resp_json is None:
+                raise PageNotObtainedError("Page: {page_num} for {collection} could not be obtained".format(**self.page_args))
+            for edge in resp_json['data'][collection]['edges'][max(num_parsed, self.items_to_skip):]:
+                self.num_edges += 1
+                yield edge
+
+        self.resp_json = resp_json
+        self.page_info.update(resp_json['data'][collection]['pageInfo'])
+        self.end_time = time.monotonic()
+
+def get_checkpoint_path(outfile):
+    """
+    Get the path to the checkpoint file kept next to an outfile
+
+    Arguments
+    ---------
+    outfile: str
+        Output file being written by an export
+
+    Returns
+    -------
+    str
+        Path to the checkpoint file
+    """
+    return outfile + ".checkpoint"
+
+def load_checkpoint(checkpoint_path):
+    """
+    Load the checkpoint for an export
+
+    Arguments
+    ---------
+    checkpoint_path: str
+        Path to the checkpoint file
+
+    Returns
+    -------
+    dict
+        Checkpoint for the export, or None if no checkpoint exists
+    """
+    if not os.path.isfile(checkpoint_path):
+        return None
+    with open(checkpoint_path, "r") as f:
+        return json.load(f)
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    """
+    Save the checkpoint for an export. The checkpoint is written to a temporary
+    file first and then renamed, so a crash never leaves a partial checkpoint.
+
+    Arguments
+    ---------
+    checkpoint_path: str
+        Path to the checkpoint file
+    checkpoint: dict
+        Pages completed, cursor and byte offset of the export
+    """
+    tmp_checkpoint_path = checkpoint_path + ".tmp"
+    with open(tmp_checkpoint_path, "w") as f:
+        f.write(json.dumps(checkpoint, indent=4))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_checkpoint_path, checkpoint_path)
+
+def get_page_variables(pagination, page_num, page_count, after=None):
+    """
+    Get the values of the variables of the query which select the page to
+    request
+
+    Arguments
+    ---------
+    pagination: str
+        'page' to select the page by page number (offset-based), 'cursor' to
+        select the page after the cursor (keyset-based)
+    page_num: int
+        Page number to request
+    page_count: int
+        Number of items to request on the page
+    after: str
+        endCursor of the previous page, if any, when paginating by cursor
+
+    Returns
+    -------
+    dict
+        Values of the variables eg {'count': 30, 'page': 3} or
+        {'count': 30, 'after': 'YXJyYXk='}
+    """
+    variables = {'count': int(page_count)}
+    if pagination == 'cursor':
+        if after:
+            variables['after'] = after
+    else:
+        variables['page'] = page_num
+    return variables
+
+def request_page(args, session, rate_limiter, retry_budget, collection, page_num, after=None, page_count=None,
+                 stream=False):
+    """
+    Request a single page for a collection, retrying the page on errors as per
+    the retry policy for the class of error while the retry budget lasts
+
+    Arguments
+    ---------
+    args: dict
+        Arguments provided by the user
+    session: requests.Session
+        Shared HTTP session to request the page with
+    rate_limiter: RateLimiter
+        Rate limiter shared by all the exports
+    retry_budget: RetryBudget
+        Retry budget shared by all the exports
+    collection: str
+        Collection to request eg 'assets', 'exposures'
+    page_num: int
+        Page number to request
+    after: str
+        endCursor of the previous page, when paginating by cursor
+    page_count: int
+        Number of items to request on the page, if different to the page count
+        provided by the user
+    stream: bool
+        If True, the page is read as a stream once the instance responds with
+        HTTP 200
+
+    Returns
+    -------
+    dict
+        JSON response for the page (or StreamedPage, if read as a stream), or
+        None if the page could not be obtained
+    """
+    page_args = dict(args)
+    page_args['collection'] = collection
+    page_args['page_num'] = page_num
+    if page_count is not None:
+        page_args['page_count'] = page_count
+    variables = get_page_variables(args['pagination'], page_num, page_args['page_count'], after)
+    graphql_query = COLLECTION_QUERIES[collection]
+    url = "https://{instance}.assetnotecloud.com/api/v2/graphql".format(**page_args)
+
+    # The response to a page read as a stream cannot be checked for an
+    # unknown hash before it is read, so the document is always sent with it
+    persisted = args.get('persisted_queries', False) and not stream
+
+    info(page_args, "Requesting page: {page_num} of {page_count} {collection}...")
+
+    # Number of retries made for the page, per class of error
+    retries = {}
+    while True:
+        status_code = None
+        resp_json = None
+        retry_after = None
+        exception = None
+
+        payload = graphql_query.get_payload(variables, persisted)
+        request_time = rate_limiter.wait()
+        try:
+            resp = session.post(
+                        url,
+                        json=payload,
+                        timeout=(float(args['connect_timeout']), float(args['read_timeout'])),
+                        stream=stream
+            )
+            status_code = resp.status_code
+            retry_after = get_retry_after(resp.headers)
+            if rate_limiter.record_response(status_code, resp.headers, request_time):
+                page_args['rate'] = rate_limiter.rate
+                error(page_args, "Instance under pressure, slowing down to {rate:.2f} requests/s...")
+            if persisted and graphql_query.record_response(payload, status_code, resp.content):
+                info(page_args, "Instance did not know the persisted query for {collection}, sending it again with the document...")
+                continue
+            if stream and status_code == 200:
+                return StreamedPage(resp, page_args,
+                                    lambda: request_page_again(args, session, rate_limiter, retry_budget,
+                                                               collection, page_num, after, page_count))
+            try:
+                resp_json = JSON_BACKEND.loads(resp.content)
+            except ValueError:
+                pass
+        except Exception as e:
+            exception = e
+
+        info(page_args, "Checking if page: {page_num} obtained successfully...")
+        page_args['error_class'] = classify_error(status_code, resp_json, exception)
+        if page_args['error_class'] is None:
+            return resp_json
+
+        page_args['status_code'] = status_code
+        error(page_args, "Error encountered when retrieving page: {page_num} for {collection} ({error_class}, HTTP {status_code})...")
+        if exception is not None:
+            error(page_args, str(exception))
+        elif resp_json is not None:
+            error(page_args, "Error: ")
+            print(json.dumps(resp_json, indent=4))
+
+        policy = RETRY_POLICIES.get(page_args['error_class'])
+        if policy is None:
+            error(page_args, "Not retrying page: {page_num} for {collection} on {error_class} error...")
+            return None
+        page_args['max_retries'] = policy['max_retries']
+        page_args['retry_num'] = retries.get(page_args['error_class'], 0)
+        if page_args['retry_num'] >= policy['max_retries']:
+            error(page_args, "Giving up on page: {page_num} for {collection} after {retry_num} retries on {error_class} errors...")
+            return None
+        if not retry_budget.consume():
+            error(page_args, "Retry budget of {retry_budget} retries used up, giving up on page: {page_num} for {collection}...")
+            return None
+
+        page_args['delay'] = get_backoff_delay(policy, page_args['retry_num'], retry_after)
+        page_args['retry_num'] += 1
+        retries[page_args['error_class']] = page_args['retry_num']
+        info(page_args, "Retrying page: {page_num} for {collection} in {delay:.1f}s ({error_class} retry {retry_num} of {max_retries})...")
+        if STOP_EVENT.wait(page_args['delay']):
+            return None
+
+def request_page_again(args, session, rate_limiter, retry_budget, collection, page_num, after=None, page_count=None):
+    """
+    Request a page read as a stream again in full, once the stream broke off,
+    as a retry taken from the retry budget
+
+    Arguments
+    ---------
+    args: dict
+        Arguments provided by the user
+    session: requests.Session
+        Shared HTTP session to request the page with
+    rate_limiter: RateLimiter
+        Rate limiter shared by all the exports
+    retry_budget: RetryBudget
+        Retry budget shared by all the exports
+    collection: str
+        Collection to request eg 'assets', 'exposures'
+    page_num: int
+        Page number to request
+    after: str
+        endCursor of the previous page, when paginating by cursor
+    page_count: int
+        Number of items requested on the page
+
+    Returns
+    -------
+    dict
+        JSON response for the page, or None if the page could not be obtained
+    """
+    if not retry_budget.consume():
+        page_args = dict(args)
+        page_args.update({'collection': collection, 'page_num': page_num})
+        error(page_args, "Retry budget of {retry_budget} retries used up, giving up on page: {page_num} for {collection}...")
+        return None
+    return request_page(args, session, rate_limiter, retry_budget, collection, page_num,
+                        after=after, page_count=page_count)
+
+def has_next_page(resp_json, collection):
+    """
+    Check whether another page exists after the page response
+
+    Arguments
+    ---------
+    resp_json: dict
+        JSON response for a page
+    collection: str
+        Collection the page belongs to eg 'assets', 'exposures'
+
+    Returns
+    -------
+    bool
+        True, if the page indicates that a next page exists
+    """
+    return bool(resp_json['data'][collection]['pageInfo']['hasNextPage'])
+
+def fetch_pages(args, session, rate_limiter, retry_budget, collection, page_size_controller,
+                first_page_num=1, offset=0, after=None):
+    """
+    Generator which requests the pages for a collection one after another and
+    yields the page number and JSON response of each page obtained
+    successfully. Only a single page is held in memory at any time. When
+    paginating by cursor, each page is requested after the endCursor of the
+    previous page.
+
+    The number of items on each page is decided by the page size controller.
+    When paginating by page number and the offset of the next item to request
+    does not fall on a page boundary for the page size (eg after the page size
+    changed), the page containing the offset is requested and the items before
+    the offset, which were already exported, are dropped from it.
+
+    When the pages are read as a stream, a StreamedPage is yielded in place of
+    the JSON response, and the page info is only read from it once its edges
+    have been iterated.
+
+    Arguments
+    ---------
+    args: dict
+        Arguments provided by the user
+    session: requests.Session
+        Shared HTTP session to request the pages with
+    rate_limiter: RateLimiter
+        Rate limiter shared by all the exports
+    retry_budget: RetryBudget
+        Retry budget shared by all the exports
+    collection: str
+        Collection to request eg 'assets', 'exposures'
+    page_size_controller: PageSizeController
+        Controller which decides the number of items to request per page
+    first_page_num: int
+        Number of the first page yielded, counting the pages already exported
+    offset: int
+        Number of items already exported, to start requesting from
+    after: str
+        endCursor of the page before the first page, when paginating by cursor
+    """
+    page_args = dict(args)
+    page_args['collection'] = collection
+    page_args['page_num'] = first_page_num
+    page_args['offset'] = offset
+
+    info(page_args, "Requesting {collection} for instance: {instance} page-wise by {pagination} from offset: {offset}...")
+    while not STOP_EVENT.is_set():
+
+        page_count = page_size_controller.get_page_size()
+        start_time = time.monotonic()
+        resp_json = request_page(args, session, rate_limiter, retry_budget, collection,
+                                 offset // page_count + 1, after=after, page_count=page_count,
+                                 stream=args['stream_pages'])
+        if resp_json is None:
+            if page_size_controller.record_failure(page_count):
+                page_args['page_count'] = page_size_controller.get_page_size()
+                info(page_args, "Retrying page: {page_num} for {collection} with page count: {page_count}...")
+                continue
+            return
+        streamed_page = resp_json if isinstance(resp_json, StreamedPage) else None
+
+        page_args['items_to_skip'] = offset % page_count
+        if args['pagination'] == 'page' and page_args['items_to_skip'] > 0:
+            info(page_args, "Dropping the first {items_to_skip} {collection} on page: {page_num}, already exported...")
+            if streamed_page is not None:
+                streamed_page.items_to_skip = page_args['items_to_skip']
+            else:
+                del resp_json['data'][collection]['edges'][:page_args['items_to_skip']]
+
+        if streamed_page is None:
+            page_size_controller.record_success(page_count, time.monotonic() - start_time)
+        yield page_args['page_num'], resp_json
+
+        # A page read as a stream is only complete once its edges are written
+        if streamed_page is not None:
+            page_size_controller.record_success(page_count, streamed_page.end_time - start_time)
+            resp_json = streamed_page.resp_json
+            num_edges = streamed_page.num_edges
+        else:
+            num_edges = len(resp_json['data'][collection]['edges'])
+
+        info(page_args, "Checking if another page exists from page: {page_num} response...")
+        if not has_next_page(resp_json, collection):
+            return
+
+        after = resp_json['data'][collection]['pageInfo'].get('endCursor')
+        offset += num_edges
+        page_args['page_num'] += 1
+        if args['limit_pages_returned'] > 0:
+            if int(page_args['page_num']) > args['limit_pages_returned']:
+                info(page_args, "Stopping extraction of more pages as limit of number of pages to get hit...")
+                return
+
+def fetch_pages_concurrently(args, session, rate_limiter, retry_budget, collection, first_page_num=1):
+    """
+    Generator which requests the pages for a collection in parallel from a
+    bounded pool of workers, and yields the page number and JSON response of
+    each page in page order. At most 'concurrency' pages are in flight (or waiting to be yielded)
+    at any time. Since pagination is offset-based, pages do not depend on each
+    other and can be requested ahead of the page being yielded.
+
+    Arguments
+    ---------
+    args: dict
+        Arguments provided by the user including the concurrency
+    session: requests.Session
+        Shared HTTP session to request the pages with
+    rate_limiter: RateLimiter
+        Rate limiter shared by all the exports
+    retry_budget: RetryBudget
+        Retry budget shared by all the exports
+    collection: str
+        Collection to request eg 'assets', 'exposures'
+    first_page_num: int
+        Page number to start requesting from
     """
-    Sleep and let the user know that we are sleeping before making requests
+    page_args = dict(args)
+    page_args['collection'] = collection
+    page_args['page_num'] = first_page_num
+    concurrency = int(args['concurrency'])
+
+    info(page_args, "Requesting {collection} for instance: {instance} page-wise from page: {page_num} with {concurrency} workers...")
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pages_in_flight = {}
+    next_page_to_request = first_page_num
+
+    # First page known not to have a next page - no pages are requested beyond
+    # this one
+    last_page_num = None
+    try:
+        while not STOP_EVENT.is_set():
+
+            # Note the last page as soon as any completed page reports it
+            for page_num, future in pages_in_flight.items():
+                if future.done() and future.result() is not None:
+                    if not has_next_page(future.result(), collection):
+                        if last_page_num is None or page_num < last_page_num:
+                            last_page_num = page_num
+
+            while len(pages_in_flight) < concurrency:
+                if last_page_num is not None and next_page_to_request > last_page_num:
+                    break
+                if args['limit_pages_returned'] > 0 and \
+                   next_page_to_request > args['limit_pages_returned']:
+                    break
+                pages_in_flight[next_page_to_request] = executor.submit(request_page, args, session, rate_limiter,
+                                                                        retry_budget, collection,
+                                                                        next_page_to_request)
+                next_page_to_request += 1
+
+            if page_args['page_num'] not in pages_in_flight:
+                if args['limit_pages_returned'] > 0 and \
+                   page_args['page_num'] > args['limit_pages_returned']:
+                    info(page_args, "Stopping extraction of more pages as limit of number of pages to get hit...")
+                return
+
+            resp_json = pages_in_flight.pop(page_args['page_num']).result()
+            if resp_json is None:
+                return
+
+            yield page_args['page_num'], resp_json
+
+            info(page_args, "Checking if another page exists from page: {page_num} response...")
+            if not has_next_page(resp_json, collection):
+                return
+            page_args['page_num'] += 1
+
+    finally:
+        for future in pages_in_flight.values():
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def iter_page_edges(args, collection, pages):
+    """
+    Generator which yields the page number, the edges and the page info from
+    each page response. For a page read as a stream, the edges are parsed as
+    they are iterated and the page info is only filled in once they have all
+    been iterated.
 
     Arguments
     ---------
     args: dict
-        Arguments provided by the user including sleep time
+        Arguments provided by the user
+    collection: str
+        Collection the pages belong to eg 'assets', 'exposures'
+    pages: iterable
+        Page numbers and JSON responses (or StreamedPage) for each page, as
+        yielded by fetch_pages()
+    """
+    for page_num, resp_json in pages:
+        if isinstance(resp_json, StreamedPage):
+            yield page_num, resp_json.iter_edges(), resp_json.page_info
+            continue
+        yield (page_num,
+               resp_json['data'][collection]['edges'],
+               resp_json['data'][collection]['pageInfo'])
+
+def export_collection(args, session, rate_limiter, retry_budget, collection, outfile):
     """
-    if 'sleep_time' in args:
-        sleep_time = int(args['sleep_time'])
-        info(args, "Sleeping for {sleep_time}s...".format(**args))
-        time.sleep(sleep_time)
+    Export all the records in a collection to the outfile, page by page. The
+    records are never accumulated in memory, so memory usage only depends on
+    the page size.
+
+    A checkpoint with the last page written, its cursor and the byte offset of
+    the outfile is saved next to the outfile each time the outfile is fsync-ed.
+    When resuming, the outfile is truncated to that offset and the export
+    continues from the next page, so no records are duplicated.
+
+    Arguments
+    ---------
+    args: dict
+        Arguments provided by the user
+    session: requests.Session
+        Shared HTTP session to request the pages with
+    rate_limiter: RateLimiter
+        Rate limiter shared by all the exports
+    retry_budget: RetryBudget
+        Retry budget shared by all the exports
+    collection: str
+        Collection to export eg 'assets', 'exposures'
+    outfile: str
+        Output file to write the records to
+    """
+    export_args = dict(args)
+    export_args['collection'] = collection
+    export_args['outfile'] = outfile
+    export_args['records_count'] = 0
+    export_args['checkpoint_path'] = get_checkpoint_path(outfile)
+
+    checkpoint = {
+        'collection': collection,
+        'output_format': args['output_format'],
+        'pagination': args['pagination'],
+        'last_page_num': 0,
+        'end_cursor': None,
+        'records_written': 0,
+        'byte_offset': None,
+        'completed': False
+    }
+
+    resume_offset = None
+    if args['resume']:
+        info(export_args, "Checking for checkpoint: {checkpoint_path} to resume {collection} export from...")
+        saved_checkpoint = load_checkpoint(export_args['checkpoint_path'])
+        if saved_checkpoint is None:
+            info(export_args, "No checkpoint found, starting {collection} export from the first page...")
+        elif saved_checkpoint['output_format'] != checkpoint['output_format'] or \
+             saved_checkpoint.get('pagination', 'page') != checkpoint['pagination']:
+            error(export_args, ("Checkpoint: {checkpoint_path} was written with a different output format "
+                                "or pagination, skipping {collection} export..."))
+            return
+        elif saved_checkpoint['completed']:
+            info(export_args, "Export of {collection} to outfile: {outfile} already completed, skipping...")
+            return
+        else:
+            checkpoint = saved_checkpoint
+            resume_offset = checkpoint['byte_offset']
+            export_args['records_count'] = checkpoint['records_written']
+            export_args['last_page_num'] = checkpoint['last_page_num']
+            info(export_args, "Resuming {collection} export after page: {last_page_num} with {records_count} records written...")
+
+    writer = StreamingJSONWriter(outfile,
+                                 output_format=args['output_format'],
+                                 fsync_every=args['fsync_every'],
+                                 resume_offset=resume_offset,
+                                 records_written=checkpoint['records_written'])
+    if resume_offset is None:
+        checkpoint['byte_offset'] = writer.committed_offset
+        save_checkpoint(export_args['checkpoint_path'], checkpoint)
+
+    # Pages are requested in parallel only with a fixed page size, and when
+    # the pages already written line up with the page numbers
+    page_count = int(args['page_count'])
+    fetch_concurrently = (int(args['concurrency']) > 1 and args['pagination'] == 'page' and
+                          checkpoint['records_written'] == checkpoint['last_page_num'] * page_count)
+
+    page_size_query_type = "{}/{}".format(args['instance'], collection)
+    learned_page_size = None
+    if args['adaptive_page_size'] and not fetch_concurrently:
+        learned_page_size = load_learned_page_size(args['page_size_state_file'], page_size_query_type)
+    page_size_controller = PageSizeController(learned_page_size or page_count,
+                                              min_page_size=int(args['min_page_count']),
+                                              max_page_size=int(args['max_page_count']),
+                                              target_latency=float(args['target_page_latency']),
+                                              adaptive=args['adaptive_page_size'] and not fetch_concurrently)
+    export_args['page_count'] = page_size_controller.get_page_size()
+    info(export_args, "Starting {collection} export with page count: {page_count}...")
+
+    # Pages written to the outfile, which are not yet in the checkpoint
+    last_page_num = checkpoint['last_page_num']
+    end_cursor = checkpoint['end_cursor']
+    last_page_has_next_page = True
+    try:
+        first_page_num = checkpoint['last_page_num'] + 1
+        if fetch_concurrently:
+            pages = fetch_pages_concurrently(args, session, rate_limiter, retry_budget, collection,
+                                             first_page_num)
+        else:
+            pages = fetch_pages(args, session, rate_limiter, retry_budget, collection, page_size_controller,
+                                first_page_num=first_page_num,
+                                offset=checkpoint['records_written'],
+                                after=checkpoint['end_cursor'])
+        for page_num, edges, page_info in iter_page_edges(args, collection, pages):
+            records_written = writer.records_written
+            try:
+                synced = writer.write_records(edges)
+            except PageNotObtainedError:
+                break
+            export_args['records_count'] += writer.records_written - records_written
+            info(export_args, "Number of {collection} written to outfile: {outfile} is: {records_count}")
+
+            last_page_num = page_num
+            end_cursor = page_info.get('endCursor')
+            last_page_has_next_page = page_info['hasNextPage']
+            if synced:
+                checkpoint['last_page_num'] = last_page_num
+                checkpoint['end_cursor'] = end_cursor
+                checkpoint['records_written'] = writer.records_written
+                checkpoint['byte_offset'] = writer.committed_offset
+                save_checkpoint(export_args['checkpoint_path'], checkpoint)
+
+        # A page which could not be obtained ends the loop before the last page
+        limit_hit = (args['limit_pages_returned'] > 0 and
+                     last_page_num >= args['limit_pages_returned'])
+        if STOP_EVENT.is_set():
+            error(export_args, "Interrupted, closing {collection} outfile: {outfile} with the pages obtained so far...")
+        elif last_page_has_next_page and not limit_hit:
+            export_args['last_page_num'] = last_page_num
+            error(export_args, ("Export of {collection} stopped after page: {last_page_num} as the next page could "
+                                "not be obtained, re-run with -r to resume it from checkpoint: {checkpoint_path}"))
+        else:
+            info(export_args, "Completed export of {records_count} {collection} to outfile: {outfile}")
+    finally:
+        writer.close()
+
+        # All pages written have now been fsync-ed, so commit them
+        checkpoint['last_page_num'] = last_page_num
+        checkpoint['end_cursor'] = end_cursor
+        checkpoint['records_written'] = writer.records_written
+        checkpoint['byte_offset'] = writer.committed_offset
+        limit_hit = (args['limit_pages_returned'] > 0 and
+                     last_page_num >= args['limit_pages_returned'])
+        checkpoint['completed'] = not STOP_EVENT.is_set() and \
+                                  (not last_page_has_next_page or limit_hit)
+        save_checkpoint(export_args['checkpoint_path'], checkpoint)
+        if not checkpoint['completed']:
+            INCOMPLETE_EXPORTS.append(collection)
+
+        if page_size_controller.adaptive and page_size_controller.learned_page_size:
+            export_args['page_count'] = page_size_controller.learned_page_size
+            info(export_args, "Saving learned page count: {page_count} for {collection}...")
+            save_learned_page_size(args['page_size_state_file'], page_size_query_type,
+                                   page_size_controller.learned_page_size)
 
 def main():
     parser = argparse.ArgumentParser(description="Script to pull down all assets and exposures in JSON and CSV format from Assetnote")
@@ -324,18 +1969,74 @@ def main():
     parser.add_argument("-oe", "--outfile-exposures", default="out-assetnote-exposures.json",
                         help="Output file containing exposures listing as a JSON output")
     parser.add_argument("-pc", "--page-count", default="30",
-                        help=("Number of items to provide per page count. Note that there is an "
-                             "upper limit of number of assets that can be extracted at once... tested upper limit was 30."))
+                        help=("Number of items to provide per page count. With --adaptive-page-size, this is the "
+                              "page count to start from when no page count has been learned for the instance yet."))
+    parser.add_argument("-aps", "--adaptive-page-size", action="store_true",
+                        help=("Grow the page count while pages are returned quickly and without errors, and shrink "
+                              "it on timeouts or errors. The learned page count is kept per instance and collection "
+                              "in the page size state file. Not used with --concurrency."))
+    parser.add_argument("-mnpc", "--min-page-count", default="5",
+                        help="Smallest page count to shrink to with --adaptive-page-size")
+    parser.add_argument("-mxpc", "--max-page-count", default="500",
+                        help="Largest page count to grow to with --adaptive-page-size")
+    parser.add_argument("-tl", "--target-page-latency", default="10",
+                        help="Page count is only grown while pages are returned within this many seconds")
+    parser.add_argument("-pss", "--page-size-state-file",
+                        default=os.path.join(os.path.expanduser("~"), ".assetnote_page_sizes.json"),
+                        help="File to keep the page counts learned with --adaptive-page-size in")
     parser.add_argument("-lp", "--limit-pages-returned", default=0,
                         help="Limit the number of pages returned. If set to 0 or less, no limit.")
     parser.add_argument("-sa", "--skip-assets", action="store_true",
                         help="Skip assets export")
     parser.add_argument("-se", "--skip-exposures", action="store_true",
                         help="Skip exposures export")
-    parser.add_argument("-st", "--sleep-time", action="store", default="2",
-                        help="Sleep timeout between individual requests")
+    parser.add_argument("-of", "--output-format", choices=["json", "ndjson"], default="json",
+                        help=("Format of the output files. 'json' writes a single JSON array, 'ndjson' "
+                              "writes one JSON record per line"))
+    parser.add_argument("-fe", "--fsync-every", default="10",
+                        help="Number of pages to write to the output files before flushing them to disk")
+    parser.add_argument("-ps", "--pool-size", default="4",
+                        help="Maximum number of keep-alive connections to keep open to the Assetnote instance")
+    parser.add_argument("-ct", "--connect-timeout", default="10",
+                        help="Timeout in seconds for connecting to the Assetnote instance")
+    parser.add_argument("-rt", "--read-timeout", default="120",
+                        help="Timeout in seconds for reading a page response from the Assetnote instance")
+    parser.add_argument("-c", "--concurrency", default="1",
+                        help=("Number of pages to request in parallel, subject to the shared rate limit. "
+                              "Records are still written in page order."))
+    parser.add_argument("-mr", "--max-requests-per-second", default="0",
+                        help=("Maximum number of requests per second made across the assets and exposures "
+                              "exports, which run in parallel. Requests are otherwise made as fast as the "
+                              "instance allows, slowing down on HTTP 429/5xx or Retry-After. If set to 0 or "
+                              "less, no limit."))
+    parser.add_argument("-mnr", "--min-requests-per-second", default="0.1",
+                        help="Rate in requests per second below which requests are never slowed down")
+    parser.add_argument("-rb", "--retry-budget", default="100",
+                        help=("Total number of times pages can be re-requested on errors across the assets and "
+                              "exposures exports. Each class of error (eg connection reset, HTTP 429, "
+                              "HTTP 502/503, GraphQL errors) is retried with its own number of retries and "
+                              "exponential backoff. If set to 0, pages are not retried."))
+    parser.add_argument("-pg", "--pagination", choices=["page", "cursor"], default="page",
+                        help=("Paginate by page number (offset-based), or by the endCursor of the previous "
+                              "page (cursor-based). Cursor-based pagination does not drift when assets "
+                              "change during the export, but pages can then only be requested one at a time."))
+    parser.add_argument("-sp", "--stream-pages", action="store_true",
+                        help=("Read each page response as a stream, writing each record to the outfile as soon as "
+                              "it is parsed instead of holding the whole page in memory. Not used with "
+                              "--concurrency."))
+    parser.add_argument("-pq", "--persisted-queries", action="store_true",
+                        help=("Send the SHA-256 hash of the query instead of the whole query once the instance "
+                              "has been sent the query, as per the automatic persisted queries protocol. If the "
+                              "instance does not know the hash, the query is sent again in full. Not used for "
+                              "pages read with --stream-pages."))
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help=("Resume the exports from the checkpoint files kept next to the outfiles "
+                              "eg out-assetnote-assets.json.checkpoint, instead of starting from the first page"))
     args = vars(parser.parse_args())
     
+    if args['pagination'] == 'cursor' and int(args['concurrency']) > 1:
+        info(args, "Pages are requested one at a time when paginating by cursor, ignoring concurrency...")
+
     info(args, "Validing the value of 'limit_pages_returned' argument...")
     try:
         args['limit_pages_returned'] = int(args['limit_pages_returned'])
@@ -343,129 +2044,54 @@ def main():
         error(args, "Invalid value for limit pages returned provided, defaulting to 0...")
         args['limit_pages_returned'] = 0
 
+    collections_to_export = []
     if not args['skip_assets']:
-
-        info(args, "Requesting assets for instance: {instance} page-wise...")
-        assets = []
-        get_next_page = True
-        args['page_num'] = 1
-        while get_next_page:
-            
-            info(args, "Requesting page: {page_num} for assets...")
-            graphql_query = ASSETS_GRAPHQL_QUERY_TEMPLATE.format(**args)
-            try:
-                resp = requests.post(
-                            "https://{instance}.assetnotecloud.com/api/v2/graphql".format(**args),
-                            headers={
-                                "X-ASSETNOTE-API-KEY": "{api_key}".format(**args)
-                            }, json=dict(query=graphql_query)
-                )
-                status_code = resp.status_code
-                resp_json = resp.json()
-    
-                info(args, "Checking if page: {page_num} obtained successfully...")
-                if status_code != 200 or 'data' not in resp_json:
-                    error(args, "Error encountered when retrieving page: {page_num}...")
-                    error(args, "Error: ")
-                    print(json.dumps(resp_json, indent=4))
-                    get_next_page = False
-    
-                else:
-    
-                    info(args, "Parsing page: {page_num} response for assets...")
-                    
-                    info(args, "Getting assets from the page...")
-                    assets_on_page = resp_json['data']['assets']['edges']
-                    for asset_on_page in assets_on_page:
-                        assets.append(asset_on_page)
-                        args['assets_count'] = len(assets)
-                    info(args, "Number of assets after page: {page_num} is: {assets_count}")
-    
-                    info(args, "Checking if another page exists from page: {page_num} response...")
-                    get_next_page = resp_json['data']['assets']['pageInfo']['hasNextPage']
-                    if get_next_page:
-                        args['page_num'] += 1
-                        if args['limit_pages_returned'] > 0:
-                            if int(args['page_num']) > args['limit_pages_returned']:
-                                info(args, "Stopping extraction of more pages as limit of number of pages to get hit...")
-                                get_next_page = False
-    
-    
-            except Exception as e:
-    
-                error(args, "Error encountered when requesting page: {page_num} for assets...")
-                error(args, str(e))
-                get_next_page = False
-    
-            info(args, "Writing assets to outfile: {outfile_assets}")
-            with open(args['outfile_assets'], "w+") as f:
-                f.write(json.dumps(assets, indent=4))
-            
-            sleep_time(args)
+        collections_to_export.append(('assets', args['outfile_assets']))
     else:
         info(args, "Skipping assets export as requested by user when invoking the script...")
 
     if not args['skip_exposures']:
+        collections_to_export.append(('exposures', args['outfile_exposures']))
+    else:
+        info(args, "Skipping exposures export as requested by user when invoking the script...")
 
-        info(args, "Requesting exposures for instance: {instance} page-wise...")
-        exposures = []
-        get_next_page = True
-        args['page_num'] = 1
-        while get_next_page:
-            
-            info(args, "Requesting page: {page_num} for exposures...")
-            graphql_query = EXPOSURES_GRAPHQL_QUERY_TEMPLATE.format(**args)
-            try:
-                resp = requests.post(
-                            "https://{instance}.assetnotecloud.com/api/v2/graphql".format(**args),
-                            headers={
-                                "X-ASSETNOTE-API-KEY": "{api_key}".format(**args)
-                            }, json=dict(query=graphql_query)
-                )
-                status_code = resp.status_code
-                resp_json = resp.json()
-                
-                info(args, "Checking if page: {page_num} obtained successfully...")
-                if status_code != 200 or "errors" in resp_json:
-                    error(args, "Error encountered when retrieving page: {page_num} for exposures...")
-                    error(args, "Error: ")
-                    print(json.dumps(resp_json, indent=4))
-                    get_next_page = False
-    
-                else:
-    
-                    info(args, "Parsing page: {page_num} respons for exposurese...")
-    
-                    info(args, "Getting exposures from the page...")
-                    assets_on_page = resp_json['data']['exposures']['edges']
-                    for asset_on_page in assets_on_page:
-                        exposures.append(asset_on_page)
-                        args['exposures_count'] = len(exposures)
-                    info(args, "Number of assets after page: {page_num} is: {exposures_count}")
-    
-                    info(args, "Checking if another page exists from page: {page_num} response...")
-                    get_next_page = resp_json['data']['exposures']['pageInfo']['hasNextPage']
-                    if get_next_page:
-                        args['page_num'] += 1
-                        if args['limit_pages_returned'] > 0:
-                            if int(args['page_num']) > args['limit_pages_returned']:
-                                info(args, "Stopping extraction of more pages as limit of number of pages to get hit...")
-                                get_next_page = False
-    
-            except Exception as e:
-    
-                error(args, "Error encountered when requesting page: {page_num} for exposures...")
-                error(args, str(e))
-                get_next_page = False
-    
-            info(args, "Writing exposures to outfile: {outfile_exposures}")
-            with open(args['outfile_exposures'], "w+") as f:
-                f.write(json.dumps(exposures, indent=4))
-            
-            sleep_time(args)
+    info(args, "Creating a pooled HTTP session for instance: {instance}...")
+    session = create_session(args)
+    rate_limiter = RateLimiter(args['max_requests_per_second'],
+                               args['min_requests_per_second'])
+    retry_budget = RetryBudget(args['retry_budget'])
 
-    else:
-        info(args, "Skipping assets as requested by user when invoking the script...")
+    # Run the export of each collection in its own thread, so that the total
+    # time taken is close to the longest export rather than the sum of exports
+    export_threads = []
+    for collection, outfile in collections_to_export:
+        export_thread = threading.Thread(target=export_collection,
+                                         args=(args, session, rate_limiter, retry_budget, collection, outfile),
+                                         name=collection)
+        export_thread.start()
+        export_threads.append(export_thread)
+
+    # Poll the threads rather than join() them, as interrupting join() may
+    # leave the thread marked as stopped before it has closed its outfile
+    try:
+        while any(export_thread.is_alive() for export_thread in export_threads):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        error(args, "Interrupted, stopping the exports and closing the outfiles...")
+        STOP_EVENT.set()
+        for export_thread in export_threads:
+            export_thread.join()
+        sys.exit(1)
+    finally:
+        session.close()
+
+    args['retries_used'] = retry_budget.retries_used
+    info(args, "Pages re-requested {retries_used} times out of the retry budget of {retry_budget}...")
+
+    if INCOMPLETE_EXPORTS:
+        args['incomplete_exports'] = ", ".join(INCOMPLETE_EXPORTS)
+        error(args, "Export of {incomplete_exports} did not complete, re-run with -r to resume...")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+# encoding = utf-8
+
+from concurrent.futures import ThreadPoolExecutor
+
+from assetnote_assetgroups_download import collect_assetgroups
+from assetnote_assets_download import collect_assets
+from assetnote_common import SerializedEventWriter
+from assetnote_common import StanzaHelper
+from assetnote_common import check_circuit_breaker
+from assetnote_common import create_circuit_breaker
+from assetnote_common import create_rate_limiter
+from assetnote_common import get_transport_options
+from assetnote_common import log
+from assetnote_common import reset_log_state
+from assetnote_exposures_download import collect_exposures
+
+"""Collections made together for each input stanza, with the function to collect each, the sourcetype to write
+its events with and the source, set to the name of its own input so that the checkpoints of that input are used"""
+COLLECTIONS = (('assets', collect_assets, 'assetnote:assets:json2', 'assetnote_python_assets_script'),
+               ('exposures', collect_exposures, 'assetnote:exposures:json2', 'assetnote_python_exposures_script'),
+               ('assetgroups', collect_assetgroups, 'assetnote:assetgroups:json2', 'assetnote_python_assetgroups_download'))
+
+def info(helper, all_params, msg, format_params=True, sample=None):
+    
+    """"
+    Write an info log message, if info messages are enabled
+    
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters to substitute in the message to print
+    msg: str
+        Info message to print to the internal log, or a function returning it
+    format_params: bool
+        Format the parameters out in the original message
+    sample: str
+        Kind of the message, to sample messages logged per record
+    """
+    log(helper, 'INFO', all_params, msg, format_params, sample)
+
+def collect_stanza(helper, ew, input_stanza_name):
+
+    """"
+    Collect the assets, exposures and asset groups for the instance of an input
+    stanza at the same time, sharing a single rate limiter and circuit breaker
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk, in single instance mode
+    ew: EventWriter
+        Event writer to write the events with, safe to call from many threads
+    input_stanza_name: str
+        Name of the input stanza to collect for
+    """
+    stanza_helper = StanzaHelper(helper, input_stanza_name)
+    all_params = {'input_stanza_name': input_stanza_name,
+                  'assetnote_instance': stanza_helper.get_arg('assetnote_instance'),
+                  'assetnote_api_key': stanza_helper.get_arg('assetnote_api_key'),
+                  'num_collections': len(COLLECTIONS)}
+    all_params.update(get_transport_options(stanza_helper))
+
+    # All the requests to the instance are made within the same rate and
+    # through the same pool of connections, and the instance is checked once
+    # for all the collections
+    rate_limiter = create_rate_limiter(stanza_helper)
+    circuit_breaker = create_circuit_breaker(stanza_helper, all_params)
+    if not check_circuit_breaker(stanza_helper, all_params, rate_limiter, circuit_breaker):
+        return
+
+    info(helper, all_params,
+         "Starting {num_collections} collections for instance: {assetnote_instance} for input: {input_stanza_name}...")
+    with ThreadPoolExecutor(max_workers=len(COLLECTIONS)) as executor:
+        futures = {}
+        for collection, collect, sourcetype, source in COLLECTIONS:
+            collection_helper = StanzaHelper(helper, input_stanza_name,
+                                             sourcetype=sourcetype, source=source)
+            futures[collection] = executor.submit(collect, collection_helper, ew,
+                                                  rate_limiter, circuit_breaker)
+
+        # A collection which fails does not stop the others
+        for collection, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                all_params['collection'] = collection
+                all_params['error'] = "{}, {}".format(e.__class__, e)
+                info(helper, all_params,
+                     "Collection of {collection} for input: {input_stanza_name} failed. Error: {error}")
+
+'''
+    IMPORTANT
+    Edit only the validate_input and collect_events functions.
+    Do not edit any other part in this file.
+    This file is generated only once when creating the modular input.
+'''
+# The assets, exposures and asset groups are collected in a single process for
+# all the input stanzas
+def use_single_instance_mode():
+    return True
+
+def validate_input(helper, definition):
+    """Implement your own validation logic to validate the input stanza configurations"""
+    pass
+
+def collect_events(helper, ew):
+
+    # The process is kept for many intervals, so the log level is read again
+    # and the log sampling starts over in each one
+    reset_log_state()
+
+    # Events are written by the collections from many threads, one at a time
+    serialized_ew = SerializedEventWriter(ew)
+    try:
+        for input_stanza_name in helper.get_input_stanza_names():
+            collect_stanza(helper, serialized_ew, input_stanza_name)
+    finally:
+        serialized_ew.close()
@@ -2,40 +2,73 @@
 
 import json
 import os
+import queue
 import sys
 import time
 import datetime
 
+from concurrent.futures import ThreadPoolExecutor
 
-"""Special prefix added to each log message"""
-LOG_PREFIX = "AssetNote"
+from assetnote_common import GraphQLQuery
+from assetnote_common import JSON_BACKEND
+from assetnote_common import MAX_CONSECUTIVE_FAILED_PAGES
+from assetnote_common import SerializedEventWriter
+from assetnote_common import check_circuit_breaker
+from assetnote_common import create_circuit_breaker
+from assetnote_common import create_dead_letter_queue
+from assetnote_common import create_page_size_controller
+from assetnote_common import create_events
+from assetnote_common import create_rate_limiter
+from assetnote_common import get_event_options
+from assetnote_common import get_page_size_options
+from assetnote_common import get_transport_options
+from assetnote_common import log
+from assetnote_common import request_page
+from assetnote_common import reset_log_state
+from assetnote_common import save_learned_page_size
+from assetnote_common import send_graphql_request
 
-"""Number of assets to load per page"""
+
+"""Number of assets to load per page, until a page count is learned for the instance"""
 ASSETS_PER_PAGE_COUNT = 25
 
-"""Graph Query template to pull the list of all asset groups"""
-ASSETGROUPS_GRAPHQL_QUERY_TEMPLATE = """
-query {{
-    assetGroups {{
-        edges {{
-            node {{
+"""Graph Query to pull the list of all asset groups, compiled once"""
+ASSETGROUPS_GRAPHQL_QUERY = GraphQLQuery("""
+query AssetGroups {
+    assetGroups {
+        edges {
+            node {
                 id,
                 name
-            }},
-        }}
-    }}
-}}
-"""
+            },
+        }
+    }
+}
+""")
 
-"""Graph Query template to pull the list of all IPs within an asset group"""
-IPS_PER_ASSETGROUP_GRAPHQL_QUERY_TEMPLATE = """
-{{
-  assetGroups(f: {{field: "id", op: EQ, value: "{ag_id}"}}) {{
+"""Default number of asset groups to request the IPs and domains for in a single request"""
+ASSETGROUPS_PER_BATCH_COUNT = 20
+
+"""Default number of workers requesting batches of asset groups at the same time"""
+ASSETGROUPS_WORKERS_COUNT = 4
+
+"""Graph Query template for an asset group, selecting a page of each of its IPs
+and domains still to be obtained. Each asset group in a batch is requested
+under its own alias within a single query."""
+ASSETGROUP_GRAPHQL_QUERY_TEMPLATE = """
+  {alias}: assetGroups(f: {{field: "id", op: EQ, value: "{ag_id}"}}) {{
     edges {{
       node {{
         id
-        name
-        ipRanges(count: {page_count}, page: {page_num}) {{
+        name{value_fields}
+      }}
+    }}
+  }}
+"""
+
+"""Graph Query template for a page of IPs within an asset group"""
+IPS_PER_ASSETGROUP_GRAPHQL_QUERY_TEMPLATE = """
+        ipRanges(count: {page_count}, page: {request_page_num}) {{
           pageInfo {{
             hasNextPage
           }}
@@ -45,22 +78,11 @@ IPS_PER_ASSETGROUP_GRAPHQL_QUERY_TEMPLATE = """
               cidr
             }}
           }}
-        }}
-      }}
-    }}
-  }}
-}}
-"""
+        }}"""
 
-"""Graphql query to pull the list of all domains for the asset group"""
+"""Graphql query template for a page of domains within an asset group"""
 DOMAINS_PER_ASSETGROUP_GRAPHQL_QUERY_TEMPLATE = """
-{{
-  assetGroups(f: {{field: "id", op: EQ, value: "{ag_id}"}}) {{
-    edges {{
-      node {{
-        id
-        name
-        domains(count: {page_count}, page: {page_num}) {{
+        domains(count: {page_count}, page: {request_page_num}) {{
           pageInfo {{
             hasNextPage
           }}
@@ -70,17 +92,18 @@ DOMAINS_PER_ASSETGROUP_GRAPHQL_QUERY_TEMPLATE = """
               name
             }}
           }}
-        }}
-      }}
-    }}
-  }}
-}}
-"""
+        }}"""
 
-def debug(helper, all_params, msg, format_params=True):
+"""Query template, event field per page, event field per record and node field holding the values for each query per asset group"""
+ASSETGROUP_QUERIES = {
+    'ipRanges': (IPS_PER_ASSETGROUP_GRAPHQL_QUERY_TEMPLATE, 'ip_ranges', 'ip_range', 'cidr'),
+    'domains': (DOMAINS_PER_ASSETGROUP_GRAPHQL_QUERY_TEMPLATE, 'domains', 'domain', 'name')
+}
+
+def debug(helper, all_params, msg, format_params=True, sample=None):
     
     """"
-    Write an debug log message
+    Write a debug log message, if debug messages are enabled
     
     Arguments
     ---------
@@ -89,20 +112,18 @@ def debug(helper, all_params, msg, format_params=True):
     all_params: dict
         Parameters to substitute in the message to print
     msg: str
-        Debug message to print to the internal log
+        Debug message to print to the internal log, or a function returning it
     format_params: bool
         Format the parameters out in the original message
+    sample: str
+        Kind of the message, to sample messages logged per record
     """
-    msg_to_log = LOG_PREFIX + ":DEBUG: " + msg
-    if format_params:
-        helper.log_debug(msg_to_log.format(**all_params))
-    else:
-        helper.log_debug(msg_to_log)
+    log(helper, 'DEBUG', all_params, msg, format_params, sample)
         
-def info(helper, all_params, msg, format_params=True):
+def info(helper, all_params, msg, format_params=True, sample=None):
     
     """"
-    Write an info log message
+    Write an info log message, if info messages are enabled
     
     Arguments
     ---------
@@ -111,28 +132,487 @@ def info(helper, all_params, msg, format_params=True):
     all_params: dict
         Parameters to substitute in the message to print
     msg: str
-        Info message to print to the internal log
+        Info message to print to the internal log, or a function returning it
     format_params: bool
         Format the parameters out in the original message
+    sample: str
+        Kind of the message, to sample messages logged per record
     """
-    msg_to_log = LOG_PREFIX + ":INFO: " + msg
-    if format_params:
-        helper.log_info(msg_to_log.format(**all_params))
-    else:
-        helper.log_info(msg_to_log)
+    log(helper, 'INFO', all_params, msg, format_params, sample)
+
+def build_assetgroups_batch_query(batch):
+    
+    """"
+    Build a single GraphQL query requesting the next page of IPs and domains
+    for each asset group in a batch, with each asset group under its own alias
+    
+    Arguments
+    ---------
+    batch: list
+        Paging state of each asset group in the batch, including the alias,
+        the asset group ID and the page count and page number to request for
+        each of its IPs and domains still to be obtained
+        
+    Returns
+    -------
+    str
+        GraphQL query for all the asset groups in the batch
+    """
+    asset_group_fields = []
+    for group_state in batch:
+        value_fields = ""
+        for query_type, values_state in group_state['values'].items():
+            if not values_state.get('done'):
+                value_fields += ASSETGROUP_QUERIES[query_type][0].format(**values_state)
+        asset_group_fields.append(ASSETGROUP_GRAPHQL_QUERY_TEMPLATE.format(value_fields=value_fields,
+                                                                           **group_state))
+    return "{\n" + "".join(asset_group_fields) + "}\n"
+
+def get_assetgroup_values(resp_json, alias, query_type):
+    
+    """"
+    Get the edges and page info of the IPs or domains returned for the asset
+    group requested under an alias
+    
+    Arguments
+    ---------
+    resp_json: dict
+        JSON response to the batch query
+    alias: str
+        Alias the asset group was requested under, eg 'g0'
+    query_type: str
+        Values requested for the asset group, 'ipRanges' or 'domains'
+        
+    Returns
+    -------
+    tuple
+        List of edges, and the page info (empty if the asset group was not
+        found)
+    """
+    asset_group_node = {}
+    asset_groups_edges = ((resp_json.get('data') or {}).get(alias) or {}).get('edges') or []
+    if asset_groups_edges:
+        asset_group_node = asset_groups_edges[0].get('node') or {}
+    values = asset_group_node.get(query_type) or {}
+    return values.get('edges') or [], values.get('pageInfo') or {}
+
+def get_failed_aliases(resp_json, aliases):
+    
+    """"
+    Get the aliases of the asset groups which could not be obtained in the
+    response to a batch query, as they are missing from its data or the
+    errors returned point at them. Errors which do not point at any field
+    fail all the asset groups in the batch.
+    
+    Arguments
+    ---------
+    resp_json: dict
+        JSON response to the batch query
+    aliases: list
+        Aliases the asset groups in the batch were requested under
+        
+    Returns
+    -------
+    set
+        Aliases of the asset groups which could not be obtained
+    """
+    data = resp_json.get('data') or {}
+    failed_aliases = set(alias for alias in aliases if not data.get(alias))
+    for err in resp_json.get('errors') or []:
+        path = err.get('path') if isinstance(err, dict) else None
+        if not path:
+            return set(aliases)
+        failed_aliases.add(path[0])
+    return failed_aliases & set(aliases)
+
+def replay_dead_letters(helper, ew, all_params, rate_limiter, circuit_breaker,
+                        dead_letter_queue):
+    
+    """"
+    Replay the pages of IPs and domains in asset groups which could not be
+    obtained in previous intervals, and write the IPs or domains on each page
+    obtained as an event
+    
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    ew: EventWriter
+        Event writer to write the events with
+    all_params: dict
+        Parameters including the instance, the API key and the index
+    rate_limiter: RateLimiter
+        Rate limiter for the requests made by the input
+    circuit_breaker: CircuitBreaker
+        Circuit breaker shared by all the inputs for the instance
+    dead_letter_queue: DeadLetterQueue
+        Pages which could not be obtained in previous intervals
+    """
+    for query_type, (query_template, event_field, record_field, node_field) in ASSETGROUP_QUERIES.items():
+        for entry_key, entry in dead_letter_queue.get_pages_to_replay(query_type):
+            if circuit_breaker.is_open():
+                info(helper, all_params,
+                     "Circuit breaker open for instance: {assetnote_instance}, not replaying any more pages...")
+                return
+            replay_params = dict(all_params)
+            replay_params.update(entry)
+            info(helper, replay_params,
+                 "Replaying page: {page_num} of {query_type} for asset group: {ag_id}, {ag_name} which failed at: {failed_at}...")
+            replay_params['request_page_num'] = replay_params['offset'] // replay_params['page_count'] + 1
+            replay_group = {'alias': 'g0',
+                            'ag_id': replay_params['ag_id'],
+                            'values': {query_type: replay_params}}
+            resp_json = request_page(helper, replay_params,
+                                     build_assetgroups_batch_query([replay_group]),
+                                     rate_limiter, circuit_breaker)
+            removed = dead_letter_queue.record_replay(entry_key, resp_json is not None)
+            if resp_json is None:
+                if removed:
+                    info(helper, replay_params,
+                         "Dropping page: {page_num} of {query_type} for asset group: {ag_id} from the dead-letter queue after {replays} replays...")
+                else:
+                    info(helper, replay_params,
+                         "Replay of page: {page_num} of {query_type} for asset group: {ag_id} failed, replaying again in the next interval...")
+                continue
+            
+            edges, _ = get_assetgroup_values(resp_json, 'g0', query_type)
+            del edges[:replay_params['offset'] % replay_params['page_count']]
+            
+            asset_group_fields = {}
+            asset_group_fields['ag_id'] = replay_params['ag_id']
+            asset_group_fields['ag_name'] = replay_params['ag_name']
+            asset_group_fields['page_num'] = replay_params['page_num']
+            values = [edge['node'][node_field] for edge in edges
+                      if node_field in edge.get('node', {})]
+            
+            replay_params['num_values'] = len(values)
+            info(helper, replay_params,
+                 "Writing {num_values} {query_type} replayed from page: {page_num} for asset group: {ag_id} as events...")
+            for new_event in create_events(helper, all_params, values, page_fields=asset_group_fields,
+                                           values_field=event_field, value_field=record_field):
+                ew.write_event(new_event)
+
+
+
+def collect_assetgroup_batches(helper, ew, all_params, pending_asset_groups,
+                               page_size_controllers, rate_limiter, circuit_breaker,
+                               dead_letter_queue):
+    
+    """"
+    Collect the IPs and domains of asset groups page-wise in a worker,
+    requesting the next page of both the IPs and domains for a batch of asset
+    groups in each request, and write the values on each page obtained as an
+    event per asset group. The IPs and domains of an asset group are each
+    paged through until they have no next page, and asset groups leave the
+    batch once both are exhausted, with the asset groups still waiting to be
+    requested taking their place.
+    
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    ew: SerializedEventWriter
+        Event writer shared by all the workers
+    all_params: dict
+        Parameters of the worker including the instance, the API key and the
+        index
+    pending_asset_groups: queue.Queue
+        Paging state of the asset groups waiting to be requested, shared by
+        all the workers
+    page_size_controllers: dict
+        Page size controller for the IPs and the domains, shared by all the
+        workers
+    rate_limiter: RateLimiter
+        Rate limiter for the requests made by the input
+    circuit_breaker: CircuitBreaker
+        Circuit breaker shared by all the inputs for the instance
+    dead_letter_queue: DeadLetterQueue
+        Pages which could not be obtained, to replay in the next interval
+    """
+    batch = []
+    while True:
+        
+        if circuit_breaker.is_open():
+            info(helper, all_params,
+                 "Circuit breaker open for instance: {assetnote_instance}, skipping remaining asset groups...")
+            break
+        
+        # Top up the batch with the asset groups still waiting to be requested
+        while len(batch) < all_params['assetgroups_batch_size']:
+            try:
+                batch.append(pending_asset_groups.get_nowait())
+            except queue.Empty:
+                break
+        if not batch:
+            break
+        all_params['num_asset_groups_in_batch'] = len(batch)
+        
+        # IPs and domains requested for each asset group in the batch
+        requested_values = []
+        for i, group_state in enumerate(batch):
+            group_state['alias'] = 'g{}'.format(i)
+            for values_state in group_state['values'].values():
+                if not values_state.get('done'):
+                    requested_values.append((group_state, values_state))
+        requested_query_types = set(values_state['query_type'] for _, values_state in requested_values)
+        
+        # Get ready to loop through multiple times per batch
+        all_params['try'] = 0
+        all_params['page_load_success'] = False
+        failed_aliases = set()
+        
+        while not all_params['page_load_success'] and \
+                  all_params['try'] < all_params['num_retries']:
+            
+            all_params['try'] += 1
+            if circuit_breaker.is_open():
+                info(helper, all_params,
+                     "Circuit breaker open for instance: {assetnote_instance}, not requesting any more pages...")
+                break
+            
+            debug(helper, all_params,
+                 "Try: {try}. Requesting IPs and domains for {num_asset_groups_in_batch} asset groups from AssetNote...")
+            for group_state, values_state in requested_values:
+                values_state['page_count'] = page_size_controllers[values_state['query_type']].get_page_size()
+                values_state['request_page_num'] = values_state['offset'] // values_state['page_count'] + 1
+            graphql_query = build_assetgroups_batch_query(batch)
+            transport_error = False
+            try:
+                resp = send_graphql_request(helper, all_params, graphql_query,
+                                            rate_limiter, circuit_breaker)
+                status_code = resp.status_code
+                
+                # Only the asset groups the errors point at (eg an asset group
+                # deleted during the run) are failed, unless all of them are,
+                # in which case the batch was not loaded successfully
+                if status_code == 200:
+                    resp_json = JSON_BACKEND.loads(resp.content)
+                    failed_aliases = get_failed_aliases(resp_json,
+                                                        [group_state['alias'] for group_state in batch])
+                    if len(failed_aliases) == len(batch):
+                        status_code = -1
+                        
+                        # No data at all is a failure of the request as a
+                        # whole (eg page count too large), not of an alias
+                        transport_error = not resp_json.get('data')
+                        info(helper, all_params,
+                             "GraphQL errors returned for IPs and domains of {num_asset_groups_in_batch} asset groups for try: {try}...")
+                    else:
+                        if failed_aliases:
+                            all_params['num_failed_asset_groups'] = len(failed_aliases)
+                            info(helper, all_params,
+                                 "GraphQL errors returned for {num_failed_asset_groups} of {num_asset_groups_in_batch} asset groups, adding only their pages to the dead-letter queue...")
+                        for query_type in requested_query_types:
+                            page_size_controllers[query_type].record_success(
+                                page_size_controllers[query_type].get_page_size(),
+                                resp.total_time)
+                else:
+                    transport_error = status_code == 504
+                    
+            except Exception as e:
+                
+                # Log the exception occurred to log file
+                status_code = -1
+                transport_error = True
+                err_class = str(e.__class__)
+                raw_err_msg = str(e)
+                err_msg  = "Error in send_graphql_request for requesting IPs and domains in try: {try}. "
+                err_msg += "Error: {}, {}".format(err_class, raw_err_msg)
+                info(helper, all_params, err_msg)
+                
+            # Batch was not loaded successfully, so wait for some time before
+            # re-requesting the batch
+            if status_code == 200:
+                all_params['page_load_success'] = True
+            else:
+                
+                # Pages are only shrunk when the request failed or timed out,
+                # rather than on errors returned for some of the asset groups
+                for query_type in (requested_query_types if transport_error else ()):
+                    if page_size_controllers[query_type].record_failure(page_size_controllers[query_type].get_page_size()):
+                        all_params['query_type'] = query_type
+                        all_params['next_page_count'] = page_size_controllers[query_type].get_page_size()
+                        info(helper, all_params,
+                             "Requesting same pages of {query_type} with page count: {next_page_count}...")
+                if not circuit_breaker.is_open():
+                    info(helper, all_params,
+                        "Sleeping {backoff_time}s before re-requesting IPs and domains for {num_asset_groups_in_batch} asset groups...")
+                    time.sleep(all_params['backoff_time'])
+        
+        for group_state, values_state in requested_values:
+            query_type = values_state['query_type']
+            query_template, event_field, record_field, node_field = ASSETGROUP_QUERIES[query_type]
+            group_params = dict(all_params)
+            group_params.update(group_state)
+            group_params.update(values_state)
+            
+            if all_params['page_load_success'] and group_state['alias'] not in failed_aliases:
+                values_state['consecutive_failed_pages'] = 0
+                edges, page_info = get_assetgroup_values(resp_json, group_state['alias'], query_type)
+                
+                # Drop the values before the offset, which were already
+                # obtained when the page count changed in between pages
+                del edges[:values_state['offset'] % values_state['page_count']]
+                values_state['offset'] += len(edges)
+                
+                asset_group_fields = {}
+                asset_group_fields['ag_id'] = group_state['ag_id']
+                asset_group_fields['ag_name'] = group_state['ag_name']
+                asset_group_fields['page_num'] = values_state['page_num']
+                values = [edge['node'][node_field] for edge in edges
+                          if node_field in edge.get('node', {})]
+                
+                group_params['num_values'] = len(values)
+                info(helper, group_params,
+                     "Writing {num_values} {query_type} found on page: {page_num} for asset group: {ag_id}, {ag_name} as {event_mode} events...",
+                     sample='assetgroup_values')
+                for new_event in create_events(helper, all_params, values, page_fields=asset_group_fields,
+                                               values_field=event_field, value_field=record_field):
+                    ew.write_event(new_event)
+                
+                has_next_page = page_info.get('hasNextPage', False)
+                if has_next_page == False or has_next_page == 'false' or has_next_page == 'False':
+                    debug(helper, group_params,
+                          "No more pages of {query_type} after page: {page_num} for asset group: {ag_id}, {ag_name}",
+                          sample='assetgroup_done')
+                    values_state['done'] = True
+            else:
+                group_params['dead_letter_key'] = dead_letter_queue.add(query_type, values_state,
+                                                                        ag_id=group_state['ag_id'],
+                                                                        ag_name=group_state['ag_name'])
+                info(helper, group_params,
+                     "Added page: {page_num} of {query_type} for asset group: {ag_id} to the dead-letter queue as: {dead_letter_key} to replay in the next interval...")
+                values_state['offset'] = (values_state['offset'] // values_state['page_count'] + 1) * values_state['page_count']
+                
+                # Stop paging through the asset group if the instance looks to
+                # be down, rather than skipping pages indefinitely
+                values_state['consecutive_failed_pages'] += 1
+                if values_state['consecutive_failed_pages'] >= MAX_CONSECUTIVE_FAILED_PAGES:
+                    group_params['consecutive_failed_pages'] = values_state['consecutive_failed_pages']
+                    info(helper, group_params,
+                         "Stopping after {consecutive_failed_pages} pages of {query_type} failed one after another for asset group: {ag_id}, {ag_name}...")
+                    values_state['done'] = True
+            
+            values_state['page_num'] += 1
+            if all_params['limit_num_pages_returned'] > 0 and \
+               values_state['page_num'] > all_params['limit_num_pages_returned']:
+                group_params['page_num'] = values_state['page_num']
+                info(helper, group_params,
+                     "Hit a limit of pages of {query_type} to return for asset group: {ag_id}, current page_num: {page_num}, limit_num_pages_returned: {limit_num_pages_returned}")
+                values_state['done'] = True
+        
+        batch = [group_state for group_state in batch
+                 if not all(values_state.get('done') for values_state in group_state['values'].values())]
+    
+
+def collect_assetgroup_values(helper, ew, all_params, asset_groups, rate_limiter,
+                              circuit_breaker, dead_letter_queue):
+    
+    """"
+    Collect the IPs and domains of all the asset groups, with a bounded pool of
+    workers each requesting batches of asset groups (see
+    collect_assetgroup_batches) under the rate limit shared by the input. The
+    events from all the workers are written by a single writer thread.
+    
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    ew: EventWriter
+        Event writer to write the events with
+    all_params: dict
+        Parameters including the instance, the API key and the index
+    asset_groups: list
+        IDs and names of the asset groups to collect the values for
+    rate_limiter: RateLimiter
+        Rate limiter for the requests made by the input
+    circuit_breaker: CircuitBreaker
+        Circuit breaker shared by all the inputs for the instance
+    dead_letter_queue: DeadLetterQueue
+        Pages which could not be obtained, to replay in the next interval
+    """
+    # Page count is learned separately for the IPs and the domains
+    page_size_controllers = {}
+    for query_type in ASSETGROUP_QUERIES:
+        page_size_controllers[query_type] = create_page_size_controller(helper, all_params,
+                                                                        query_type,
+                                                                        ASSETS_PER_PAGE_COUNT)
+    
+    # Paging state of the IPs and domains of each asset group which still has
+    # pages to request
+    pending_asset_groups = queue.Queue()
+    for asset_group in asset_groups:
+        group_state = {'ag_id': asset_group['id'],
+                       'ag_name': asset_group['name'],
+                       'values': {}}
+        for query_type in ASSETGROUP_QUERIES:
+            group_state['values'][query_type] = {'query_type': query_type,
+                                                 'page_num': 1,
+                                                 'offset': 0,
+                                                 'consecutive_failed_pages': 0}
+        pending_asset_groups.put(group_state)
+    
+    if not asset_groups:
+        return
+    all_params['num_asset_groups'] = len(asset_groups)
+    all_params['num_workers'] = min(all_params['num_workers'], len(asset_groups))
+    info(helper, all_params,
+         "Requesting IPs and domains for {num_asset_groups} asset groups with {num_workers} workers...")
+    event_writer = SerializedEventWriter(ew)
+    executor = ThreadPoolExecutor(max_workers=all_params['num_workers'])
+    try:
+        workers = []
+        for worker_num in range(all_params['num_workers']):
+            worker_params = dict(all_params)
+            worker_params['worker_num'] = worker_num
+            workers.append(executor.submit(collect_assetgroup_batches, helper, event_writer,
+                                           worker_params, pending_asset_groups,
+                                           page_size_controllers, rate_limiter,
+                                           circuit_breaker, dead_letter_queue))
+        for worker in workers:
+            worker.result()
+    finally:
+        executor.shutdown(wait=True)
+        event_writer.close()
+    
+    for query_type, page_size_controller in page_size_controllers.items():
+        all_params['query_type'] = query_type
+        info(helper, all_params,
+             "Saving the learned page count for {query_type} in asset groups...")
+        save_learned_page_size(helper, all_params, query_type, page_size_controller)
 
 def validate_input(helper, definition):
     """Implement your own validation logic to validate the input stanza configurations"""
     pass
 
 def collect_events(helper, ew):
+    reset_log_state()
+    collect_assetgroups(helper, ew)
+
+def collect_assetgroups(helper, ew, rate_limiter=None, circuit_breaker=None):
+    
+    """"
+    Collect the asset groups for the instance, and write them as events
+    
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    ew: EventWriter
+        Event writer to write the events with
+    rate_limiter: RateLimiter
+        Rate limiter shared with the other collections for the instance, or
+        None to create one for the input
+    circuit_breaker: CircuitBreaker
+        Circuit breaker shared with the other collections for the instance, or
+        None to create one for the input
+    """
     
     # ------------------------------------------------------------------------
     # Collect user input
     # ------------------------------------------------------------------------
     opt_assetnote_api_key = helper.get_arg('assetnote_api_key')
     opt_assetnote_instance = helper.get_arg('assetnote_instance')
-    opt_sleep_time_per_page = int(helper.get_arg('sleep_time_per_page'))
     opt_num_retries_per_page = int(helper.get_arg('num_retries_per_page'))
     opt_backoff_time_per_page_retry = int(helper.get_arg('backoff_time_per_page_retry'))
     opt_limit_num_pages_returned = int(helper.get_arg('limit_num_pages_returned'))
@@ -142,18 +622,39 @@ def collect_events(helper, ew):
                   'assetnote_source': helper.get_input_type(),
                   'assetnote_api_key': opt_assetnote_api_key,
                   'assetnote_instance': opt_assetnote_instance,
-                  'sleep_time': opt_sleep_time_per_page,
                   'backoff_time': opt_backoff_time_per_page_retry,
                   'num_retries': opt_num_retries_per_page,
                   'page_count': ASSETS_PER_PAGE_COUNT,
-                  'limit_num_pages_returned': opt_limit_num_pages_returned}
+                  'limit_num_pages_returned': opt_limit_num_pages_returned,
+                  'assetgroups_batch_size': int(helper.get_arg('assetgroups_batch_size') or ASSETGROUPS_PER_BATCH_COUNT),
+                  'num_workers': max(int(helper.get_arg('num_workers') or ASSETGROUPS_WORKERS_COUNT), 1)}
+    all_params.update(get_page_size_options(helper))
+    all_params.update(get_event_options(helper))
+    all_params.update(get_transport_options(helper))
+    
+    # Requests are made as fast as the instance allows, slowing down when it
+    # signals pressure
+    if rate_limiter is None:
+        rate_limiter = create_rate_limiter(helper)
+    
+    # Fail fast without requesting anything while the instance is down, as
+    # seen by any of the inputs
+    if circuit_breaker is None:
+        circuit_breaker = create_circuit_breaker(helper, all_params)
+    if not check_circuit_breaker(helper, all_params, rate_limiter, circuit_breaker):
+        return
+    
+    # Pages which could not be obtained in previous intervals are replayed
+    # first, and pages which cannot be obtained now are kept for the next one
+    dead_letter_queue = create_dead_letter_queue(helper, all_params)
+    replay_dead_letters(helper, ew, all_params, rate_limiter, circuit_breaker,
+                        dead_letter_queue)
     
     # Printing all the current parameters to internal log
     msg = ("assetnote_index: {assetnote_index}, "
            "assetnote_sourcetype: {assetnote_sourcetype}, "
            "assetnote_source: {assetnote_source}, "
            "assetnote_instance: {assetnote_instance}, "
-           "sleep_time: {sleep_time},"
            "backoff_time: {backoff_time},"
            "num_retries: {num_retries},"
            "page_count: {page_count},"
@@ -172,29 +673,23 @@ def collect_events(helper, ew):
     
     all_params['try'] = 0
     all_params['page_load_success'] = False
+    resp_json = ""
     
     while not all_params['page_load_success'] and \
               all_params['try'] < all_params['num_retries']:
         
         all_params['try'] += 1
+        if circuit_breaker.is_open():
+            info(helper, all_params,
+                 "Circuit breaker open for instance: {assetnote_instance}, not requesting any more pages...")
+            status_code = -1
+            break
         
         debug(helper, all_params, 
              "Try: {try}. Requesting asset groups from AssetNote...")
-        graphql_query = ASSETGROUPS_GRAPHQL_QUERY_TEMPLATE.format(**all_params)
-        url_to_call = "https://{assetnote_instance}.assetnotecloud.com/api/v2/graphql".format(**all_params)
-        method = "POST"
-        headers={
-            "X-ASSETNOTE-API-KEY": "{assetnote_api_key}".format(**all_params)
-        }
-        payload = dict(query=graphql_query)
         try:
-            resp = helper.send_http_request(url=url_to_call,
-                                            method=method, 
-                                            payload=payload,
-                                            headers=headers,
-                                            verify=True,
-                                            use_proxy=True)
-        
+            resp = send_graphql_request(helper, all_params, ASSETGROUPS_GRAPHQL_QUERY,
+                                        rate_limiter, circuit_breaker)
             status_code = resp.status_code
             resp_text = resp.text
                 
@@ -204,7 +699,7 @@ def collect_events(helper, ew):
             status_code = -1
             err_class = str(e.__class__)
             raw_err_msg = str(e)
-            err_msg  = "Error in send_http_request for requesting asset groups in try: {try}. "
+            err_msg  = "Error in send_graphql_request for requesting asset groups in try: {try}. "
             err_msg += "Error: {}, {}".format(err_class, raw_err_msg)
             info(helper, all_params, err_msg)
             
@@ -214,9 +709,10 @@ def collect_events(helper, ew):
                 all_params['page_load_success'] = True
         else:
             all_params['page_load_success'] = False
-            debug(helper, all_params, 
-                "Sleeping {backoff_time}s before re-requesting asset groups...")
-            time.sleep(all_params['backoff_time'])
+            if not circuit_breaker.is_open():
+                debug(helper, all_params, 
+                    "Sleeping {backoff_time}s before re-requesting asset groups...")
+                time.sleep(all_params['backoff_time'])
 
 
     # ------------------------------------------------------------------------
@@ -227,7 +723,7 @@ def collect_events(helper, ew):
 
         debug(helper, all_params,
              "Parsing response to get the list of all asset groups JSON...")
-        resp_json = resp.json()
+        resp_json = JSON_BACKEND.loads(resp.content)
         
         debug(helper, all_params, 
             "Getting the list of asset groups  edges...")
@@ -249,7 +745,8 @@ def collect_events(helper, ew):
                     all_params['ag_id'] = asset_group_id
                     all_params['ag_name'] = asset_group_name
                     debug(helper, all_params, 
-                          "Added asset_group with id: {ag_id}, name: {ag_name}")
+                          "Added asset_group with id: {ag_id}, name: {ag_name}",
+                          sample='assetgroup_added')
                           
                     asset_groups.append({'id': asset_group_id, 
                                          'name': asset_group_name})
@@ -264,371 +761,14 @@ def collect_events(helper, ew):
     else:
         
         info(helper, all_params, "Error encountered when retrieving the list of all asset groups...")
-        info(helper, all_params, "Error: ")
-        info(helper, all_params,
-             str(resp_json), format_params=False)
-        get_next_page = False
-
-    # ------------------------------------------------------------------------
-    # Get the IPs for each asset group (paginated)
-    # ------------------------------------------------------------------------
-    for asset_group in asset_groups:
-        
-        asset_group_id = asset_group['id']
-        asset_group_name = asset_group['name']
-        all_params['ag_id'] = asset_group_id
-        all_params['ag_name'] = asset_group_name
-        
         debug(helper, all_params,
-              "Making POST req to get IPs for asset group: {ag_id}, {ag_name}")
-             
-        get_next_page = True
-        all_params['page_num'] = 1
-        
-        # Loop until we are told to stop looping to the next page
-        while get_next_page:
-            
-            # Define a dict to store info about the asset group IP ranges, and 
-            # metadata such as the page we get it from
-            asset_group_ip_ranges_per_page = {}
-            asset_group_ip_ranges_per_page['ag_id'] = all_params['ag_id']
-            asset_group_ip_ranges_per_page['ag_name'] = all_params['ag_name']
-            asset_group_ip_ranges_per_page['page_num'] = all_params['page_num']
-            asset_group_ip_ranges_per_page['ip_ranges'] = []
-            
-            # Get ready to loop through multiple times per page
-            all_params['try'] = 0
-            all_params['page_load_success'] = False
-            
-            while not all_params['page_load_success'] and \
-                      all_params['try'] < all_params['num_retries']:
-                
-                all_params['try'] += 1
-                
-                debug(helper, all_params, 
-                     "Try: {try}, Page: {page_num}. Requesting IPs for asset group: {ag_id}, {ag_name} from AssetNote...")
-                graphql_query = IPS_PER_ASSETGROUP_GRAPHQL_QUERY_TEMPLATE.format(**all_params)
-                url_to_call = "https://{assetnote_instance}.assetnotecloud.com/api/v2/graphql".format(**all_params)
-                method = "POST"
-                headers={
-                    "X-ASSETNOTE-API-KEY": "{assetnote_api_key}".format(**all_params)
-                }
-                payload = dict(query=graphql_query)
-                try:
-                    resp = helper.send_http_request(url=url_to_call,
-                                                    method=method, 
-                                                    payload=payload,
-                                                    headers=headers,
-                                                    verify=True,
-                                                    use_proxy=True)
-                
-                    status_code = resp.status_code
-                    resp_text = resp.text
-                        
-                except Exception as e:
-                    
-                    # Log the exception occurred to log file
-                    status_code = -1
-                    err_class = str(e.__class__)
-                    raw_err_msg = str(e)
-                    err_msg  = "Error in send_http_request for requesting IPs for page: {page_num} in try: {try}. "
-                    err_msg += "Error: {}, {}".format(err_class, raw_err_msg)
-                    info(helper, all_params, err_msg)
-                    
-                # Page was not loaded successfully, so wait for some time before
-                # re-requesting the page
-                if status_code == 200:
-                        all_params['page_load_success'] = True
-                else:
-                    all_params['page_load_success'] = False
-                    info(helper, all_params, 
-                        "Sleeping {backoff_time}s before re-requesting IPs in asset group: {ag_id}, {ag_name}...")
-                    time.sleep(all_params['backoff_time'])
-
-            debug(helper, all_params, 
-                  "Parsing the response to determine the IPs...")
-            if status_code == 200:
-                
-                resp_json = resp.json()
-                
-                debug(helper, all_params, 
-                      "Get all the IPs from page: {page_num} for asset group: {ag_id}, {ag_name}")
-
-                resp_json_ip_ranges_edges = None
-                resp_json_ip_ranges = None
-                if 'data' in resp_json:
-                    resp_json_data = resp_json['data']
-                    if 'assetGroups' in resp_json_data:
-                        resp_json_asset_groups = resp_json_data['assetGroups']
-                        if 'edges' in resp_json_asset_groups:
-                            resp_json_edges = resp_json_asset_groups['edges']
-                            if isinstance(resp_json_edges,
-                                          list):
-                                resp_json_edges = resp_json_edges[0]
-                            if 'node' in resp_json_edges:
-                                resp_json_node = resp_json_edges['node']
-                                if 'ipRanges' in resp_json_node:
-                                    resp_json_ip_ranges = resp_json_node['ipRanges']
-                                    if 'edges' in resp_json_ip_ranges:
-                                        resp_json_ip_ranges_edges = resp_json_ip_ranges['edges']
-                                        if isinstance(resp_json_ip_ranges_edges,dict) or \
-                                           isinstance(resp_json_ip_ranges_edges,str):
-                                               resp_json_ip_ranges_edges = [resp_json_ip_ranges_edges]
-
-                helper.log_debug('resp_json: ' + str(resp_json))
-                helper.log_debug('resp_json_ip_ranges_edges: ' + str(resp_json_ip_ranges_edges))
-                    
-                if resp_json_ip_ranges_edges:
-                    
-                    for edge in resp_json_ip_ranges_edges:
-                        if 'node' in edge:
-                            if 'cidr' in edge['node']:
-                                ip_range = edge['node']['cidr']
-                                all_params['ip_range'] = ip_range
-                                debug(helper, all_params,
-                                      "Adding cidr: {ip_range} to ip_ranges")
-                                asset_group_ip_ranges_per_page['ip_ranges'].append(ip_range)
-                
-                debug(helper, all_params, 
-                      "Counting number of IP ranges found")
-                all_params['num_ip_ranges'] = len(asset_group_ip_ranges_per_page['ip_ranges'])
-                info(helper, all_params,
-                     "Number of IP ranges found on page: {page_num} for asset group: {ag_id}, {ag_name} is: {num_ip_ranges}")
-            
-                info(helper, all_params, 
-                    "Creating all {num_ip_ranges} assets as an event...")
-                new_event = helper.new_event(json.dumps(asset_group_ip_ranges_per_page, indent=4),
-                            index=all_params['assetnote_index'],
-                            sourcetype=all_params['assetnote_sourcetype'],
-                            source=all_params['assetnote_source'])
-                            
-                info(helper, all_params, 
-                    "Writing an event to Splunk index: {assetnote_index}, sourcetype: {assetnote_sourcetype}, source: {assetnote_source}...")
-                ew.write_event(new_event)
-            
-            
-                debug(helper, all_params, 
-                      "Checking if the next page exists for page: {page_num} for asset group: {ag_id}, {ag_name}")
-                if resp_json_ip_ranges:
-                    if 'pageInfo' in resp_json_ip_ranges:
-                        resp_json_page_info = resp_json_ip_ranges['pageInfo']
-                        if 'hasNextPage' in resp_json_page_info:
-                            get_next_page = resp_json_page_info['hasNextPage']
-                            if get_next_page == False or get_next_page == 'false' or get_next_page == 'False':
-                                get_next_page = False
-                            if not get_next_page:
-                                debug(helper, all_params,
-                                      "No more pages of IPs after page: {page_num} for asset group: {ag_id}, {ag_name}")
+              lambda: "Error: " + str(resp_json), format_params=False)
+        get_next_page = False
 
-                else:
-                    get_next_page = False
-                    debug(helper, all_params,
-                          "No more pages of IPs after page: {page_num} for asset group: {ag_id}, {ag_name}")
-            else:
-                debug(helper, all_params,
-                     "Error obtaining page: {page_num} when requesting IPs for asset group: {ag_id}, {ag_name}. Moving to next page.")
-            
-            all_params['page_num'] += 1
-            debug(helper, all_params,
-                  "Incrementing the page num to page: {page_num} for asset group: {ag_id}, {ag_name}")
-                  
-            
-            debug(helper, all_params, 
-                  "Check if a page limit is defined for num pages to return" )
-            if all_params['limit_num_pages_returned'] > 0:
-                
-                debug(helper, all_params, 
-                  "Checking if we have hit limit of number of pages to return")
-                if int(all_params['page_num']) > int(all_params['limit_num_pages_returned']):
-                    
-                    info(helper, all_params,
-                          "Hit a limit of pages to return, current page_numm: {page_num}, limit_num_pages_returned: {limit_num_pages_returned}")
-                    get_next_page = False
-                    
-            else:
-                # No limit defined - get all available pages 
-                pass
 
-        
     # ------------------------------------------------------------------------
-    # Get the domains for each asset group (paginated)
+    # Get the IPs and domains for each asset group (paginated, both in the same
+    # request, many asset groups per request)
     # ------------------------------------------------------------------------
-    for asset_group in asset_groups:
-        
-        asset_group_id = asset_group['id']
-        asset_group_name = asset_group['name']
-        all_params['ag_id'] = asset_group_id
-        all_params['ag_name'] = asset_group_name
-        
-        debug(helper, all_params,
-              "Making POST req to get IPs for asset group: {ag_id}, {ag_name}")
-             
-        get_next_page = True
-        all_params['page_num'] = 1
-        
-        # Keep going to the next page
-        while get_next_page:
-            
-            # Define a dict to store info about the asset group domains and 
-            # metadata such as the page we get it from
-            asset_group_domains_per_page = {}
-            asset_group_ip_ranges_per_page['ag_id'] = all_params['ag_id']
-            asset_group_ip_ranges_per_page['ag_name'] = all_params['ag_name']
-            asset_group_domains_per_page['page_num'] = all_params['page_num']
-            asset_group_domains_per_page['domains'] = []
-            
-            # Get ready to loop through multiple times to get the domains on the
-            # page
-            all_params['try'] = 0
-            all_params['page_load_success'] = False
-            
-            while not all_params['page_load_success'] and \
-                      all_params['try'] < all_params['num_retries']:
-                
-                all_params['try'] += 1
-                
-                debug(helper, all_params, 
-                     "Try: {try}, Page: {page_num}. Requesting domains for asset group: {ag_id}, {ag_name} from AssetNote...")
-                graphql_query = DOMAINS_PER_ASSETGROUP_GRAPHQL_QUERY_TEMPLATE.format(**all_params)
-                url_to_call = "https://{assetnote_instance}.assetnotecloud.com/api/v2/graphql".format(**all_params)
-                method = "POST"
-                headers={
-                    "X-ASSETNOTE-API-KEY": "{assetnote_api_key}".format(**all_params)
-                }
-                payload = dict(query=graphql_query)
-                try:
-                    resp = helper.send_http_request(url=url_to_call,
-                                                    method=method, 
-                                                    payload=payload,
-                                                    headers=headers,
-                                                    verify=True,
-                                                    use_proxy=True)
-                
-                    status_code = resp.status_code
-                    resp_text = resp.text
-                        
-                except Exception as e:
-                    
-                    # Log the exception occurred to log file
-                    status_code = -1
-                    err_class = str(e.__class__)
-                    raw_err_msg = str(e)
-                    err_msg  = "Error in send_http_request for requesting domains for page: {page_num} in try: {try}. "
-                    err_msg += "Error: {}, {}".format(err_class, raw_err_msg)
-                    info(helper, all_params, err_msg)
-                    
-                # Page was not loaded successfully, so wait for some time before
-                # re-requesting the page
-                if status_code == 200:
-                        all_params['page_load_success'] = True
-                else:
-                    all_params['page_load_success'] = False
-                    info(helper, all_params, 
-                        "Sleeping {backoff_time}s before re-requesting domains in the asset group: {ag_id}, {ag_name}...")
-                    time.sleep(all_params['backoff_time'])
-
-            debug(helper, all_params, 
-                  "Parsing the response to determine the IPs...")
-            if status_code == 200:
-                
-                resp_json = resp.json()
-                
-                debug(helper, all_params, 
-                      "Get all the domains from page: {page_num} for asset group: {ag_id}, {ag_name}")
-                      
-                resp_json_domains_edges = None
-                resp_json_domains = None
-                if 'data' in resp_json:
-                    resp_json_data = resp_json['data']
-                    if 'assetGroups' in resp_json_data:
-                        resp_json_asset_groups = resp_json_data['assetGroups']
-                        if 'edges' in resp_json_asset_groups:
-                            resp_json_edges = resp_json_asset_groups['edges']
-                            if isinstance(resp_json_edges,
-                                          list):
-                                resp_json_edges = resp_json_edges[0]
-                            if 'node' in resp_json_edges:
-                                resp_json_node = resp_json_edges['node']
-                                if 'domains' in resp_json_node:
-                                    resp_json_domains = resp_json_node['domains']
-                                    if 'edges' in resp_json_domains:
-                                        resp_json_domains_edges = resp_json_domains['edges']
-                                        if isinstance(resp_json_domains_edges,dict) or \
-                                           isinstance(resp_json_domains_edges,str):
-                                               resp_json_domains_edges = [resp_json_domains_edges]
-
-                helper.log_debug('resp_json: ' + str(resp_json))
-                helper.log_debug('resp_json_domains_edges: ' + str(resp_json_domains_edges))
-                    
-                if resp_json_domains_edges:
-                    
-                    for edge in resp_json_domains_edges:
-                        if 'node' in edge:
-                            if 'name' in edge['node']:
-                                domain = edge['node']['name']
-                                all_params['domain'] = domain
-                                debug(helper, all_params,
-                                      "Adding domain: {domain} to domains")
-                                asset_group_domains_per_page['domains'].append(domain)
-                
-                debug(helper, all_params, 
-                      "Counting number of domains found")
-                
-                all_params['num_domains'] = len(asset_group_domains_per_page['domains'])
-                info(helper, all_params,
-                    "Number of domains found on page: {page_num} for asset group: {ag_id}, {ag_name} is: {num_domains}")
-            
-                info(helper, all_params, 
-                    "Creating all {num_domains} assets as an event...")
-                new_event = helper.new_event(json.dumps(asset_group_domains_per_page, indent=4),
-                            index=all_params['assetnote_index'],
-                            sourcetype=all_params['assetnote_sourcetype'],
-                            source=all_params['assetnote_source'])
-                            
-                info(helper, all_params, 
-                    "Writing an event to Splunk index: {assetnote_index}, sourcetype: {assetnote_sourcetype}, source: {assetnote_source}...")
-                ew.write_event(new_event)
-            
-                debug(helper, all_params, 
-                      "Checking if the next page exists for page: {page_num} for asset group: {ag_id}, {ag_name}")
-                if resp_json_domains:
-                    if 'pageInfo' in resp_json_domains:
-                        resp_json_page_info = resp_json_domains['pageInfo']
-                        if 'hasNextPage' in resp_json_page_info:
-                            get_next_page = resp_json_page_info['hasNextPage']
-                            if get_next_page == False or get_next_page == 'false' or get_next_page == 'False':
-                                get_next_page = False
-                            if not get_next_page:
-                                debug(helper, all_params,
-                                      "No more pages of domains after page: {page_num} for asset group: {ag_id}, {ag_name}")
-                                
-                else:
-                    get_next_page = False
-                    debug(helper, all_params,
-                          "No more pages of domains after page: {page_num} for asset group: {ag_id}, {ag_name}")
-            else:
-                debug(helper, all_params,
-                     "Error obtaining page: {page_num} when requesting domains for asset group: {ag_id}, {ag_name}. Moving to next page.")
-            
-            # Try to get the next page
-            all_params['page_num'] += 1
-            debug(helper, all_params,
-                  "Incrementing the page num to page: {page_num} for asset group: {ag_id}, {ag_name}")
-                  
-            debug(helper, all_params, 
-                  "Check if a page limit is defined for num pages to return" )
-            if all_params['limit_num_pages_returned'] > 0:
-                
-                debug(helper, all_params, 
-                  "Checking if we have hit limit of number of pages to return")
-                if int(all_params['page_num']) > int(all_params['limit_num_pages_returned']):
-                    
-                    info(helper, all_params,
-                          "Hit a limit of pages to return, current page_num: {page_num}, limit_num_pages_returned: {limit_num_pages_returned}")
-                    get_next_page = False
-                    
-            else:
-                # No limit defined - get all available pages 
-                pass   
-                                      
-    
+    collect_assetgroup_values(helper, ew, all_params, asset_groups, rate_limiter,
+                              circuit_breaker, dead_letter_queue)
@@ -0,0 +1,2494 @@
+# encoding = utf-8
+
+"""Helpers shared by the Assetnote modular inputs"""
+
+import codecs
+import collections
+import datetime
+import email.utils
+import hashlib
+import json
+import os
+import queue
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# fcntl is not available on Windows, where the files are locked with msvcrt
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# orjson is used to parse and serialize the JSON, if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""Checkpoint key to keep the page size learned per instance and query type"""
+PAGE_SIZE_CHECKPOINT_KEY_TEMPLATE = "assetnote_page_size_{assetnote_instance}_{query_type}"
+
+"""Checkpoint key to keep the pages which could not be obtained per instance and input"""
+DEAD_LETTER_CHECKPOINT_KEY_TEMPLATE = "assetnote_dead_letters_{assetnote_instance}_{assetnote_source}"
+
+"""Checkpoint key to keep the high-water mark of lastUpdated and the time of the last full collection per instance and input"""
+COLLECTION_CHECKPOINT_KEY_TEMPLATE = "assetnote_collection_{assetnote_instance}_{assetnote_source}"
+
+"""GraphQL arguments to request only the records updated since the high-water mark, oldest first"""
+INCREMENTAL_COLLECTION_ARGUMENTS_TEMPLATE = 'f:{{field:"lastUpdated",op:GTE,value:{high_water_mark_json}}},s:[{{field:"lastUpdated",dir:ASC}}],'
+
+"""Default number of seconds between full collections, when collecting incrementally"""
+FULL_COLLECTION_INTERVAL = 604800
+
+"""Number of pages failing one after another after which a collection stops, as the instance is likely down"""
+MAX_CONSECUTIVE_FAILED_PAGES = 3
+
+"""File to keep the circuit breaker state per instance in, shared by all the inputs"""
+CIRCUIT_BREAKER_FILE_TEMPLATE = "circuit_breaker_{assetnote_instance}.json"
+
+"""File to keep the fingerprints of the records written per instance and input in, in the state directory"""
+FINGERPRINT_STORE_FILE_TEMPLATE = "fingerprints_{assetnote_instance}_{assetnote_source}.db"
+
+"""Cheapest GraphQL query, to probe whether the instance is reachable again"""
+PROBE_GRAPHQL_QUERY = "query { __typename }"
+
+"""Pattern matching a string, whitespace around a punctuator, or any other whitespace in a GraphQL document, to
+minify the document with"""
+GRAPHQL_MINIFY_PATTERN = re.compile(r'("(?:[^"\\]|\\.)*")|\s*([{}()\[\]:,!=])\s*|\s+')
+
+"""Version of the automatic persisted queries protocol, to send the SHA-256 hash of a query instead of its document"""
+PERSISTED_QUERY_VERSION = 1
+
+"""Error code returned by the instance for a persisted query, per error message"""
+PERSISTED_QUERY_ERROR_CODES = {'PersistedQueryNotFound': 'PERSISTED_QUERY_NOT_FOUND',
+                               'PersistedQueryNotSupported': 'PERSISTED_QUERY_NOT_SUPPORTED'}
+
+"""Number of keep-alive connections to the Assetnote instance kept in the pool, enough for all the concurrent requests"""
+TRANSPORT_POOL_SIZE = 10
+
+"""URL of the Assetnote GraphQL API"""
+GRAPHQL_URL_TEMPLATE = "https://{assetnote_instance}.assetnotecloud.com/api/v2/graphql"
+
+"""Number of bytes to read at a time from the response, when reading a page as a stream"""
+STREAM_CHUNK_SIZE = 65536
+
+"""Number of records parsed from a page read as a stream, which are written as events together"""
+STREAMED_RECORDS_PER_BATCH = 100
+
+"""Pattern matching the key of the records array of a page in the raw JSON of the response"""
+RAW_EDGES_KEY_PATTERN = re.compile(rb'"edges"\s*:\s*\[')
+
+"""Patterns of raw JSON for any text outside of strings and brackets, and for a string"""
+RAW_TEXT = rb'[^"{}\[\]]*'
+RAW_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+
+"""Pattern matching raw JSON up to (and capturing) the next bracket outside of any string"""
+RAW_BRACKET_PATTERN = re.compile(RAW_TEXT + rb'(?:' + RAW_STRING + RAW_TEXT + rb')*([{}\[\]])', re.DOTALL)
+
+"""Levels of nesting of an object or array in raw JSON which are matched by RAW_VALUE_PATTERN, beyond which
+its brackets are matched one at a time"""
+RAW_VALUE_MAX_DEPTH = 8
+
+"""Pattern matching any whitespace in raw JSON"""
+RAW_WHITESPACE_PATTERN = re.compile(rb'\s*')
+
+def _get_raw_value_pattern(max_depth):
+    """
+    Build the pattern matching an object or array in raw JSON in a single
+    step, from the innermost level of nesting out. The kind of the brackets
+    is not checked, as the records are only located by the pattern.
+
+    Arguments
+    ---------
+    max_depth: int
+        Levels of nesting to match
+
+    Returns
+    -------
+    re.Pattern
+        Pattern matching an object or array
+    """
+    value = rb'[{\[]' + RAW_TEXT + rb'(?:' + RAW_STRING + RAW_TEXT + rb')*[}\]]'
+    for _ in range(max_depth - 1):
+        value = rb'[{\[]' + RAW_TEXT + rb'(?:(?:' + RAW_STRING + rb'|' + value + rb')' + RAW_TEXT + rb')*[}\]]'
+    return re.compile(value, re.DOTALL)
+
+"""Pattern matching an object or array in raw JSON, nested up to RAW_VALUE_MAX_DEPTH levels deep"""
+RAW_VALUE_PATTERN = _get_raw_value_pattern(RAW_VALUE_MAX_DEPTH)
+
+"""Pattern matching the first 'lastUpdated' of a record in raw JSON, which is the one of the node itself as
+GraphQL returns the fields in the order of the query, where the 'lastUpdated' of the node comes first"""
+RAW_LAST_UPDATED_PATTERN = re.compile(rb'"lastUpdated"\s*:\s*"([^"\\]*)"')
+
+"""Separators to serialize the events with, without any whitespace"""
+COMPACT_JSON_SEPARATORS = (',', ':')
+
+"""Default largest size of an event in bytes, matching the default TRUNCATE limit of Splunk"""
+MAX_EVENT_BYTES = 10000
+
+"""Special prefix added to each log message"""
+LOG_PREFIX = "AssetNote"
+
+"""Severity of each log level of Splunk, to only format the messages of the levels enabled"""
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+
+"""Parameters holding secrets, which are never written to the internal log"""
+SECRET_PARAMS = ('assetnote_api_key',)
+
+"""Written to the internal log in place of the secrets"""
+REDACTED = "<redacted>"
+
+"""Largest number of characters of a message written to the internal log eg for responses logged in full"""
+MAX_LOG_MESSAGE_CHARS = 4096
+
+"""Number of sampled messages of the same kind (eg per record) written, before only some of them are written"""
+LOG_SAMPLE_FIRST = 10
+
+"""One in this many sampled messages of the same kind is written, after the first ones"""
+LOG_SAMPLE_RATE = 100
+
+class PageSizeController(object):
+    """
+    Adapt the number of items requested per page to the largest page that the
+    Assetnote instance handles well. The page size is doubled after a few pages
+    returned within the target latency, held while pages are slow, and halved
+    on timeouts or errors (or brought back to the largest page size known to
+    work, if a larger page size was being probed). A page size which failed is
+    never requested again, and growth then probes halfway towards it instead
+    of doubling.
+
+    Arguments
+    ---------
+    page_size: int
+        Page size to start with
+    min_page_size: int
+        Smallest page size to shrink to
+    max_page_size: int
+        Largest page size to grow to
+    target_latency: float
+        Page size is only grown while pages are returned within this time (s)
+    adaptive: bool
+        If False, the page size is kept fixed
+    """
+
+    # Number of pages returned within the target latency before growing
+    SUCCESSES_BEFORE_GROWTH = 2
+
+    def __init__(self, page_size, min_page_size=5, max_page_size=200,
+                 target_latency=10, adaptive=True):
+        self.adaptive = adaptive
+        self.min_page_size = min(min_page_size, page_size)
+        self.max_page_size = max(max_page_size, page_size)
+        if self.adaptive:
+            page_size = min(max(page_size, self.min_page_size), self.max_page_size)
+        self.page_size = page_size
+        self.target_latency = target_latency
+        self.successes = 0
+
+        # Largest page size returned within the target latency so far
+        self.learned_page_size = None
+        self.lock = threading.Lock()
+
+    def get_page_size(self):
+        """
+        Get the page size to request the next page with
+
+        Returns
+        -------
+        int
+            Page size to request the next page with
+        """
+        return self.page_size
+
+    def record_success(self, page_size, latency):
+        """
+        Record a page returned successfully, growing the page size if healthy
+
+        Arguments
+        ---------
+        page_size: int
+            Page size the page was requested with
+        latency: float
+            Time taken to return the page (s)
+        """
+        if not self.adaptive:
+            return
+        with self.lock:
+            if latency > self.target_latency:
+                self.successes = 0
+                return
+            self.learned_page_size = max(self.learned_page_size or 0, page_size)
+            self.successes += 1
+            if self.successes >= self.SUCCESSES_BEFORE_GROWTH:
+                self.page_size = min(self.page_size * 2,
+                                     (self.page_size + self.max_page_size + 1) // 2)
+                self.successes = 0
+
+    def record_failure(self, page_size):
+        """
+        Record a page which could not be obtained, shrinking the page size
+
+        Arguments
+        ---------
+        page_size: int
+            Page size the page was requested with
+
+        Returns
+        -------
+        bool
+            True, if the page size was shrunk
+        """
+        with self.lock:
+            self.successes = 0
+            if not self.adaptive or page_size <= self.min_page_size:
+                return False
+            self.max_page_size = max(page_size - 1, self.min_page_size)
+            if self.learned_page_size is not None and self.learned_page_size < page_size:
+                self.page_size = self.learned_page_size
+            else:
+                self.page_size = max(page_size // 2, self.min_page_size)
+                if self.learned_page_size is not None:
+                    self.learned_page_size = min(self.learned_page_size, self.max_page_size)
+            return True
+
+def get_retry_after(headers):
+    """
+    Get the number of seconds to wait from the 'Retry-After' header of a
+    response, which may be given either in seconds or as an HTTP date
+
+    Arguments
+    ---------
+    headers: dict
+        Headers of the response
+
+    Returns
+    -------
+    float
+        Number of seconds to wait, or None if no valid 'Retry-After' header
+    """
+    retry_after = (headers or {}).get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        retry_after_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_after_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+
+class RateLimiter(object):
+    """
+    Rate limiter for the requests made by an input, which lets requests
+    through as fast as the Assetnote instance allows. The rate is cut
+    multiplicatively when the instance signals pressure (HTTP 429, 5xx or a
+    'Retry-After' header), and recovered additively after each successful
+    request (AIMD). Until the first sign of pressure, the rate is only capped
+    by the maximum requests per second (if any).
+
+    Requests are spaced out evenly at the current rate, as with a token bucket
+    holding a single token, by keeping the earliest time the next request can
+    be made.
+
+    Arguments
+    ---------
+    max_requests_per_second: float
+        Maximum number of requests per second. If set to 0 or less, no limit.
+    min_requests_per_second: float
+        Rate below which the rate is never cut
+    """
+
+    # Factor to cut the rate by when the instance signals pressure
+    MULTIPLICATIVE_DECREASE = 0.5
+
+    # Requests per second to recover the rate by after each successful request
+    ADDITIVE_INCREASE = 0.5
+
+    # Number of recent requests to measure the rate from, when cutting the rate
+    # for the first time
+    RATE_WINDOW = 10
+
+    def __init__(self, max_requests_per_second=0, min_requests_per_second=0.1):
+        max_requests_per_second = float(max_requests_per_second)
+        self.max_rate = max_requests_per_second if max_requests_per_second > 0 else None
+        self.min_rate = float(min_requests_per_second)
+        if self.max_rate is not None:
+            self.min_rate = min(self.min_rate, self.max_rate)
+        self.rate = self.max_rate
+        self.next_request_time = 0
+        self.last_decrease_time = None
+        self.request_times = collections.deque(maxlen=self.RATE_WINDOW)
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the next request can be made without exceeding the rate
+
+        Returns
+        -------
+        float
+            Time (as per time.monotonic()) at which the request is made
+        """
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_time)
+            if self.rate is not None:
+                self.next_request_time = request_time + 1.0 / self.rate
+            self.request_times.append(request_time)
+        if request_time > now:
+            time.sleep(request_time - now)
+        return request_time
+
+    def get_current_rate(self):
+        """
+        Get the rate at which the recent requests were made
+
+        Returns
+        -------
+        float
+            Requests per second over the recent requests, or None if the rate
+            cannot be measured yet
+        """
+        if len(self.request_times) < 2:
+            return None
+        elapsed = self.request_times[-1] - self.request_times[0]
+        if elapsed <= 0:
+            return None
+        return (len(self.request_times) - 1) / elapsed
+
+    def record_response(self, status_code, headers=None, request_time=None):
+        """
+        Adjust the rate based on the response to a request. The rate is cut
+        only once for the requests which were already in flight when it was
+        last cut.
+
+        Arguments
+        ---------
+        status_code: int
+            HTTP status code of the response
+        headers: dict
+            Headers of the response
+        request_time: float
+            Time at which the request was made, as returned by wait()
+
+        Returns
+        -------
+        bool
+            True, if the response signalled pressure
+        """
+        retry_after = get_retry_after(headers)
+        with self.lock:
+            if status_code == 429 or status_code >= 500 or retry_after is not None:
+                now = time.monotonic()
+                if self.last_decrease_time is None or request_time is None or \
+                   request_time >= self.last_decrease_time:
+
+                    # Without a rate yet, cut the rate at which the recent
+                    # requests were made
+                    rate = self.rate
+                    if rate is None:
+                        rate = self.get_current_rate() or 1.0
+                    self.rate = max(rate * self.MULTIPLICATIVE_DECREASE, self.min_rate)
+                    self.next_request_time = max(self.next_request_time, now + 1.0 / self.rate)
+                    self.last_decrease_time = now
+
+                # No requests are let through until the time to retry after
+                if retry_after is not None:
+                    self.next_request_time = max(self.next_request_time, now + retry_after)
+                return True
+
+            if status_code == 200 and self.rate is not None:
+                self.rate += self.ADDITIVE_INCREASE
+                if self.max_rate is not None:
+                    self.rate = min(self.rate, self.max_rate)
+            return False
+
+class DeadLetterQueue(object):
+    """
+    Pages which could not be obtained after all their retries, kept in the
+    checkpoint storage of the add-on so that they can be replayed at the start
+    of the next interval instead of their data being lost. Each page is keyed
+    by the query, the asset group (if any) and the page number, and is kept
+    with everything needed to request it again (offset, page count and the
+    endCursor of the page before it).
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    key: str
+        Checkpoint key to keep the pages in
+    replay_budget: int
+        Number of pages which can be replayed per interval
+    max_replays: int
+        Number of intervals in which a page is replayed before it is dropped
+    """
+    def __init__(self, helper, key, replay_budget=50, max_replays=5):
+        self.helper = helper
+        self.key = key
+        self.replay_budget = replay_budget
+        self.max_replays = max_replays
+        self.entries = helper.get_check_point(key) or {}
+        self.lock = threading.Lock()
+
+    def save(self):
+        """
+        Write the pages in the queue to the checkpoint storage
+        """
+        if self.entries:
+            self.helper.save_check_point(self.key, self.entries)
+        else:
+            self.helper.delete_check_point(self.key)
+
+    def add(self, query_type, all_params, ag_id=None, ag_name=None):
+        """
+        Add a page which could not be obtained to the queue
+
+        Arguments
+        ---------
+        query_type: str
+            Query the page belongs to eg 'assets', 'exposures', 'ipRanges'
+        all_params: dict
+            Parameters including the page number, offset, page count,
+            pagination mode, the endCursor of the previous page and the
+            number of records already written from the page
+        ag_id: str
+            ID of the asset group the page belongs to, if any
+        ag_name: str
+            Name of the asset group the page belongs to, if any
+
+        Returns
+        -------
+        str
+            Key of the page in the queue
+        """
+        entry_key = "{}/{}/{}".format(query_type, ag_id or '', all_params['page_num'])
+        with self.lock:
+            replays = self.entries.get(entry_key, {}).get('replays', 0)
+            self.entries[entry_key] = {'query_type': query_type,
+                                       'ag_id': ag_id,
+                                       'ag_name': ag_name,
+                                       'page_num': all_params['page_num'],
+                                       'offset': all_params['offset'],
+                                       'page_count': all_params['page_count'],
+                                       'pagination_mode': all_params.get('pagination_mode', 'page'),
+                                       'end_cursor': all_params.get('end_cursor'),
+                                       'streamed_on_page': all_params.get('streamed_on_page', 0),
+                                       'collection_arguments': all_params.get('collection_arguments', ''),
+                                       'failed_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                                       'replays': replays}
+            self.save()
+        return entry_key
+
+    def get_pages_to_replay(self, query_type):
+        """
+        Get the pages in the queue for a query, within the replay budget left
+        for this interval
+
+        Arguments
+        ---------
+        query_type: str
+            Query to get the pages for eg 'assets', 'exposures', 'ipRanges'
+
+        Returns
+        -------
+        list
+            Key and page of each page to replay
+        """
+        # The queue is shared by the workers of a collection, which may add
+        # or remove pages meanwhile
+        with self.lock:
+            pages = [(entry_key, entry) for entry_key, entry in sorted(self.entries.items())
+                     if entry['query_type'] == query_type]
+            pages = pages[:max(self.replay_budget, 0)]
+            self.replay_budget -= len(pages)
+        return pages
+
+    def record_replay(self, entry_key, success):
+        """
+        Record the outcome of replaying a page. A page replayed successfully is
+        removed from the queue, as is a page which failed to replay in too many
+        intervals.
+
+        Arguments
+        ---------
+        entry_key: str
+            Key of the page in the queue
+        success: bool
+            True, if the page was obtained
+
+        Returns
+        -------
+        bool
+            True, if the page was removed from the queue
+        """
+        with self.lock:
+            entry = self.entries[entry_key]
+            entry['replays'] += 1
+            removed = success or entry['replays'] >= self.max_replays
+            if removed:
+                del self.entries[entry_key]
+            self.save()
+        return removed
+
+class SerializedEventWriter(object):
+    """
+    Event writer which can be shared by many threads. The events are handed
+    over to a single writer thread, which writes them one at a time with the
+    event writer of the input, as the event writer is not safe to call from
+    many threads at once.
+
+    Arguments
+    ---------
+    ew: EventWriter
+        Event writer of the input
+    max_queued_events: int
+        Number of events which can wait to be written, before the threads
+        writing more events are blocked
+    """
+    def __init__(self, ew, max_queued_events=1000):
+        self.ew = ew
+        self.events = queue.Queue(maxsize=max_queued_events)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="assetnote-event-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        Write the events handed over, until the writer is closed. After an
+        error, the remaining events are discarded so that the threads writing
+        events are not blocked.
+        """
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            if self.error is None:
+                try:
+                    self.ew.write_event(event)
+                except Exception as e:
+                    self.error = e
+
+    def write_event(self, event):
+        """
+        Hand over an event to be written by the writer thread
+
+        Arguments
+        ---------
+        event: Event
+            Event to write, as created by helper.new_event()
+        """
+        if self.error is not None:
+            raise self.error
+        self.events.put(event)
+
+    def close(self):
+        """
+        Wait for all the events handed over to be written, and stop the writer
+        thread. Any error encountered while writing the events is raised.
+        """
+        self.events.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+class StanzaHelper(object):
+    """
+    View of the helper of a single instance modular input for one of its input
+    stanzas, so that a collection can read the arguments of the stanza as if
+    it were an input of its own. The sourcetype and the source of the events
+    written can be set per collection, the source also keeping the checkpoints
+    of each collection apart.
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk, in single instance mode
+    input_stanza_name: str
+        Name of the input stanza to read the arguments of
+    sourcetype: str
+        Sourcetype to write the events with, or None for the sourcetype of the
+        input stanza
+    source: str
+        Source to write the events with, or None for the type of the input
+    """
+    def __init__(self, helper, input_stanza_name, sourcetype=None, source=None):
+        self.helper = helper
+        self.input_stanza_name = input_stanza_name
+        self.sourcetype = sourcetype
+        self.source = source
+
+    def get_arg(self, arg_name):
+        return self.helper.get_arg(arg_name, self.input_stanza_name)
+
+    def get_output_index(self):
+        return self.helper.get_output_index(self.input_stanza_name)
+
+    def get_sourcetype(self):
+        return self.sourcetype or self.helper.get_sourcetype(self.input_stanza_name)
+
+    def get_input_type(self):
+        return self.source or self.helper.get_input_type()
+
+    def __getattr__(self, name):
+        # Logging, checkpoints, events and HTTP requests go through the helper
+        # itself, and so through the same HTTP session for all the collections
+        return getattr(self.helper, name)
+
+class Transport(object):
+    """
+    Transport for the requests to the Assetnote GraphQL API, shared by all the
+    collections in the process. The proxy configuration of the add-on is read
+    once, and the keep-alive connections to the instance are pooled and re-used
+    across pages, instead of a new connection (and CONNECT and TLS handshake
+    through the proxy) being set up for every page.
+
+    Arguments
+    ---------
+    proxies: dict
+        Proxies to send the requests through, as given to requests, or None
+    pool_size: int
+        Number of keep-alive connections to keep in the pool
+    """
+    def __init__(self, proxies=None, pool_size=TRANSPORT_POOL_SIZE):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        if proxies:
+            self.session.proxies.update(proxies)
+        self.num_requests = 0
+        self.total_time = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, payload, headers, timeout, stream=False):
+        """
+        Send a POST request with a JSON payload, and time it. The time to the
+        response headers is kept in 'elapsed' of the response, and the time
+        until the whole response is read in 'total_time' (or until the headers,
+        when the response is read as a stream).
+
+        Arguments
+        ---------
+        url: str
+            URL to send the request to
+        payload: dict
+            JSON payload of the request
+        headers: dict
+            Headers of the request
+        timeout: tuple
+            Seconds to wait to connect and to read the response
+        stream: bool
+            If True, only the headers are read, leaving the body to be read as
+            a stream
+
+        Returns
+        -------
+        requests.Response
+            Response to the request
+        """
+        start_time = time.monotonic()
+        resp = self.session.post(url, json=payload, headers=headers, timeout=timeout, verify=True,
+                                 stream=stream)
+        resp.total_time = time.monotonic() - start_time
+        with self.lock:
+            self.num_requests += 1
+            self.total_time += resp.total_time
+        return resp
+
+    def close(self):
+        """
+        Close all the connections in the pool
+        """
+        self.session.close()
+
+class JSONBackend(object):
+    """
+    Serialization layer for the JSON of the responses, the events and the
+    fingerprints, using orjson when it is installed and the json module
+    otherwise. Values are serialized without any whitespace and with
+    non-ASCII characters written as is, so that the output of both backends
+    is byte-identical (apart from floats written with an exponent, eg 1e16
+    rather than 1e+16, which are not found in the records). Values orjson
+    does not handle (eg integers beyond 64 bits) fall back to the json module.
+
+    Arguments
+    ---------
+    use_orjson: bool
+        Use orjson, if it is installed
+    """
+    def __init__(self, use_orjson=True):
+        self.orjson = orjson if use_orjson else None
+        self.name = 'orjson' if self.orjson is not None else 'json'
+
+    def loads(self, data):
+        """
+        Decode a JSON document
+
+        Arguments
+        ---------
+        data: bytes
+            JSON document, as bytes or str
+
+        Returns
+        -------
+        object
+            Value decoded
+        """
+        if self.orjson is not None:
+            try:
+                return self.orjson.loads(data)
+            except self.orjson.JSONDecodeError:
+                pass
+        return json.loads(data)
+
+    def dumps(self, value, sort_keys=False):
+        """
+        Serialize a value as JSON without any whitespace
+
+        Arguments
+        ---------
+        value: object
+            Value to serialize
+        sort_keys: bool
+            Sort the keys of the objects, eg to fingerprint the value
+
+        Returns
+        -------
+        str
+            JSON of the value
+        """
+        if self.orjson is not None:
+            try:
+                return self.orjson.dumps(value, option=self.orjson.OPT_SORT_KEYS if sort_keys else 0).decode('utf-8')
+            except self.orjson.JSONEncodeError:
+                pass
+        return json.dumps(value, sort_keys=sort_keys, separators=COMPACT_JSON_SEPARATORS, ensure_ascii=False)
+
+"""Serialization layer used for all the JSON, with orjson if it is installed"""
+JSON_BACKEND = JSONBackend()
+
+class GraphQLQuery(object):
+    """
+    GraphQL query document compiled once, with the page to request given as
+    variables rather than formatted into the document. The document is
+    minified and hashed with SHA-256 up front, so that in the persisted
+    query mode only the hash is sent to an instance which has already been
+    sent the document, as per the automatic persisted queries protocol.
+
+    Arguments
+    ---------
+    document: str
+        GraphQL query document, without any comments
+    """
+    def __init__(self, document):
+        self.document = GRAPHQL_MINIFY_PATTERN.sub(lambda m: m.group(1) or m.group(2) or ' ', document).strip()
+        self.sha256_hash = hashlib.sha256(self.document.encode('utf-8')).hexdigest()
+        self.extensions = {'persistedQuery': {'version': PERSISTED_QUERY_VERSION,
+                                              'sha256Hash': self.sha256_hash}}
+        self.registered_urls = set()
+        self.unsupported_urls = set()
+
+    def get_payload(self, url, variables=None, persisted=False):
+        """
+        Get the JSON payload of a request for the query. In the persisted
+        query mode, the document is only sent along with the hash until the
+        instance has returned a response to it.
+
+        Arguments
+        ---------
+        url: str
+            URL of the GraphQL API of the instance
+        variables: dict
+            Values of the variables of the query
+        persisted: bool
+            If True, the hash of the query is sent, and the document left out
+            once the instance has been sent it
+
+        Returns
+        -------
+        dict
+            JSON payload of the request
+        """
+        payload = {}
+        if not persisted or url in self.unsupported_urls:
+            payload['query'] = self.document
+        else:
+            if url not in self.registered_urls:
+                payload['query'] = self.document
+            payload['extensions'] = self.extensions
+        if variables:
+            payload['variables'] = variables
+        return payload
+
+    def record_response(self, url, payload, status_code, content):
+        """
+        Record whether the instance knows the hash of the query, from the
+        response to a request sent with the hash. The instance has registered
+        the query once it returns a response to the document sent along with
+        the hash, and forgets it if it returns PersistedQueryNotFound.
+
+        Arguments
+        ---------
+        url: str
+            URL of the GraphQL API of the instance
+        payload: dict
+            JSON payload the request was sent with
+        status_code: int
+            HTTP status code of the response
+        content: bytes
+            Body of the response
+
+        Returns
+        -------
+        bool
+            True, if the request must be sent again as the instance did not
+            know the hash, or does not support persisted queries
+        """
+        if 'extensions' not in payload:
+            return False
+        error_code = get_persisted_query_error(content)
+        if error_code == 'PERSISTED_QUERY_NOT_SUPPORTED':
+            self.unsupported_urls.add(url)
+            return True
+        if error_code == 'PERSISTED_QUERY_NOT_FOUND':
+            self.registered_urls.discard(url)
+            return 'query' not in payload
+        if status_code == 200 and 'query' in payload:
+            self.registered_urls.add(url)
+        return False
+
+def get_persisted_query_error(content):
+    """
+    Get the error returned for a persisted query in a response, if any. The
+    body is only decoded if it mentions a persisted query at all, so that
+    pages of records are not decoded twice.
+
+    Arguments
+    ---------
+    content: bytes
+        Body of the response
+
+    Returns
+    -------
+    str
+        Error code eg 'PERSISTED_QUERY_NOT_FOUND', or None
+    """
+    if not content or (b'PersistedQuery' not in content and b'PERSISTED_QUERY' not in content):
+        return None
+    try:
+        resp_json = JSON_BACKEND.loads(content)
+    except ValueError:
+        return None
+    if not isinstance(resp_json, dict):
+        return None
+    for err in resp_json.get('errors') or []:
+        if not isinstance(err, dict):
+            continue
+        error_code = (err.get('extensions') or {}).get('code') or PERSISTED_QUERY_ERROR_CODES.get(err.get('message'))
+        if error_code in PERSISTED_QUERY_ERROR_CODES.values():
+            return error_code
+    return None
+
+"""GraphQL query compiled last per query template, with the collection arguments it was compiled with"""
+_collection_queries = {}
+
+def get_collection_query(query_template, collection_arguments):
+    """
+    Get the GraphQL query for a collection with the filters and sorts of the
+    collection arguments, compiled again only when the collection arguments
+    change (ie with the high-water mark of an incremental collection). Only
+    the query compiled last is kept per query template, so that the queries
+    of earlier high-water marks do not pile up in a process kept for many
+    intervals.
+
+    Arguments
+    ---------
+    query_template: str
+        Query template of the collection, with {collection_arguments}
+    collection_arguments: str
+        GraphQL arguments placed before the 'count' argument
+
+    Returns
+    -------
+    GraphQLQuery
+        GraphQL query for the collection
+    """
+    compiled_arguments, graphql_query = _collection_queries.get(query_template, (None, None))
+    if graphql_query is None or compiled_arguments != collection_arguments:
+        graphql_query = GraphQLQuery(query_template.format(collection_arguments=collection_arguments))
+        _collection_queries[query_template] = (collection_arguments, graphql_query)
+    return graphql_query
+
+def get_page_variables(all_params):
+    """
+    Get the values of the variables of a collection query which select the
+    page to request
+
+    Arguments
+    ---------
+    all_params: dict
+        Parameters including the pagination mode, the number of items obtained
+        so far, the page count and the endCursor of the previous page
+
+    Returns
+    -------
+    dict
+        Values of the variables eg {'count': 25, 'page': 3} or
+        {'count': 25, 'after': 'YXJyYXk='}
+    """
+    variables = {'count': all_params['page_count']}
+    if all_params['pagination_mode'] == 'cursor':
+        if all_params.get('end_cursor'):
+            variables['after'] = all_params['end_cursor']
+    else:
+        variables['page'] = all_params['offset'] // all_params['page_count'] + 1
+    return variables
+
+class StreamingJSONParser(object):
+    """
+    Incremental parser for a JSON document read in chunks, which yields each
+    item of the array found at a path (eg the edges of a page) as soon as the
+    item is complete. Only the item being parsed is held in memory, along with
+    the rest of the document (the header) eg
+    {'data': {'assets': {'edges': [], 'pageInfo': {...}}}}. Each item is
+    decoded by the json module, while the objects leading to the array are
+    walked key by key.
+
+    Arguments
+    ---------
+    path: tuple
+        Keys of the objects leading to the array eg ('data', 'assets', 'edges')
+    """
+
+    WHITESPACE = " \t\n\r"
+
+    def __init__(self, path):
+        self.path = tuple(path)
+        self.decoder = json.JSONDecoder()
+        self.header = None
+
+    def parse(self, chunks):
+        """
+        Parse a JSON document, yielding each item of the array at the path. Once
+        all the items are yielded, the header is kept in 'header'.
+
+        Arguments
+        ---------
+        chunks: iterable
+            Text of the JSON document, in chunks
+        """
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+        self.header = yield from self.parse_value(self.path)
+        self.skip_whitespace(allow_eof=True)
+        if self.pos < len(self.buffer):
+            raise ValueError("Extra data after the JSON document at: {}".format(self.pos))
+
+    def read_more(self):
+        """
+        Read the next chunk of the document, dropping the text already parsed
+
+        Returns
+        -------
+        bool
+            False, if the whole document has been read
+        """
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def skip_whitespace(self, allow_eof=False):
+        """
+        Move past any whitespace, reading more of the document if needed
+
+        Arguments
+        ---------
+        allow_eof: bool
+            If False, reaching the end of the document is an error
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return
+            if not self.read_more():
+                if allow_eof:
+                    return
+                raise ValueError("Unexpected end of the JSON document")
+
+    def expect(self, chars):
+        """
+        Move past the next character, which must be one of the characters given
+
+        Arguments
+        ---------
+        chars: str
+            Characters expected eg ',}'
+
+        Returns
+        -------
+        str
+            Character found
+        """
+        self.skip_whitespace()
+        char = self.buffer[self.pos]
+        if char not in chars:
+            raise ValueError("Expected one of: {!r} at: {}, found: {!r}".format(chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """
+        Decode the next value in full, reading more of the document until the
+        value is complete
+
+        Returns
+        -------
+        object
+            Value decoded
+        """
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.read_more():
+                    raise
+                continue
+
+            # A number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and self.read_more():
+                continue
+            self.pos = end
+            return value
+
+    def parse_value(self, path):
+        """
+        Parse the next value, yielding the items of the array at the path
+
+        Arguments
+        ---------
+        path: tuple
+            Keys leading from the value to the array
+
+        Returns
+        -------
+        object
+            Value parsed, with the array at the path left empty
+        """
+        self.skip_whitespace()
+        if not path:
+            if self.buffer[self.pos] != '[':
+                return self.decode()
+            self.pos += 1
+            self.skip_whitespace()
+            if self.buffer[self.pos] == ']':
+                self.pos += 1
+                return []
+            while True:
+                yield self.decode()
+                if self.expect(',]') == ']':
+                    return []
+        if self.buffer[self.pos] != '{':
+            return self.decode()
+        self.pos += 1
+        value = {}
+        self.skip_whitespace()
+        if self.buffer[self.pos] == '}':
+            self.pos += 1
+            return value
+        while True:
+            key = self.decode()
+            self.expect(':')
+            if key == path[0]:
+                value[key] = yield from self.parse_value(path[1:])
+            else:
+                value[key] = self.decode()
+            if self.expect(',}') == '}':
+                return value
+
+class FileLock(object):
+    """
+    Exclusive lock on a file shared by the processes of all the inputs, held
+    within a 'with' block. The lock is taken on a separate lock file, so that
+    the file it guards can still be replaced in one step.
+
+    Arguments
+    ---------
+    path: str
+        Lock file, created if it does not exist
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            # msvcrt gives up after 10 attempts a second apart, so keep trying
+            self.file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            self.file = None
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for an Assetnote instance, shared by the assets, exposures
+    and assetgroups inputs through a state file on disk. While the instance is
+    reachable, the circuit is 'closed'. After a number of requests fail one
+    after another (connection errors, timeouts or HTTP 5xx), the circuit is
+    'open' and the inputs fail fast without requesting anything. Once the open
+    time has passed, the circuit is 'half_open': a single input probes the
+    instance with a cheap query, closing the circuit if it succeeds, or opening
+    it again if it fails. The state is read and changed under a lock on the
+    state file, so that only one of the input processes probes the instance
+    and no failure recorded by any of them is lost.
+
+    Arguments
+    ---------
+    state_file: str
+        File to keep the state of the circuit in
+    failure_threshold: int
+        Number of requests failing one after another which open the circuit
+    open_time: float
+        Number of seconds to keep the circuit open for before probing
+    """
+
+    # Number of seconds after which a probe which has not completed (eg the
+    # input probing was stopped) is abandoned, letting another input probe
+    PROBE_TIMEOUT = 300
+
+    def __init__(self, state_file, failure_threshold=5, open_time=600):
+        self.state_file = state_file
+        self.failure_threshold = failure_threshold
+        self.open_time = open_time
+        self.lock = threading.Lock()
+        self.file_lock = FileLock(state_file + ".lock")
+
+    def load(self):
+        """
+        Read the state of the circuit from the state file
+
+        Returns
+        -------
+        dict
+            State of the circuit, failures one after another and timestamps
+        """
+        try:
+            with open(self.state_file, 'rb') as f:
+                return JSON_BACKEND.loads(f.read())
+        except (IOError, OSError, ValueError):
+            return {'state': 'closed', 'failures': 0, 'open_until': 0, 'probe_started_at': 0}
+
+    def save(self, state):
+        """
+        Write the state of the circuit to the state file, replacing the file in
+        one step so that the other inputs never read a partial state
+
+        Arguments
+        ---------
+        state: dict
+            State of the circuit to write
+        """
+        tmp_file = "{}.{}.tmp".format(self.state_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            f.write(JSON_BACKEND.dumps(state))
+        os.replace(tmp_file, self.state_file)
+
+    def get_state(self):
+        """
+        Get the state of the circuit
+
+        Returns
+        -------
+        str
+            'closed', 'open' or 'half_open'
+        """
+        return self.load()['state']
+
+    def allow_request(self):
+        """
+        Check whether a request can be made to the instance. When the open time
+        has passed, the circuit becomes 'half_open' and only the caller which
+        made it so is allowed to probe the instance.
+
+        Returns
+        -------
+        str
+            'closed' if requests can be made, 'probe' if the caller should probe
+            the instance, or None if no requests should be made
+        """
+        with self.lock, self.file_lock:
+            state = self.load()
+            now = time.time()
+            if state['state'] == 'closed':
+                return 'closed'
+            if state['state'] == 'open' and now < state['open_until']:
+                return None
+            if state['state'] == 'half_open' and \
+               now - state['probe_started_at'] < self.PROBE_TIMEOUT:
+                return None
+            state['state'] = 'half_open'
+            state['probe_started_at'] = now
+            self.save(state)
+            return 'probe'
+
+    def record_response(self, status_code):
+        """
+        Record the outcome of a request to the instance. Only connection errors,
+        timeouts and HTTP 5xx count as failures - any other response shows the
+        instance is reachable. An HTTP 4xx response to a probe (eg 401, 429)
+        neither closes nor opens the circuit, which stays half-open for the
+        next input to probe again.
+
+        Arguments
+        ---------
+        status_code: int
+            HTTP status code of the response, or None if no response was
+            received
+
+        Returns
+        -------
+        str
+            State of the circuit after the request, 'closed', 'open' or
+            'half_open'
+        """
+        failed = status_code is None or status_code >= 500
+        with self.lock, self.file_lock:
+            state = self.load()
+            if not failed:
+                if state['state'] == 'half_open' and status_code >= 400:
+                    state['probe_started_at'] = 0
+                    self.save(state)
+                elif state['state'] != 'closed' or state['failures'] > 0:
+                    state.update({'state': 'closed', 'failures': 0})
+                    self.save(state)
+                return state['state']
+            state['failures'] += 1
+            if state['state'] == 'half_open' or state['failures'] >= self.failure_threshold:
+                state['state'] = 'open'
+                state['open_until'] = time.time() + self.open_time
+            self.save(state)
+            return state['state']
+
+    def is_open(self):
+        """
+        Check whether the circuit is open (or being probed by another input),
+        so that no requests should be made
+
+        Returns
+        -------
+        bool
+            True, if no requests should be made to the instance
+        """
+        return self.get_state() != 'closed'
+
+class FingerprintStore(object):
+    """
+    Fingerprints of the records written as events by an input, kept in a
+    SQLite database on disk and keyed by the ID of each record, so that only
+    the records which are new or changed since they were last written are
+    written again. The fingerprint of a record is the hash of its JSON with
+    the keys sorted. Records which are no longer returned by the instance can
+    be found as the records not seen since the store was opened.
+
+    Arguments
+    ---------
+    path: str
+        Path of the SQLite database
+    """
+
+    # Number of IDs to look up the fingerprints for in a single query, within
+    # the limit of SQLite on the number of parameters per query
+    LOOKUP_BATCH_SIZE = 500
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fingerprints "
+                                "(id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, last_seen REAL NOT NULL)")
+        self.connection.commit()
+        self.open_time = time.time()
+
+    @staticmethod
+    def get_fingerprint(record):
+        """
+        Get the fingerprint of a record
+
+        Arguments
+        ---------
+        record: dict
+            Record obtained from a page
+
+        Returns
+        -------
+        str
+            Hash of the JSON of the record with the keys sorted
+        """
+        record_json = JSON_BACKEND.dumps(record, sort_keys=True)
+        return hashlib.sha1(record_json.encode('utf-8')).hexdigest()
+
+    def filter_changed(self, records):
+        """
+        Get the records which are new or changed since they were last written,
+        and mark all the records as seen. The fingerprints are only saved on
+        commit(), once the records have been written.
+
+        Arguments
+        ---------
+        records: list
+            Records obtained from a page, with the ID in their node (eg assets,
+            exposures) or in the record itself. Records without an ID are
+            always taken as changed.
+
+        Returns
+        -------
+        list
+            Records which are new or changed
+        """
+        fingerprints = collections.OrderedDict()
+        changed_records = []
+        for record in records:
+            node = record.get('node', record) if isinstance(record, dict) else None
+            if not isinstance(node, dict) or node.get('id') is None:
+                changed_records.append(record)
+                continue
+            fingerprints[str(node['id'])] = (record, self.get_fingerprint(record))
+
+        record_ids = list(fingerprints)
+        known_fingerprints = {}
+        for i in range(0, len(record_ids), self.LOOKUP_BATCH_SIZE):
+            batch_ids = record_ids[i:i + self.LOOKUP_BATCH_SIZE]
+            rows = self.connection.execute("SELECT id, fingerprint FROM fingerprints WHERE id IN ({})".format(
+                                           ",".join("?" * len(batch_ids))), batch_ids)
+            known_fingerprints.update(rows)
+
+        for record_id, (record, fingerprint) in fingerprints.items():
+            if known_fingerprints.get(record_id) != fingerprint:
+                changed_records.append(record)
+        self.connection.executemany("INSERT OR REPLACE INTO fingerprints (id, fingerprint, last_seen) VALUES (?, ?, ?)",
+                                    [(record_id, fingerprint, self.open_time)
+                                     for record_id, (_, fingerprint) in fingerprints.items()])
+        return changed_records
+
+    def commit(self):
+        """
+        Save the fingerprints of the records filtered since the last commit
+        """
+        self.connection.commit()
+
+    def get_unseen_ids(self):
+        """
+        Get the IDs of the records not seen since the store was opened
+
+        Returns
+        -------
+        list
+            IDs of the records not seen
+        """
+        rows = self.connection.execute("SELECT id FROM fingerprints WHERE last_seen < ? ORDER BY id",
+                                       (self.open_time,))
+        return [row[0] for row in rows]
+
+    def forget_unseen(self):
+        """
+        Remove the fingerprints of the records not seen since the store was
+        opened, once they have been written as deleted
+        """
+        self.connection.execute("DELETE FROM fingerprints WHERE last_seen < ?", (self.open_time,))
+        self.connection.commit()
+
+    def close(self):
+        """
+        Close the database, discarding the fingerprints not committed
+        """
+        self.connection.close()
+
+class RedactedParams(object):
+    """
+    Parameters to format a log message with, giving the secrets as redacted
+
+    Arguments
+    ---------
+    params: dict
+        Parameters to substitute in the message
+    """
+    def __init__(self, params):
+        self.params = params
+
+    def __getitem__(self, key):
+        if key in SECRET_PARAMS:
+            return REDACTED
+        return self.params[key]
+
+"""Severity of the log level of the add-on, read once per collection run on first use"""
+_log_level = None
+
+"""Number of sampled messages logged so far in the collection run, per kind"""
+_log_samples = collections.Counter()
+_log_lock = threading.Lock()
+
+def reset_log_state():
+    """
+    Forget the log level read and the sampled messages counted, at the start
+    of each collection run. An input in single instance mode runs in the same
+    process for many intervals, so the log level is read again (eg after it is
+    changed in the add-on settings) and the first messages of each kind are
+    all written again in each interval.
+    """
+    global _log_level
+    with _log_lock:
+        _log_level = None
+        _log_samples.clear()
+
+def is_log_enabled(helper, level):
+    """
+    Check whether messages of a log level are written to the internal log,
+    reading the log level of the add-on once per collection run
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    level: str
+        Log level eg 'DEBUG', 'INFO'
+
+    Returns
+    -------
+    bool
+        True, if messages of the log level are written
+    """
+    global _log_level
+    if _log_level is None:
+        _log_level = LOG_LEVELS.get(str(helper.get_log_level()).upper(), LOG_LEVELS['INFO'])
+    return LOG_LEVELS[level] >= _log_level
+
+def is_sampled_out(sample):
+    """
+    Count a sampled message, checking whether it should be dropped. The first
+    messages of a kind are all written, and one in LOG_SAMPLE_RATE after that.
+
+    Arguments
+    ---------
+    sample: str
+        Kind of the message eg 'assetgroup_values'
+
+    Returns
+    -------
+    bool
+        True, if the message should not be written
+    """
+    with _log_lock:
+        _log_samples[sample] += 1
+        count = _log_samples[sample]
+    return count > LOG_SAMPLE_FIRST and (count - LOG_SAMPLE_FIRST) % LOG_SAMPLE_RATE != 0
+
+def log(helper, level, all_params, msg, format_params=True, sample=None):
+    """
+    Write a message to the internal log, only building and formatting it if
+    the log level is enabled, with the secrets in the parameters redacted
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    level: str
+        Log level eg 'DEBUG', 'INFO'
+    all_params: dict
+        Parameters to substitute in the message to print
+    msg: str
+        Message to print to the internal log, or a function returning it for
+        messages which are costly to build eg a whole response
+    format_params: bool
+        Format the parameters out in the original message
+    sample: str
+        Kind of the message, for messages logged many times over eg per record
+        to be sampled, or None to write every message
+    """
+    if not is_log_enabled(helper, level):
+        return
+    if sample is not None and is_sampled_out(sample):
+        return
+    if callable(msg):
+        msg = msg()
+    if format_params:
+        msg = msg.format_map(RedactedParams(all_params))
+    if len(msg) > MAX_LOG_MESSAGE_CHARS:
+        msg = msg[:MAX_LOG_MESSAGE_CHARS] + "...(truncated)"
+
+    # Secrets may also be found in messages which are not formatted eg errors
+    for param in SECRET_PARAMS:
+        secret = all_params.get(param)
+        if secret:
+            msg = msg.replace(secret, REDACTED)
+    getattr(helper, "log_" + level.lower())("{}:{}: {}".format(LOG_PREFIX, level, msg))
+
+def get_state_dir():
+    """
+    Get the directory to keep the state shared by all the inputs in, creating
+    it if needed
+
+    Returns
+    -------
+    str
+        Directory under the modular inputs directory of Splunk, or the temp
+        directory when not running under Splunk
+    """
+    splunk_home = os.environ.get('SPLUNK_HOME')
+    if splunk_home:
+        state_dir = os.path.join(splunk_home, 'var', 'lib', 'splunk', 'modinputs', 'assetnote')
+    else:
+        state_dir = os.path.join(tempfile.gettempdir(), 'assetnote')
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    return state_dir
+
+def create_circuit_breaker(helper, all_params):
+    """
+    Create the circuit breaker for the instance from the modular input
+    arguments, falling back to defaults for arguments which are not defined
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the instance
+
+    Returns
+    -------
+    CircuitBreaker
+        Circuit breaker shared by all the inputs for the instance
+    """
+    state_file = os.path.join(get_state_dir(), CIRCUIT_BREAKER_FILE_TEMPLATE.format(**all_params))
+    return CircuitBreaker(state_file,
+                          failure_threshold=int(helper.get_arg('circuit_breaker_failure_threshold') or 5),
+                          open_time=float(helper.get_arg('circuit_breaker_open_time') or 600))
+
+def create_fingerprint_store(helper, all_params):
+    """
+    Open the fingerprint store of the input, if unchanged records are to be
+    suppressed
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the instance and the source
+
+    Returns
+    -------
+    FingerprintStore
+        Fingerprints of the records written by the input, or None if all the
+        records are to be written
+    """
+    if not is_enabled(helper.get_arg('suppress_unchanged_records'), default=False):
+        return None
+    path = os.path.join(get_state_dir(), FINGERPRINT_STORE_FILE_TEMPLATE.format(**all_params))
+    return FingerprintStore(path)
+
+def check_circuit_breaker(helper, all_params, rate_limiter, circuit_breaker):
+    """
+    Check whether the instance can be collected from before starting a
+    collection, probing the instance with a cheap query if the circuit breaker
+    has been open for its open time
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the instance and the API key
+    rate_limiter: RateLimiter
+        Rate limiter for the requests made by the input
+    circuit_breaker: CircuitBreaker
+        Circuit breaker shared by all the inputs for the instance
+
+    Returns
+    -------
+    bool
+        True, if the collection can go ahead
+    """
+    allowed = circuit_breaker.allow_request()
+    if allowed == 'closed':
+        return True
+    if allowed is None:
+        log(helper, 'INFO', all_params,
+            "Circuit breaker open for instance: {assetnote_instance}, skipping collection...")
+        return False
+    log(helper, 'INFO', all_params,
+        "Probing instance: {assetnote_instance} as the circuit breaker is half-open...")
+
+    # The outcome of the probe is recorded here rather than by the request, to
+    # act on the state the circuit breaker actually recorded
+    try:
+        resp = send_graphql_request(helper, all_params, PROBE_GRAPHQL_QUERY, rate_limiter)
+        status_code = resp.status_code
+        resp.close()
+    except Exception:
+        status_code = None
+    state = circuit_breaker.record_response(status_code)
+    if state == 'closed':
+        log(helper, 'INFO', all_params,
+            "Probe of instance: {assetnote_instance} succeeded, circuit breaker closed...")
+        return True
+    if state == 'half_open':
+        log(helper, 'INFO', all_params,
+            lambda: "Probe of instance: {} returned HTTP {}, circuit breaker still half-open, skipping "
+                    "collection...".format(all_params['assetnote_instance'], status_code),
+            format_params=False)
+        return False
+    log(helper, 'INFO', all_params,
+        "Probe of instance: {assetnote_instance} failed, circuit breaker opened again, skipping collection...")
+    return False
+
+def create_dead_letter_queue(helper, all_params):
+    """
+    Create the dead-letter queue for an input from the modular input
+    arguments, falling back to defaults for arguments which are not defined
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the instance and the input type
+
+    Returns
+    -------
+    DeadLetterQueue
+        Dead-letter queue for the pages of the input
+    """
+    key = DEAD_LETTER_CHECKPOINT_KEY_TEMPLATE.format(**all_params)
+    return DeadLetterQueue(helper, key,
+                           replay_budget=int(helper.get_arg('dead_letter_replay_budget') or 50),
+                           max_replays=int(helper.get_arg('dead_letter_max_replays') or 5))
+
+def get_proxies(helper):
+    """
+    Get the proxies to send the requests through from the proxy configuration
+    of the add-on
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+
+    Returns
+    -------
+    dict
+        Proxies for both http and https, as given to requests, or None if no
+        proxy is configured
+    """
+    proxy = helper.get_proxy()
+    if not proxy or not proxy.get('proxy_url') or not is_enabled(proxy.get('proxy_enabled')):
+        return None
+    proxy_type = proxy.get('proxy_type') or 'http'
+    if is_enabled(proxy.get('proxy_rdns'), default=False):
+        proxy_type = {'socks4': 'socks4a', 'socks5': 'socks5h'}.get(proxy_type, proxy_type)
+    credentials = ""
+    if proxy.get('proxy_username'):
+        credentials = "{}:{}@".format(quote(proxy['proxy_username'], safe=''),
+                                      quote(proxy.get('proxy_password') or '', safe=''))
+    proxy_uri = "{}://{}{}".format(proxy_type, credentials, proxy['proxy_url'])
+    if proxy.get('proxy_port'):
+        proxy_uri += ":{}".format(proxy['proxy_port'])
+    return {'http': proxy_uri, 'https': proxy_uri}
+
+"""Transport shared by all the collections in the process, created on first use"""
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport(helper):
+    """
+    Get the transport shared by all the collections in the process, creating
+    it with the proxy configuration of the add-on on first use
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+
+    Returns
+    -------
+    Transport
+        Transport for the requests to the Assetnote GraphQL API
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport(get_proxies(helper))
+        return _transport
+
+def get_transport_options(helper):
+    """
+    Get the timeouts of the requests, whether pages are read as a stream and
+    whether queries are persisted from the modular input arguments, falling
+    back to defaults for arguments which are not defined
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+
+    Returns
+    -------
+    dict
+        Transport options to add to the input parameters
+    """
+    return {'connect_timeout': float(helper.get_arg('connect_timeout') or 10),
+            'read_timeout': float(helper.get_arg('read_timeout') or 120),
+            'stream_pages': is_enabled(helper.get_arg('stream_pages'), default=False),
+            'persisted_queries': is_enabled(helper.get_arg('persisted_queries'), default=False)}
+
+def send_graphql_request(helper, all_params, graphql_query, rate_limiter, circuit_breaker=None,
+                         stream=False, variables=None):
+    """
+    Send a GraphQL query to the Assetnote GraphQL API through the transport
+    once the rate limiter allows, recording the outcome with the rate limiter
+    and circuit breaker. In the persisted query mode, a compiled query is
+    sent by its hash once the instance has been sent its document, and sent
+    again with its document if the instance does not know the hash. Pages
+    read as a stream are always sent with the document, as the response
+    cannot be checked for an unknown hash before it is read.
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the instance, the API key, the timeouts and
+        whether queries are persisted
+    graphql_query: GraphQLQuery or str
+        GraphQL query compiled once, or built for the request
+    rate_limiter: RateLimiter
+        Rate limiter for the requests made by the input
+    circuit_breaker: CircuitBreaker
+        Circuit breaker to record the outcome of the request with, if any
+    stream: bool
+        If True, the body of the response is left to be read as a stream
+    variables: dict
+        Values of the variables of the query, if any
+
+    Returns
+    -------
+    requests.Response
+        Response to the query. Exceptions raised when sending the query (eg
+        connection errors) are raised again after being recorded.
+    """
+    headers = {
+        "X-ASSETNOTE-API-KEY": "{assetnote_api_key}".format(**all_params)
+    }
+    url = GRAPHQL_URL_TEMPLATE.format(**all_params)
+    persisted = all_params.get('persisted_queries', False) and not stream and \
+                isinstance(graphql_query, GraphQLQuery)
+    transport = get_transport(helper)
+    while True:
+        if isinstance(graphql_query, GraphQLQuery):
+            payload = graphql_query.get_payload(url, variables, persisted)
+        else:
+            payload = dict(query=graphql_query)
+        request_time = rate_limiter.wait()
+        try:
+            resp = transport.post(url,
+                                  payload=payload,
+                                  headers=headers,
+                                  timeout=(all_params['connect_timeout'], all_params['read_timeout']),
+                                  stream=stream)
+        except Exception:
+            if circuit_breaker is not None:
+                circuit_breaker.record_response(None)
+            raise
+        if rate_limiter.record_response(resp.status_code, resp.headers, request_time):
+            log(helper, 'INFO', all_params,
+                lambda: "Instance under pressure, slowing down to {:.2f} requests/s...".format(rate_limiter.rate),
+                format_params=False)
+        if circuit_breaker is not None:
+            circuit_breaker.record_response(resp.status_code)
+        log(helper, 'DEBUG', all_params,
+            lambda: "Request returned HTTP {} in {:.3f}s, headers after {:.3f}s ({} requests in {:.2f}s "
+                    "so far)...".format(resp.status_code, resp.total_time, resp.elapsed.total_seconds(),
+                                        transport.num_requests, transport.total_time),
+            format_params=False)
+        if not persisted or not graphql_query.record_response(url, payload, resp.status_code, resp.content):
+            return resp
+        log(helper, 'DEBUG', all_params,
+            "Instance: {assetnote_instance} did not know the persisted query, sending it again with the document...")
+
+def request_page(helper, all_params, graphql_query, rate_limiter, circuit_breaker=None,
+                 variables=None):
+    """
+    Request a single page from the Assetnote GraphQL API, without retrying
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the instance and the API key
+    graphql_query: GraphQLQuery or str
+        GraphQL query for the page
+    rate_limiter: RateLimiter
+        Rate limiter for the requests made by the input
+    circuit_breaker: CircuitBreaker
+        Circuit breaker to record the outcome of the request with, if any
+    variables: dict
+        Values of the variables of the query which select the page, if any
+
+    Returns
+    -------
+    dict
+        JSON response for the page, or None if the page could not be obtained
+    """
+    try:
+        resp = send_graphql_request(helper, all_params, graphql_query, rate_limiter,
+                                    circuit_breaker, variables=variables)
+        if resp.status_code != 200:
+            return None
+        resp_json = JSON_BACKEND.loads(resp.content)
+    except Exception:
+        return None
+    if 'errors' in resp_json or not resp_json.get('data'):
+        return None
+    return resp_json
+
+def iter_response_text(resp):
+    """
+    Read the body of a response streamed in chunks, as text
+
+    Arguments
+    ---------
+    resp: requests.Response
+        Response sent with stream=True
+
+    Returns
+    -------
+    generator
+        Text of the body, in chunks
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+def write_streamed_page(helper, ew, all_params, resp, collection, fingerprint_store=None):
+    """
+    Read a page of records as a stream, writing the records as events as
+    they are parsed, in batches, rather than once the whole page is read.
+    Records before the offset (or already written from the page, when
+    paginating by cursor) are dropped, so that a page which broke off midway
+    can be requested again without writing any record twice.
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    ew: EventWriter
+        Event writer to write the events with
+    all_params: dict
+        Parameters including the pagination mode, the offset, the page count
+        and the number of records already written from the page
+    resp: requests.Response
+        Response for the page, sent with stream=True
+    collection: str
+        Collection the page belongs to eg 'assets', 'exposures'
+    fingerprint_store: FingerprintStore
+        Fingerprints of the records written, to only write the records which
+        are new or changed (if any)
+
+    Returns
+    -------
+    dict
+        JSON response for the page, with its records left out
+    """
+    start_time = time.monotonic()
+    if all_params['pagination_mode'] == 'cursor':
+        items_to_skip = all_params['streamed_on_page']
+    else:
+        items_to_skip = all_params['offset'] % all_params['page_count']
+
+    def write_batch(records):
+        track_high_water_mark(all_params, records)
+        all_params['offset'] += len(records)
+        all_params['streamed_on_page'] += len(records)
+        if fingerprint_store is not None:
+            records = fingerprint_store.filter_changed(records)
+        for new_event in create_events(helper, all_params, records):
+            ew.write_event(new_event)
+        if fingerprint_store is not None:
+            fingerprint_store.commit()
+
+    parser = StreamingJSONParser(('data', collection, 'edges'))
+    records = []
+    try:
+        for record in parser.parse(iter_response_text(resp)):
+            if items_to_skip > 0:
+                items_to_skip -= 1
+                continue
+            records.append(record)
+            if len(records) >= STREAMED_RECORDS_PER_BATCH:
+                batch, records = records, []
+                write_batch(batch)
+    finally:
+        resp.close()
+        if records:
+            write_batch(records)
+    resp.total_time += time.monotonic() - start_time
+    return parser.header
+
+def find_raw_value_end(content, pos):
+    """
+    Find the end of the JSON object or array starting at a position in raw
+    JSON, by matching its brackets without decoding it. Values nested up to
+    RAW_VALUE_MAX_DEPTH levels deep are matched in a single step, and deeper
+    ones bracket by bracket.
+
+    Arguments
+    ---------
+    content: bytes
+        Raw JSON
+    pos: int
+        Position of the opening bracket
+
+    Returns
+    -------
+    int
+        Position after the closing bracket, or None if the value is not an
+        object or array, or does not end
+    """
+    if content[pos:pos + 1] not in (b'{', b'['):
+        return None
+    match = RAW_VALUE_PATTERN.match(content, pos)
+    if match is not None:
+        return match.end()
+    depth = 0
+    while True:
+        match = RAW_BRACKET_PATTERN.match(content, pos)
+        if match is None:
+            return None
+        pos = match.end()
+        if match.group(1) in (b'{', b'['):
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return pos
+
+def split_raw_page(content, collection):
+    """
+    Split the raw JSON of a page response into the records of the page,
+    located by their byte span and left as raw JSON, and the rest of the
+    response (the header), which is decoded. The records are slices of the
+    response (memoryview) rather than copies, and are not decoded. If the
+    records cannot be located, the whole response is decoded instead.
+
+    Arguments
+    ---------
+    content: bytes
+        Raw JSON of the response
+    collection: str
+        Collection the page belongs to eg 'assets', 'exposures'
+
+    Returns
+    -------
+    tuple
+        JSON response for the page (with its records left out) and the raw
+        JSON of each record, or the JSON response and None if the records
+        could not be located
+    """
+    view = memoryview(content)
+    records = []
+    match = RAW_EDGES_KEY_PATTERN.search(content)
+    if match is not None:
+        edges_start = match.end() - 1
+        pos = RAW_WHITESPACE_PATTERN.match(content, match.end()).end()
+        edges_end = None
+        if content[pos:pos + 1] == b']':
+            edges_end = pos + 1
+        while edges_end is None:
+            end = find_raw_value_end(content, pos)
+            if end is None:
+                break
+            records.append(view[pos:end])
+            pos = RAW_WHITESPACE_PATTERN.match(content, end).end()
+            separator = content[pos:pos + 1]
+            if separator == b']':
+                edges_end = pos + 1
+            elif separator != b',':
+                break
+            pos = RAW_WHITESPACE_PATTERN.match(content, pos + 1).end()
+
+        # The array found must be the records of the page, left empty in the
+        # header, rather than an array of the same name elsewhere
+        if edges_end is not None:
+            try:
+                header = JSON_BACKEND.loads(content[:edges_start] + b'[]' + content[edges_end:])
+                if header['data'][collection]['edges'] == []:
+                    return header, records
+            except (ValueError, KeyError, TypeError):
+                pass
+    return JSON_BACKEND.loads(content), None
+
+def is_enabled(value, default=True):
+    """
+    Parse a checkbox/boolean modular input argument
+
+    Arguments
+    ---------
+    value: str
+        Value of the argument, or None if the argument is not defined
+    default: bool
+        Value to use if the argument is not defined
+
+    Returns
+    -------
+    bool
+        True, if the argument is enabled
+    """
+    if value is None or str(value).strip() == '':
+        return default
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y', 'on')
+
+def get_page_size_options(helper):
+    """
+    Get the options for adapting the page size from the modular input
+    arguments, falling back to defaults for arguments which are not defined.
+    The page size is only adapted if enabled, so that existing inputs keep
+    their fixed page size.
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+
+    Returns
+    -------
+    dict
+        Page size options to add to the input parameters
+    """
+    return {'adaptive_page_size': is_enabled(helper.get_arg('adaptive_page_size'), default=False),
+            'min_page_count': int(helper.get_arg('min_page_count') or 5),
+            'max_page_count': int(helper.get_arg('max_page_count') or 200),
+            'target_page_latency': float(helper.get_arg('target_page_latency') or 10)}
+
+def create_page_size_controller(helper, all_params, query_type, default_page_size):
+    """
+    Create the page size controller for a query type, starting from the page
+    size learned in a previous run of the input (if any)
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the instance and the page size options
+    query_type: str
+        Query the page size applies to eg 'assets', 'exposures', 'ipRanges'
+    default_page_size: int
+        Page size to start with, if no page size was learned yet
+
+    Returns
+    -------
+    PageSizeController
+        Page size controller for the query type
+    """
+    learned_page_size = None
+    if all_params['adaptive_page_size']:
+        key = PAGE_SIZE_CHECKPOINT_KEY_TEMPLATE.format(**dict(all_params, query_type=query_type))
+        learned_page_size = helper.get_check_point(key)
+    return PageSizeController(int(learned_page_size or default_page_size),
+                              min_page_size=all_params['min_page_count'],
+                              max_page_size=all_params['max_page_count'],
+                              target_latency=all_params['target_page_latency'],
+                              adaptive=all_params['adaptive_page_size'])
+
+def save_learned_page_size(helper, all_params, query_type, page_size_controller):
+    """
+    Save the page size learned in this run of the input, for the next run to
+    start with
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the instance
+    query_type: str
+        Query the page size applies to eg 'assets', 'exposures', 'ipRanges'
+    page_size_controller: PageSizeController
+        Page size controller for the query type
+    """
+    if page_size_controller.adaptive and page_size_controller.learned_page_size:
+        key = PAGE_SIZE_CHECKPOINT_KEY_TEMPLATE.format(**dict(all_params, query_type=query_type))
+        helper.save_check_point(key, page_size_controller.learned_page_size)
+
+def create_rate_limiter(helper):
+    """
+    Create the rate limiter for an input from the modular input arguments,
+    falling back to defaults for arguments which are not defined
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+
+    Returns
+    -------
+    RateLimiter
+        Rate limiter for the requests made by the input
+    """
+    return RateLimiter(float(helper.get_arg('max_requests_per_second') or 0),
+                       float(helper.get_arg('min_requests_per_second') or 0.1))
+
+def get_event_options(helper):
+    """
+    Get the options for writing the events from the modular input arguments,
+    falling back to defaults for arguments which are not defined
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+
+    Returns
+    -------
+    dict
+        Event options to add to the input parameters
+    """
+    return {'event_mode': (helper.get_arg('event_mode') or 'page').strip().lower(),
+            'max_event_bytes': int(helper.get_arg('max_event_bytes') or MAX_EVENT_BYTES),
+            'raw_passthrough': is_enabled(helper.get_arg('raw_passthrough'), default=False)}
+
+def get_last_updated(record):
+    """
+    Get the 'lastUpdated' field of a record, kept either in the node of the
+    record (eg assets, exposures) or the record itself
+
+    Arguments
+    ---------
+    record: dict
+        Record obtained from a page, or its raw JSON (memoryview)
+
+    Returns
+    -------
+    str
+        'lastUpdated' of the record, or None if the record has none
+    """
+    if isinstance(record, memoryview):
+        match = RAW_LAST_UPDATED_PATTERN.search(record)
+        return match.group(1).decode('utf-8') if match else None
+    if not isinstance(record, dict):
+        return None
+    node = record.get('node', record)
+    if not isinstance(node, dict):
+        return None
+    return node.get('lastUpdated')
+
+def get_event_time(record):
+    """
+    Get the time of a record from its 'lastUpdated' field
+
+    Arguments
+    ---------
+    record: dict
+        Record obtained from a page, or its raw JSON (memoryview)
+
+    Returns
+    -------
+    float
+        Time of the record as seconds since the epoch, or None if the record
+        has no 'lastUpdated' field which can be parsed
+    """
+    return parse_time(get_last_updated(record))
+
+def serialize_record(record):
+    """
+    Serialize a record without any whitespace, or decode its raw JSON as is
+
+    Arguments
+    ---------
+    record: dict
+        Record obtained from a page, or its raw JSON (memoryview)
+
+    Returns
+    -------
+    str
+        JSON of the record
+    """
+    if isinstance(record, memoryview):
+        return str(record, 'utf-8')
+    return JSON_BACKEND.dumps(record)
+
+def parse_time(value):
+    """
+    Parse an ISO 8601 time returned by the Assetnote API, taken as UTC if it
+    has no timezone
+
+    Arguments
+    ---------
+    value: str
+        Time to parse eg '2024-01-01T00:00:00Z'
+
+    Returns
+    -------
+    float
+        Time as seconds since the epoch, or None if it cannot be parsed
+    """
+    if not value:
+        return None
+    try:
+        parsed_time = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed_time.tzinfo is None:
+        parsed_time = parsed_time.replace(tzinfo=datetime.timezone.utc)
+    return parsed_time.timestamp()
+
+def create_events(helper, all_params, records, page_fields=None, values_field=None,
+                  value_field=None):
+    """
+    Create the events for the records obtained from a page, serialized without
+    any whitespace (records still in raw JSON are written as is). In 'record'
+    mode, each record is an event of its own. In
+    'page' mode, the records are packed into as few events as fit within the
+    maximum event size. Each event is timed by the 'lastUpdated' field of its
+    record (the latest one, in 'page' mode), or the time it is indexed at if
+    there is none.
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the index, sourcetype, source and event options
+    records: list
+        Records obtained from the page eg the edges of the assets on the page,
+        decoded or as raw JSON (memoryview)
+    page_fields: dict
+        Fields to add to each event alongside the records (eg the asset group
+        ID and name), if any. The records are then added to the event under
+        'values_field' in 'page' mode, or 'value_field' in 'record' mode.
+    values_field: str
+        Field of a 'page' mode event to add the records under eg 'ip_ranges'
+    value_field: str
+        Field of a 'record' mode event to add the record under eg 'ip_range'
+
+    Returns
+    -------
+    list
+        Events to write
+    """
+    max_event_bytes = all_params['max_event_bytes']
+    events_data = []
+    if all_params['event_mode'] == 'page':
+        if page_fields is None:
+            prefix, suffix = '[', ']'
+        else:
+            # Records are added to the last field of the event, so the event
+            # can be built around the serialized records
+            page_json = JSON_BACKEND.dumps(dict(page_fields, **{values_field: []}))
+            prefix, suffix = page_json[:-2], page_json[-2:]
+        record_jsons = []
+        event_time = None
+        event_bytes = len(prefix) + len(suffix)
+        for record in records:
+            record_json = serialize_record(record)
+            if record_jsons and event_bytes + len(record_json) + 1 > max_event_bytes:
+                events_data.append((prefix + ",".join(record_jsons) + suffix, event_time))
+                record_jsons = []
+                event_time = None
+                event_bytes = len(prefix) + len(suffix)
+            record_jsons.append(record_json)
+            event_bytes += len(record_json) + 1
+            record_time = get_event_time(record)
+            if record_time is not None and (event_time is None or record_time > event_time):
+                event_time = record_time
+        if record_jsons or not events_data:
+            events_data.append((prefix + ",".join(record_jsons) + suffix, event_time))
+    else:
+        for record in records:
+            event_record = record
+            if page_fields is not None:
+                event_record = dict(page_fields)
+                event_record[value_field] = record
+            events_data.append((serialize_record(event_record), get_event_time(record)))
+
+    events = []
+    for event_data, event_time in events_data:
+        if len(event_data) > max_event_bytes:
+            log(helper, 'INFO', all_params,
+                lambda: "Writing a single record as an event of {} bytes, which is larger than "
+                        "max_event_bytes: {}...".format(len(event_data), max_event_bytes),
+                format_params=False, sample='oversized_event')
+        events.append(helper.new_event(event_data,
+                                       time=event_time,
+                                       index=all_params['assetnote_index'],
+                                       sourcetype=all_params['assetnote_sourcetype'],
+                                       source=all_params['assetnote_source']))
+    return events
+
+def start_collection(helper, all_params, full_collection_arguments):
+    """
+    Decide whether to collect all the records, or only the records updated
+    since the high-water mark of the previous collection. All the records are
+    collected unless the incremental mode is enabled, and even then, on the
+    first collection and once the full collection interval has passed since
+    the last full collection (to reconcile any records missed).
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the instance and the source. The collection
+        mode, the high-water mark and the GraphQL arguments to place before
+        the 'count' argument in the query are added to it.
+    full_collection_arguments: str
+        GraphQL arguments to collect all the records with eg the sort order
+    """
+    all_params['incremental_mode'] = is_enabled(helper.get_arg('incremental_mode'), default=False)
+    all_params['full_collection_interval'] = float(helper.get_arg('full_collection_interval') or
+                                                   FULL_COLLECTION_INTERVAL)
+    checkpoint = {}
+    if all_params['incremental_mode']:
+        checkpoint = helper.get_check_point(COLLECTION_CHECKPOINT_KEY_TEMPLATE.format(**all_params)) or {}
+    all_params['high_water_mark'] = checkpoint.get('high_water_mark')
+    all_params['last_full_collection'] = checkpoint.get('last_full_collection') or 0
+    all_params['latest_updated'] = None
+    all_params['latest_updated_time'] = None
+    all_params['collection_complete'] = False
+
+    if all_params['incremental_mode'] and all_params['high_water_mark'] and \
+       time.time() - all_params['last_full_collection'] < all_params['full_collection_interval']:
+        all_params['collection_mode'] = 'incremental'
+        all_params['high_water_mark_json'] = json.dumps(all_params['high_water_mark'])
+        all_params['collection_arguments'] = INCREMENTAL_COLLECTION_ARGUMENTS_TEMPLATE.format(**all_params)
+        log(helper, 'INFO', all_params,
+            "Collecting records updated since: {high_water_mark} for instance: {assetnote_instance}...")
+    else:
+        all_params['collection_mode'] = 'full'
+        all_params['collection_arguments'] = full_collection_arguments
+        log(helper, 'INFO', all_params,
+            "Collecting all records for instance: {assetnote_instance}...")
+
+def track_high_water_mark(all_params, records):
+    """
+    Keep the latest 'lastUpdated' of the records collected so far
+
+    Arguments
+    ---------
+    all_params: dict
+        Parameters including the latest 'lastUpdated' so far
+    records: list
+        Records obtained from a page, decoded or as raw JSON (memoryview)
+    """
+    for record in records:
+        last_updated = get_last_updated(record)
+        record_time = parse_time(last_updated)
+        if record_time is not None and (all_params['latest_updated_time'] is None or
+                                        record_time > all_params['latest_updated_time']):
+            all_params['latest_updated'] = last_updated
+            all_params['latest_updated_time'] = record_time
+
+def finish_collection(helper, all_params):
+    """
+    Save the high-water mark for the next collection to request the records
+    updated since, when collecting incrementally. As records are requested
+    oldest first in the incremental mode, the high-water mark moves forward
+    even if the collection stopped early - the collection stops at the first
+    page which could not be obtained, so the high-water mark never moves past
+    it. In the full mode, records are not
+    ordered by 'lastUpdated', so the high-water mark (and the time of the
+    full collection) is only saved once all the pages have been requested.
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters including the collection mode, the high-water mark and
+        the latest 'lastUpdated' of the records collected
+    """
+    if not all_params['incremental_mode']:
+        return
+    checkpoint = {'high_water_mark': all_params['high_water_mark'],
+                  'last_full_collection': all_params['last_full_collection']}
+    if all_params['latest_updated'] is not None and \
+       (parse_time(checkpoint['high_water_mark']) or 0) < all_params['latest_updated_time']:
+        checkpoint['high_water_mark'] = all_params['latest_updated']
+    if all_params['collection_mode'] == 'full':
+        if not all_params['collection_complete']:
+            log(helper, 'INFO', all_params,
+                "Not saving the high-water mark as the full collection for instance: {assetnote_instance} "
+                "stopped early...")
+            return
+        checkpoint['last_full_collection'] = time.time()
+    log(helper, 'INFO', dict(all_params, new_high_water_mark=checkpoint['high_water_mark']),
+        "Saving the high-water mark: {new_high_water_mark} for instance: {assetnote_instance}...")
+    helper.save_check_point(COLLECTION_CHECKPOINT_KEY_TEMPLATE.format(**all_params), checkpoint)
+
+def write_deleted_records(helper, ew, all_params, fingerprint_store):
+    """
+    Write the records no longer returned by the instance as deleted, with
+    only their ID and 'deleted' in their node, and forget their fingerprints.
+    Records are only taken as deleted after a full collection which obtained
+    all its pages, as records may have been missed rather than deleted
+    otherwise.
+
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    ew: EventWriter
+        Event writer to write the events with
+    all_params: dict
+        Parameters including the collection mode, whether the collection
+        completed and the number of pages which failed
+    fingerprint_store: FingerprintStore
+        Fingerprints of the records written by the input
+    """
+    if all_params['collection_mode'] != 'full' or not all_params['collection_complete'] or \
+       all_params['num_failed_pages'] > 0:
+        return
+    deleted_records = [{'node': {'id': record_id, 'deleted': True}}
+                       for record_id in fingerprint_store.get_unseen_ids()]
+    log(helper, 'INFO', dict(all_params, num_deleted_records=len(deleted_records)),
+        "Writing {num_deleted_records} records deleted since the previous collection for instance: "
+        "{assetnote_instance} as events...")
+    for new_event in create_events(helper, all_params, deleted_records):
+        ew.write_event(new_event)
+    fingerprint_store.forget_unseen()
@@ -6,17 +6,44 @@ import sys
 import time
 import datetime
 
+from assetnote_common import JSON_BACKEND
+from assetnote_common import MAX_CONSECUTIVE_FAILED_PAGES
+from assetnote_common import check_circuit_breaker
+from assetnote_common import create_circuit_breaker
+from assetnote_common import create_dead_letter_queue
+from assetnote_common import create_page_size_controller
+from assetnote_common import create_events
+from assetnote_common import create_fingerprint_store
+from assetnote_common import create_rate_limiter
+from assetnote_common import finish_collection
+from assetnote_common import get_collection_query
+from assetnote_common import get_event_options
+from assetnote_common import get_page_size_options
+from assetnote_common import get_page_variables
+from assetnote_common import get_transport_options
+from assetnote_common import log
+from assetnote_common import request_page
+from assetnote_common import reset_log_state
+from assetnote_common import save_learned_page_size
+from assetnote_common import send_graphql_request
+from assetnote_common import split_raw_page
+from assetnote_common import start_collection
+from assetnote_common import track_high_water_mark
+from assetnote_common import write_deleted_records
+from assetnote_common import write_streamed_page
 
-"""Special prefix added to each log message"""
-LOG_PREFIX = "AssetNote"
 
-"""Number of exposures to load per page"""
+"""Number of exposures to load per page, until a page count is learned for the instance"""
 EXPOSURES_PER_PAGE_COUNT = 25
 
-# Graph Query templates to pull vulnerability and indicators
+"""GraphQL arguments to collect all the exposures with, in the default order"""
+EXPOSURES_FULL_COLLECTION_ARGUMENTS = ""
+
+# Graph Query templates to pull vulnerability and indicators. {collection_arguments}
+# filters the exposures, and the $count, $page and $after variables select the page
 EXPOSURES_GRAPHQL_QUERY_TEMPLATE = """
-query {{
-    exposures(count:{page_count},page:{page_num}) {{
+query Exposures($count: Int!, $page: Int, $after: String) {{
+    exposures({collection_arguments}count:$count,page:$page,after:$after) {{
         edges {{
             node {{
                 __typename,
@@ -84,10 +111,30 @@ query {{
 }}
 """
 
-def info(helper, all_params, msg, format_params=True):
+def debug(helper, all_params, msg, format_params=True, sample=None):
+    
+    """"
+    Write a debug log message, if debug messages are enabled
+    
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    all_params: dict
+        Parameters to substitute in the message to print
+    msg: str
+        Debug message to print to the internal log, or a function returning it
+    format_params: bool
+        Format the parameters out in the original message
+    sample: str
+        Kind of the message, to sample messages logged per record
+    """
+    log(helper, 'DEBUG', all_params, msg, format_params, sample)
+        
+def info(helper, all_params, msg, format_params=True, sample=None):
     
     """"
-    Write amn info log message
+    Write an info log message, if info messages are enabled
     
     Arguments
     ---------
@@ -96,15 +143,79 @@ def info(helper, all_params, msg, format_params=True):
     all_params: dict
         Parameters to substitute in the message to print
     msg: str
-        Info message to print to the internal log
+        Info message to print to the internal log, or a function returning it
     format_params: bool
         Format the parameters out in the original message
+    sample: str
+        Kind of the message, to sample messages logged per record
+    """
+    log(helper, 'INFO', all_params, msg, format_params, sample)
+        
+def replay_dead_letters(helper, ew, all_params, rate_limiter, circuit_breaker,
+                        dead_letter_queue, fingerprint_store=None):
+    
+    """"
+    Replay the pages of exposures which could not be obtained in previous
+    intervals, and write the exposures on each page obtained as an event
+    
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    ew: EventWriter
+        Event writer to write the events with
+    all_params: dict
+        Parameters including the instance, the API key and the index
+    rate_limiter: RateLimiter
+        Rate limiter for the requests made by the input
+    circuit_breaker: CircuitBreaker
+        Circuit breaker shared by all the inputs for the instance
+    dead_letter_queue: DeadLetterQueue
+        Pages which could not be obtained in previous intervals
+    fingerprint_store: FingerprintStore
+        Fingerprints of the exposures written, to only write the exposures which are new
+        or changed (if any)
     """
-    msg_to_log = LOG_PREFIX + ":INFO: " + msg
-    if format_params:
-        helper.log_debug(msg_to_log.format(**all_params))
-    else:
-        helper.log_debug(msg_to_log)
+    for entry_key, entry in dead_letter_queue.get_pages_to_replay('exposures'):
+        if circuit_breaker.is_open():
+            info(helper, all_params,
+                 "Circuit breaker open for instance: {assetnote_instance}, not replaying any more pages...")
+            return
+        replay_params = dict(all_params)
+        replay_params.update(entry)
+        replay_params['collection_arguments'] = entry.get('collection_arguments',
+                                                          EXPOSURES_FULL_COLLECTION_ARGUMENTS)
+        info(helper, replay_params,
+             "Replaying page: {page_num} for exposures which failed at: {failed_at}...")
+        resp_json = request_page(helper, replay_params,
+                                 get_collection_query(EXPOSURES_GRAPHQL_QUERY_TEMPLATE,
+                                                      replay_params['collection_arguments']),
+                                 rate_limiter, circuit_breaker,
+                                 variables=get_page_variables(replay_params))
+        removed = dead_letter_queue.record_replay(entry_key, resp_json is not None)
+        if resp_json is None:
+            if removed:
+                info(helper, replay_params,
+                     "Dropping page: {page_num} for exposures from the dead-letter queue after {replays} replays...")
+            else:
+                info(helper, replay_params,
+                     "Replay of page: {page_num} for exposures failed, replaying again in the next interval...")
+            continue
+        
+        exposures_on_page = resp_json['data']['exposures']['edges']
+        if replay_params['pagination_mode'] != 'cursor':
+            del exposures_on_page[:replay_params['offset'] % replay_params['page_count']]
+        else:
+            del exposures_on_page[:replay_params.get('streamed_on_page', 0)]
+        replay_params['exposures_count_on_page'] = len(exposures_on_page)
+        info(helper, replay_params,
+             "Writing {exposures_count_on_page} exposures replayed from page: {page_num} as events...")
+        if fingerprint_store is not None:
+            exposures_on_page = fingerprint_store.filter_changed(exposures_on_page)
+        for new_event in create_events(helper, all_params, exposures_on_page):
+            ew.write_event(new_event)
+        if fingerprint_store is not None:
+            fingerprint_store.commit()
         
 '''
     IMPORTANT
@@ -123,66 +234,169 @@ def validate_input(helper, definition):
     pass
 
 def collect_events(helper, ew):
+    reset_log_state()
+    collect_exposures(helper, ew)
+
+def collect_exposures(helper, ew, rate_limiter=None, circuit_breaker=None):
+    
+    """"
+    Collect the exposures for the instance, and write them as events
+    
+    Arguments
+    ---------
+    helper: helper
+        Helper for splunk
+    ew: EventWriter
+        Event writer to write the events with
+    rate_limiter: RateLimiter
+        Rate limiter shared with the other collections for the instance, or
+        None to create one for the input
+    circuit_breaker: CircuitBreaker
+        Circuit breaker shared with the other collections for the instance, or
+        None to create one for the input
+    """
     opt_assetnote_api_key = helper.get_arg('assetnote_api_key')
     opt_assetnote_instance = helper.get_arg('assetnote_instance')
-    opt_sleep_time_per_page = int(helper.get_arg('sleep_time_per_page'))
     opt_num_retries_per_page = int(helper.get_arg('num_retries_per_page'))
     opt_backoff_time_per_page_retry = int(helper.get_arg('backoff_time_per_page_retry'))
     opt_limit_num_pages_returned = int(helper.get_arg('limit_num_pages_returned'))
+    opt_pagination_mode = helper.get_arg('pagination_mode') or 'page'
     
     all_params = {'assetnote_index': helper.get_output_index(),
                   'assetnote_sourcetype': helper.get_sourcetype(),
                   'assetnote_source': helper.get_input_type(),
                   'assetnote_api_key': opt_assetnote_api_key,
                   'assetnote_instance': opt_assetnote_instance,
-                  'sleep_time': opt_sleep_time_per_page,
                   'backoff_time': opt_backoff_time_per_page_retry,
                   'num_retries': opt_num_retries_per_page,
                   'page_count': EXPOSURES_PER_PAGE_COUNT,
-                  'limit_pages_returned': opt_limit_num_pages_returned}
+                  'limit_pages_returned': opt_limit_num_pages_returned,
+                  'pagination_mode': opt_pagination_mode,
+                  'end_cursor': None,
+                  'offset': 0}
+    all_params.update(get_page_size_options(helper))
+    all_params.update(get_event_options(helper))
+    all_params.update(get_transport_options(helper))
+    
+    # Requests are made as fast as the instance allows, slowing down when it
+    # signals pressure
+    if rate_limiter is None:
+        rate_limiter = create_rate_limiter(helper)
     
     # Printing all the current parameters to internal log
     msg = ("assetnote_index: {assetnote_index},"
            "assetnote_sourcetype: {assetnote_sourcetype},"
            "assetnote_api_key: {assetnote_api_key},"
            "assetnote_instance: {assetnote_instance}")
-    info(helper, all_params, msg)
+    debug(helper, all_params, msg)
 
+    # Fail fast without requesting anything while the instance is down, as
+    # seen by any of the inputs
+    if circuit_breaker is None:
+        circuit_breaker = create_circuit_breaker(helper, all_params)
+    if not check_circuit_breaker(helper, all_params, rate_limiter, circuit_breaker):
+        return
+    
+    # Only the exposures updated since the previous collection are requested in
+    # the incremental mode, apart from a full collection every now and then
+    start_collection(helper, all_params, EXPOSURES_FULL_COLLECTION_ARGUMENTS)
+    
+    # The query is compiled once for the collection, with the page to request
+    # sent as variables
+    graphql_query = get_collection_query(EXPOSURES_GRAPHQL_QUERY_TEMPLATE,
+                                         all_params['collection_arguments'])
+    
+    # Only the exposures which are new or changed since they were last written are
+    # written again, if unchanged exposures are suppressed
+    fingerprint_store = create_fingerprint_store(helper, all_params)
+    all_params['num_failed_pages'] = 0
+    
+    # Exposures are only passed through as raw JSON if they need not be decoded
+    # to be fingerprinted, or to be parsed from a stream
+    if all_params['raw_passthrough'] and (fingerprint_store is not None or all_params['stream_pages']):
+        info(helper, all_params,
+             "Not passing exposures through as raw JSON, as unchanged exposures are suppressed or pages are read as a stream...")
+        all_params['raw_passthrough'] = False
+    
+    # Pages which could not be obtained in previous intervals are replayed
+    # first, and pages which cannot be obtained now are kept for the next one
+    dead_letter_queue = create_dead_letter_queue(helper, all_params)
+    replay_dead_letters(helper, ew, all_params, rate_limiter, circuit_breaker,
+                        dead_letter_queue, fingerprint_store)
+    
     info(helper, all_params,
          "Requesting exposures for instance: {assetnote_instance} page-wise...")
-    exposures = []
+    all_params['exposures_count'] = 0
     get_next_page = True
     all_params['page_num'] = 1
+    all_params['consecutive_failed_pages'] = 0
+    
+    page_size_controller = create_page_size_controller(helper, all_params, 
+                                                       'exposures', 
+                                                       EXPOSURES_PER_PAGE_COUNT)
     
     while get_next_page:
 
         all_params['try'] = 0
         all_params['page_load_success'] = False
+        all_params['streamed_on_page'] = 0
         
         while not all_params['page_load_success'] \
             and all_params['try'] < all_params['num_retries']:
             
             all_params['try'] += 1
+            resp_json = ""
+            raw_exposures_on_page = None
+            if circuit_breaker.is_open():
+                info(helper, all_params,
+                     "Circuit breaker open for instance: {assetnote_instance}, not requesting any more pages...")
+                status_code = -1
+                break
             
-            info(helper, all_params, 
+            debug(helper, all_params, 
                  "Try: {try}. Requesting page: {page_num} for exposures from AssetNote...")
-            graphql_query = EXPOSURES_GRAPHQL_QUERY_TEMPLATE.format(**all_params)
-            url_to_call = "https://{assetnote_instance}.assetnotecloud.com/api/v2/graphql".format(**all_params)
-            method = "POST"
-            headers={
-                "X-ASSETNOTE-API-KEY": "{assetnote_api_key}".format(**all_params)
-            }
-            payload = dict(query=graphql_query)
-            try:
-                resp = helper.send_http_request(url=url_to_call,
-                                                method=method, 
-                                                payload=payload,
-                                                headers=headers,
-                                                verify=True,
-                                                use_proxy=True)
+            all_params['page_count'] = page_size_controller.get_page_size()
             
+            # The records already written from a page which broke off part way
+            # must stay on the page requested again after the same cursor
+            if all_params['pagination_mode'] == 'cursor':
+                all_params['page_count'] = max(all_params['page_count'],
+                                               all_params['streamed_on_page'])
+            variables = get_page_variables(all_params)
+            try:
+                # Attempt to make HTTP request to load the page with exposures
+                resp = send_graphql_request(helper, all_params, graphql_query,
+                                            rate_limiter, circuit_breaker,
+                                            stream=all_params['stream_pages'],
+                                            variables=variables)
                 status_code = resp.status_code
-                resp_text = resp.text
+                
+                # Page with GraphQL errors (eg page count too large) was not
+                # loaded successfully either
+                if status_code == 200:
+                    
+                    # Records on a page read as a stream are written as soon
+                    # as they are parsed, leaving only the page info to check
+                    if all_params['stream_pages']:
+                        resp_json = write_streamed_page(helper, ew, all_params, resp,
+                                                        'exposures', fingerprint_store)
+                    
+                    # Records passed through as raw JSON are only located in
+                    # the response, and left out of the JSON decoded
+                    elif all_params['raw_passthrough']:
+                        resp_json, raw_exposures_on_page = split_raw_page(resp.content, 'exposures')
+                    else:
+                        resp_json = JSON_BACKEND.loads(resp.content)
+                    if 'errors' in resp_json or not resp_json.get('data'):
+                        status_code = -1
+                        info(helper, all_params,
+                             "GraphQL errors returned for page: {page_num} for try: {try}...")
+                    else:
+                        page_size_controller.record_success(all_params['page_count'],
+                                                            resp.total_time)
+                else:
+                    resp.close()
+
                     
             except Exception as e:
                 
@@ -190,7 +404,7 @@ def collect_events(helper, ew):
                 status_code = -1
                 err_class = str(e.__class__)
                 raw_err_msg = str(e)
-                err_msg  = "Error in send_http_request for page: {page_num} in try: {try}. "
+                err_msg  = "Error in send_graphql_request for page: {page_num} in try: {try}. "
                 err_msg += "Error: {}, {}".format(err_class, raw_err_msg)
                 info(helper, all_params, err_msg)
                 
@@ -200,63 +414,132 @@ def collect_events(helper, ew):
                     all_params['page_load_success'] = True
             else:
                 all_params['page_load_success'] = False
-                info(helper, all_params, 
-                    "Sleeping {backoff_time}s before requesting same page...")
-                time.sleep(all_params['backoff_time'])
+                if page_size_controller.record_failure(all_params['page_count']):
+                    all_params['next_page_count'] = page_size_controller.get_page_size()
+                    info(helper, all_params,
+                         "Requesting same page with page count: {next_page_count}...")
+                if not circuit_breaker.is_open():
+                    debug(helper, all_params, 
+                        "Sleeping {backoff_time}s before requesting same page...")
+                    time.sleep(all_params['backoff_time'])
 
-        info(helper, all_params,
+        debug(helper, all_params,
             "Checking if page: {page_num} obtained successfully...")
             
-        if (status_code == -1) or (status_code != 200 or "data" not in resp_text):
+        if status_code != 200:
             
             info(helper, all_params, "Error encountered when retrieving page: {page_num}...")
-            info(helper, all_params, "Error: ")
-            info(helper, all_params,
-                 str(resp_json), format_params=False)
-            get_next_page = False
+            debug(helper, all_params,
+                  lambda: "Error: " + str(resp_json), format_params=False)
+            
+            # Records written from the page before it broke off are counted
+            all_params['exposures_count'] += all_params['streamed_on_page']
+            all_params['num_failed_pages'] += 1
+            
+            # The exposures updated since the high-water mark are ordered by
+            # 'lastUpdated', which changes between intervals, so a page
+            # replayed by its position would hold other exposures. The next
+            # collection requests them again from the high-water mark instead.
+            if all_params['collection_mode'] == 'incremental':
+                info(helper, all_params,
+                     "Not adding page: {page_num} to the dead-letter queue, as the next collection requests its exposures again from the high-water mark...")
+            else:
+                all_params['dead_letter_key'] = dead_letter_queue.add('exposures', all_params)
+                info(helper, all_params,
+                     "Added page: {page_num} to the dead-letter queue as: {dead_letter_key} to replay in the next interval...")
+            
+            # Pages can only be skipped by page number, and are not skipped
+            # either if the instance looks to be down, or when collecting
+            # incrementally as the high-water mark would move past the page
+            all_params['consecutive_failed_pages'] += 1
+            if all_params['collection_mode'] == 'incremental':
+                info(helper, all_params,
+                     "Stopping so that the high-water mark is not moved past page: {page_num}...")
+                get_next_page = False
+            elif all_params['pagination_mode'] == 'cursor':
+                info(helper, all_params,
+                     "Stopping as the page after page: {page_num} cannot be obtained without its cursor...")
+                get_next_page = False
+            elif circuit_breaker.is_open():
+                info(helper, all_params,
+                     "Stopping as the circuit breaker is open for instance: {assetnote_instance}...")
+                get_next_page = False
+            elif all_params['consecutive_failed_pages'] >= MAX_CONSECUTIVE_FAILED_PAGES:
+                info(helper, all_params,
+                     "Stopping after {consecutive_failed_pages} pages failed one after another...")
+                get_next_page = False
+            elif all_params['limit_pages_returned'] > 0 and \
+                 int(all_params['page_num']) >= all_params['limit_pages_returned']:
+                info(helper, all_params,
+                     "Limit hit! Stopping extraction of more pages...")
+                get_next_page = False
+            else:
+                info(helper, all_params,
+                     "Skipping to the page after page: {page_num}...")
+                all_params['offset'] = (all_params['offset'] // all_params['page_count'] + 1) * all_params['page_count']
+                all_params['page_num'] += 1
             
         else:
+            
+            all_params['consecutive_failed_pages'] = 0
 
-            info(helper, all_params,
+            debug(helper, all_params,
                  "Parsing page: {page_num} response for exposures as JSON...")
             
-            resp_json = resp.json()
-            
-            info(helper, all_params, 
+            debug(helper, all_params, 
                 "Listing the number of exposures on the page obtained...")
-            exposures_on_page = resp_json['data']['exposures']['edges']
-            for exposure_on_page in exposures_on_page:
-                exposures.append(exposure_on_page)
-                all_params['exposures_count'] = len(exposures)
+            if raw_exposures_on_page is not None:
+                exposures_on_page = raw_exposures_on_page
+            else:
+                exposures_on_page = resp_json['data']['exposures']['edges']
+            
+            # Drop the exposures before the offset, which were already obtained
+            # when the page count changed in between pages
+            all_params['items_to_skip'] = all_params['offset'] % all_params['page_count']
+            if all_params['pagination_mode'] != 'cursor' and all_params['items_to_skip'] > 0 \
+               and exposures_on_page:
+                info(helper, all_params,
+                     "Dropping first {items_to_skip} exposures already obtained from page: {page_num}...")
+                del exposures_on_page[:all_params['items_to_skip']]
+            all_params['offset'] += len(exposures_on_page)
+            track_high_water_mark(all_params, exposures_on_page)
+            all_params['exposures_count'] += all_params['streamed_on_page'] + len(exposures_on_page)
                 
             info(helper, all_params, 
                 "Number of exposures after page: {page_num} is: {exposures_count}")
 
-            info(helper, all_params,
+            debug(helper, all_params,
                 "Checking if another page exists from page: {page_num} response...")
                 
-            info(helper, all_params, 
+            if fingerprint_store is not None:
+                exposures_on_page = fingerprint_store.filter_changed(exposures_on_page)
+                all_params['changed_count'] = len(exposures_on_page)
+                info(helper, all_params,
+                     "Number of exposures new or changed on page: {page_num} is: {changed_count}")
+            
+            debug(helper, all_params, 
                  "Calculating the number of exposures in the page...")
             all_params['exposure_count_per_page'] = len(exposures_on_page)
             
-            info(helper, all_params, 
-                 "Creating all {exposure_count_per_page} exposures as an event...")
-            new_event = helper.new_event(json.dumps(exposures_on_page, indent=4),
-                            index=all_params['assetnote_index'],
-                            sourcetype=all_params['assetnote_sourcetype'],
-                            source=all_params['assetnote_source'])
+            debug(helper, all_params, 
+                 "Creating all {exposure_count_per_page} exposures as {event_mode} events...")
+            new_events = create_events(helper, all_params, exposures_on_page)
                             
-            info(helper, all_params, 
-                 "Writing an event to Splunk index: {assetnote_index}, sourcetype: {assetnote_sourcetype}, source: {assetnote_source}...")
-            ew.write_event(new_event)
+            debug(helper, all_params, 
+                 "Writing events to Splunk index: {assetnote_index}, sourcetype: {assetnote_sourcetype}, source: {assetnote_source}...")
+            for new_event in new_events:
+                ew.write_event(new_event)
+            if fingerprint_store is not None:
+                fingerprint_store.commit()
             
             
-            info(helper, all_params, 
+            debug(helper, all_params, 
                     "Checking if next page should be obtained...")
             get_next_page_in_resp = resp_json['data']['exposures']['pageInfo']['hasNextPage']
+            all_params['end_cursor'] = resp_json['data']['exposures']['pageInfo'].get('endCursor')
             if get_next_page_in_resp:
                 
-                info(helper, all_params, 
+                debug(helper, all_params, 
                     "Checking if limit of number of pages to return has been hit...")
                 if all_params['limit_pages_returned'] > 0:
                     if int(all_params['page_num']) >= all_params['limit_pages_returned']:
@@ -269,14 +552,19 @@ def collect_events(helper, ew):
                 info(helper, all_params, 
                     "Stopping as no indication if next page is available...")
                 get_next_page = False
+                all_params['collection_complete'] = True
                     
             if get_next_page:
                 
-                info(helper, all_params, 
+                debug(helper, all_params, 
                      "Incrementing page counter...") 
                 all_params['page_num'] += 1
-                
-                info(helper, all_params, 
-                     "Sleeping for {sleep_time}s before requesting next page...")
-                time.sleep(all_params['sleep_time'])
 
+    debug(helper, all_params,
+         "Saving the learned page count for exposures...")
+    save_learned_page_size(helper, all_params, 'exposures', page_size_controller)
+    finish_collection(helper, all_params)
+    
+    if fingerprint_store is not None:
+        write_deleted_records(helper, ew, all_params, fingerprint_store)
+        fingerprint_store.close()
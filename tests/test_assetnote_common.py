@@ -0,0 +1,91 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'splunk_addon', 'backup'))
+
+import assetnote_common
+
+
+class FakeHelper(object):
+    """
+    Helper for splunk, keeping the messages logged
+
+    Arguments
+    ---------
+    log_level: str
+        Log level of the add-on eg 'DEBUG', 'INFO'
+    """
+    def __init__(self, log_level='INFO'):
+        self.log_level = log_level
+        self.messages = []
+
+    def get_log_level(self):
+        return self.log_level
+
+    def log_debug(self, msg):
+        self.messages.append(msg)
+
+    def log_info(self, msg):
+        self.messages.append(msg)
+
+
+def log_sampled(helper, count):
+    for num in range(count):
+        assetnote_common.log(helper, 'INFO', {}, "Message: {}".format(num),
+                             format_params=False, sample='test_sample')
+
+
+class ResetLogStateTest(unittest.TestCase):
+    def setUp(self):
+        assetnote_common.reset_log_state()
+
+    def test_sampling_starts_over_after_reset(self):
+        helper = FakeHelper()
+        log_sampled(helper, assetnote_common.LOG_SAMPLE_FIRST + 50)
+        self.assertEqual(len(helper.messages), assetnote_common.LOG_SAMPLE_FIRST)
+
+        # Without a reset, the messages of the next run are sampled out
+        helper.messages = []
+        log_sampled(helper, assetnote_common.LOG_SAMPLE_FIRST)
+        self.assertEqual(len(helper.messages), 0)
+
+        assetnote_common.reset_log_state()
+        helper.messages = []
+        log_sampled(helper, assetnote_common.LOG_SAMPLE_FIRST + 50)
+        self.assertEqual(len(helper.messages), assetnote_common.LOG_SAMPLE_FIRST)
+
+    def test_log_level_read_again_after_reset(self):
+        helper = FakeHelper(log_level='INFO')
+        assetnote_common.log(helper, 'DEBUG', {}, "Not written")
+        self.assertEqual(helper.messages, [])
+
+        helper.log_level = 'DEBUG'
+        assetnote_common.log(helper, 'DEBUG', {}, "Not written, as the log level is kept for the run")
+        self.assertEqual(helper.messages, [])
+
+        assetnote_common.reset_log_state()
+        assetnote_common.log(helper, 'DEBUG', {}, "Written")
+        self.assertEqual(len(helper.messages), 1)
+
+
+class GetCollectionQueryTest(unittest.TestCase):
+    template = 'query Assets($count: Int!) {{ assets({collection_arguments}count:$count) {{ total }} }}'
+
+    def test_query_compiled_once_per_collection_arguments(self):
+        graphql_query = assetnote_common.get_collection_query(self.template, 's:[],')
+        self.assertIs(assetnote_common.get_collection_query(self.template, 's:[],'), graphql_query)
+
+    def test_only_latest_query_kept_per_template(self):
+        assetnote_common.get_collection_query(self.template, 's:[],')
+        num_queries = len(assetnote_common._collection_queries)
+        for num in range(5):
+            high_water_mark = '"2024-01-0{}T00:00:00Z"'.format(num + 1)
+            collection_arguments = 'f:{{field:"lastUpdated",op:GTE,value:{}}},'.format(high_water_mark)
+            graphql_query = assetnote_common.get_collection_query(self.template, collection_arguments)
+            self.assertIn(high_water_mark, graphql_query.document)
+        self.assertEqual(len(assetnote_common._collection_queries), num_queries)
+
+
+if __name__ == '__main__':
+    unittest.main()